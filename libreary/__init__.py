@@ -1,3 +1,4 @@
+import importlib
 import logging
 from typing import Optional
 
@@ -6,7 +7,6 @@ from libreary.libreary import Libreary
 from libreary.exceptions import *
 from libreary.adapter_manager import AdapterManager
 from libreary.ingester import Ingester
-from libreary.scheduler import Scheduler
 
 __author__ = 'Ben Glick'
 __version__ = VERSION
@@ -90,6 +90,14 @@ def set_file_logger(filename: str, name: str = 'libreary',
     futures_logger.addHandler(handler)
 
 
+def __getattr__(name: str):
+    # The scheduler needs python-crontab, which most processes never touch,
+    # so it's only imported when it's first accessed.
+    if name == "Scheduler":
+        return importlib.import_module("libreary.scheduler").Scheduler
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 class NullHandler(logging.Handler):
     """Setup default logging to /dev/null since this is library."""
 
@@ -97,7 +105,8 @@ class NullHandler(logging.Handler):
         pass
 
 
-__all__ = ["Libreary", "AdapterManager", "Ingester", "Scheduler", "set_stream_logger",
+# Scheduler is provided by __getattr__
+__all__ = ["Libreary", "AdapterManager", "Ingester", "Scheduler", "set_stream_logger",  # noqa: F405
            "set_file_logger", "AUTO_LOGNAME"]
 
 
@@ -2,31 +2,51 @@ import json
 import os
 import string
 import random
-import hashlib
 import shutil
+import tempfile
+import threading
+import time
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from typing import List
 import logging
-import ast
+from copy import deepcopy
 
 from libreary.adapters.AbstractAdapter import AbstractAdapter
-from libreary.adapters.local import LocalAdapter
-from libreary.adapters.s3 import S3Adapter
-from libreary.adapters.drive import GoogleDriveAdapter
+from libreary.adapters.local import LocalAdapter, RETRIEVE_COPY
+from libreary.adapters.lazy import LazyAdapter, LazyImportTable
 from libreary.exceptions import ResourceNotIngestedException, ChecksumMismatchException, NoCopyExistsException
 from libreary.exceptions import RestorationFailedException, AdapterCreationFailedException, AdapterRestored
+from libreary.exceptions import AdapterUnavailableException, LevelNotFoundException, IngestionFailedException
 from libreary.metadata import SQLite3MetadataManager
+from libreary.hashing import checksum_file, write_and_checksum, VerifyingReader
+from libreary.adapter_registry import adapter_registry
+from libreary.scrubber import Scrubber
+from libreary.repair_queue import RepairQueue
+from libreary.latency import LatencyTracker, DEFAULT_DECAY, DEFAULT_PERCENTILE, DEFAULT_HEDGE_DELAY
+from libreary.health import AdapterHealth
+from libreary.placement import PlacementPlanner
+from libreary.streaming import StreamTee
 
 logger = logging.getLogger(__name__)
 
-adapters_translate_table = {
+# Remote adapters are imported the first time they're looked up
+adapters_translate_table = LazyImportTable({
     "LocalAdapter": LocalAdapter,
-    "S3Adapter": S3Adapter,
-    "GoogleDriveAdapter": GoogleDriveAdapter,
-}
+    "S3Adapter": "libreary.adapters.s3:S3Adapter",
+    "GoogleDriveAdapter": "libreary.adapters.drive:GoogleDriveAdapter",
+})
 metadata_man_translate_table = {
     "SQLite3MetadataManager": SQLite3MetadataManager,
 }
 
+DEFAULT_DISTRIBUTION_WORKERS = 8
+DEFAULT_ADAPTER_CONCURRENCY = 2
+DEFAULT_RETRIEVAL_WORKERS = 8
+# Names of the canonical copy's and the staged file's branches of a stream
+CANONICAL_STREAM = "canonical"
+STAGED_STREAM = "staged"
+
 
 class AdapterManager:
     """
@@ -46,13 +66,24 @@ class AdapterManager:
     - set_additional_adapter (manually create an adapter object and add it to the AdapterManager's list of adapters)
     - verify_adapter (make sure an adapter is working properly)
     - create_adapter [static method] (factory function for adapter objects)
+    - get_registered_adapter [static method] (get a long-lived adapter object from the adapter registry)
+    - get_adapter (get a long-lived adapter object sharing this manager's metadata manager)
+    - warm_up (connect every adapter ahead of first use)
     - send_resource_to_adapters (send copies a resource to all the places they need to be)
+    - get_canonical_adapter (get the canonical adapter object)
     - get_adapters_by_level (get all adapters from a level)
     - delete_resource_from_adapters (delete non-canonical copies of an object)
     - change_resource_level (change the level of an object)
     - get_canonical_copy_metadata
     - summarize_copies
     - retrieve_by_preference (retrieve an object, prefering the canonical adapter)
+    - retrieve_hedged (retrieve an object from whichever adapter is fastest)
+    - stream_to_adapters (store the copies of a resource arriving as a stream)
+    - open_resource (read a resource straight from an adapter's copy)
+    - finish_stream (make the copies of a streamed resource which need it to be recorded first)
+    - get_adapter_health (the circuit breaker state and statistics of each adapter)
+    - reset_adapter_health (return an adapter to service)
+    - check_level (check and repair every copy in a level)
     - check_single_resource_single_adapter (make sure that a copy matches the canonical copy)
     - verify_adapter_metadata (verify that a file can be retrieved)
     - get_resource_metadata
@@ -79,7 +110,25 @@ class AdapterManager:
                 "options": {
                     "dropbox_dir": "Path to dropbox directory, where files you want to ingest should be placed",
                     "output_dir": "Path to directory you want files to be retrieved to",
-                    "config_dir": "Path to config directory"
+                    "config_dir": "Path to config directory",
+                    "parallel_distribution": (optional, boolean) store copies to all adapters concurrently,
+                    "distribution_workers": (optional, int) size of the thread pool used for parallel distribution,
+                    "adapter_concurrency": (optional) {"adapter_id": max concurrent stores to that adapter},
+                    "warm_up_adapters": (optional, boolean) connect all adapters in a background thread on startup,
+                    "background_repairs": (optional, boolean) repair bad copies found on retrieve, and make stores
+                        deferred while an adapter was out of service, in the background, from a thread started with
+                        the AdapterManager. Defaults to false, which leaves them queued for `repair_queue.process` or
+                        `repair_queue.start`, and logs a warning for each deferred store. See `RepairQueue` for the
+                        other repair_* options,
+                    "retrieval_mode": (optional) "preference" (canonical adapter first, the default) or "hedged",
+                    "hedge_percentile": (optional, int) percentile of an adapter's recent retrieve times after which
+                        a hedged retrieve also asks the next adapter. Defaults to 95,
+                    "hedge_default_delay": (optional, float) seconds to wait before hedging, until an adapter
+                        has enough history for a percentile. Defaults to 1,
+                    "latency_decay": (optional, float) weight of each new sample in the adapter latency averages,
+                    "retrieval_workers": (optional, int) size of the thread pool used for hedged retrieves,
+                    "circuit_failure_threshold": (optional, int) consecutive failures before an adapter is taken
+                        out of service. See `AdapterHealth` for the other circuit_* options
                 },
                 "canonical_adapter":"Adapter Identifier for Canonical Adapter"
             }
@@ -94,6 +143,27 @@ class AdapterManager:
             self.levels = {}
             self.adapters = {}
             self.canonical_adapter = self.config["canonical_adapter"]
+            self.parallel_distribution = config["options"].get(
+                "parallel_distribution", False)
+            self.distribution_workers = config["options"].get(
+                "distribution_workers", DEFAULT_DISTRIBUTION_WORKERS)
+            self.adapter_concurrency = config["options"].get(
+                "adapter_concurrency", {})
+            self._distribution_pool = None
+            self._retrieval_pool = None
+            self.retrieval_mode = config["options"].get("retrieval_mode", "preference")
+            self.hedge_percentile = config["options"].get(
+                "hedge_percentile", DEFAULT_PERCENTILE)
+            self.hedge_default_delay = config["options"].get(
+                "hedge_default_delay", DEFAULT_HEDGE_DELAY)
+            self.retrieval_workers = config["options"].get(
+                "retrieval_workers", DEFAULT_RETRIEVAL_WORKERS)
+            self.latency = LatencyTracker(
+                decay=config["options"].get("latency_decay", DEFAULT_DECAY))
+            self.health = AdapterHealth(config["options"])
+            self.placement = PlacementPlanner(self)
+            self._adapter_semaphores = {}
+            self._pool_lock = threading.Lock()
             self.metadata_man = metadata_man
             if self.metadata_man is None:
                 raise KeyError
@@ -106,8 +176,15 @@ class AdapterManager:
         # For most use cases, this will only be on construction
         # This method should be run externally, any time a new level is added
         self.reload_levels_adapters()
+        self.scrubber = Scrubber(self, self.metadata_man, config["options"])
+        self.repair_queue = RepairQueue(self, self.metadata_man, config["options"])
+        if self.repair_queue.background:
+            self.repair_queue.start()
 
-    def reload_levels_adapters(self) -> None:
+        if config["options"].get("warm_up_adapters", False):
+            self.warm_up(background=True)
+
+    def reload_levels_adapters(self, invalidate: bool = False) -> None:
         """
         Set the `self.adapters` and `self.levels` instance variables.
 
@@ -115,9 +192,19 @@ class AdapterManager:
         either require time-sensitive authentication information (tokens, etc), or
         may be computationally expensive to create. For this reason, we want the
         `AdapterManager` to have instance variables with adapter objects.
+
+        Adapters come from the process-wide adapter registry, so reloading only creates
+        adapters that haven't been created before (or whose config files have changed).
+
+        Cached placements (see `PlacementPlanner`) are always discarded.
+
+        :param invalidate - discard every registered adapter first, forcing all of them to be rebuilt
         """
+        if invalidate:
+            adapter_registry.invalidate()
         self._set_levels()
         self._set_adapters()
+        self.placement.invalidate()
 
     def get_all_levels(self) -> List[dict]:
         """
@@ -166,13 +253,19 @@ class AdapterManager:
 
         Ensure that `self.levels` is set properly before running this, by
         calling `self._set_levels()`
+
+        The adapter objects are `LazyAdapter`s, which don't connect to their backend
+        until they are first used. Call `warm_up` to connect them ahead of time.
         """
         adapters = {}
         for level in self.levels.values():
             # Each level may need several adapters
             for adapter in level["adapters"]:
-                adapters[adapter["id"]] = AdapterManager.create_adapter(
-                    adapter["type"], adapter["id"], self.config_dir, self.config["metadata"])
+                if adapter["id"] in adapters:
+                    continue
+                adapters[adapter["id"]] = LazyAdapter(
+                    adapter["id"], adapter["type"],
+                    partial(self.get_adapter, adapter["type"], adapter["id"]))
                 logger.debug(
                     f"Created adapter {adapter['id']} of type {adapter['type']}")
         logger.debug(f"Summary of all adapters: {adapters}")
@@ -207,13 +300,41 @@ class AdapterManager:
         :param adapter_type - the type of the adapter you wish to create.
             Must be the actual class name, i.e. "LocalAdapter".
         """
-        adapter = AdapterManager.create_adapter(
-            adapter_type, adapter_id, self.config_dir, self.config["metadata"])
+        adapter = self.get_adapter(adapter_type, adapter_id)
         self.adapters[adapter_id] = adapter
         logger.debug(
             f"Manually added adapter {adapter_id} of type {adapter_type}")
         return adapter
 
+    def warm_up(self, background: bool = False):
+        """
+        Connect every adapter in `self.adapters` now, rather than on first use.
+
+        Adapters that fail to connect are logged and skipped. They'll be retried
+        (and their errors raised) when they're first used.
+
+        :param background - if True, connect from a daemon thread and return that
+            thread immediately. Otherwise, return None once all adapters are connected.
+        """
+        def connect_all():
+            for adapter in list(self.adapters.values()):
+                try:
+                    if isinstance(adapter, LazyAdapter):
+                        adapter.load()
+                except Exception as e:
+                    logger.error(
+                        f"Could not warm up adapter {adapter.adapter_id}: {e}")
+            logger.debug("Finished warming up adapters")
+
+        if not background:
+            connect_all()
+            return None
+
+        thread = threading.Thread(
+            target=connect_all, name="libreary-warm-up", daemon=True)
+        thread.start()
+        return thread
+
     def verify_adapter(self, adapter_id: str) -> bool:
         """
         Make sure an adapter is working. To do this, we store, retrieve,
@@ -229,8 +350,7 @@ class AdapterManager:
                                 for i in range(500))
         with open(dropbox_path, "w") as fh:
             fh.write(data_to_store)
-        real_checksum = hashlib.sha1(
-            open(dropbox_path, "rb").read()).hexdigest()
+        real_checksum = checksum_file(dropbox_path)
         r_id = "LIBREARY_TEST_RESORURCE"
 
         # To circumvent full ingestion process, we manually use _ingest_canonical
@@ -244,7 +364,7 @@ class AdapterManager:
         self.metadata_man.minimal_test_ingest(locator, real_checksum, r_id)
 
         new_path = adapter.retrieve(r_id)
-        new_checksum = hashlib.sha1(open(new_path, "rb").read()).hexdigest()
+        new_checksum = checksum_file(new_path, use_cache=False)
 
         r_val = False
         if new_checksum == real_checksum:
@@ -267,7 +387,8 @@ class AdapterManager:
 
     @staticmethod
     def create_adapter(adapter_type: str, adapter_id: str,
-                       config_dir: str, metadata_man_config: dict, metadata_man_type="SQLite3MetadataManager") -> AbstractAdapter:
+                       config_dir: str, metadata_man_config: dict, metadata_man_type="SQLite3MetadataManager",
+                       metadata_man: object = None) -> AbstractAdapter:
         """
         Static method for creating and returning an adapter object.
         This is essentially an Adapter factory.
@@ -276,16 +397,51 @@ class AdapterManager:
         :param adapter_id - the identifier you want to label this adapter with
         :param config_dir - configuration directory. Must contain a file called
             `{adapter_id}_config.json`
+        :param metadata_man - optional metadata manager for the adapter to share.
+            Adapters that share their caller's metadata manager take part in its
+            transactions. If omitted, a new one is created from :param metadata_man_config
         """
         cfg = AdapterManager.create_config_for_adapter(
             adapter_id, adapter_type, config_dir)
-        adapter = adapters_translate_table[adapter_type](
-            ast.literal_eval(f"{cfg}"),
-            metadata_man_translate_table[metadata_man_type](
-                ast.literal_eval(f"{metadata_man_config}")))
+        if metadata_man is None:
+            metadata_man = metadata_man_translate_table[metadata_man_type](
+                deepcopy(metadata_man_config))
+        adapter = adapters_translate_table[adapter_type](cfg, metadata_man)
 
         return adapter
 
+    @staticmethod
+    def get_registered_adapter(adapter_type: str, adapter_id: str,
+                               config_dir: str, metadata_man: object) -> AbstractAdapter:
+        """
+        Static method for getting a long-lived adapter object from the process-wide
+        adapter registry. The adapter is only created (with `create_adapter`) the
+        first time it's requested for a given configuration and metadata manager.
+
+        Prefer this to `create_adapter` anywhere an adapter is needed repeatedly.
+
+        :param adapter_type - must be the name of a valid adapter class.
+        :param adapter_id - the identifier you want to label this adapter with
+        :param config_dir - configuration directory. Must contain a file called
+            `{adapter_id}_config.json`
+        :param metadata_man - the metadata manager the adapter should use
+        """
+        cfg = AdapterManager.create_config_for_adapter(
+            adapter_id, adapter_type, config_dir)
+        return adapter_registry.get_adapter(
+            adapter_id, cfg, metadata_man, adapters_translate_table[adapter_type])
+
+    def get_adapter(self, adapter_type: str, adapter_id: str) -> AbstractAdapter:
+        """
+        Get a long-lived adapter object from the adapter registry, sharing this
+        AdapterManager's metadata manager.
+
+        :param adapter_type - must be the name of a valid adapter class.
+        :param adapter_id - the identifier of the adapter
+        """
+        return AdapterManager.get_registered_adapter(
+            adapter_type, adapter_id, self.config_dir, self.metadata_man)
+
     @staticmethod
     def create_config_for_adapter(
             adapter_id: str, adapter_type: str, config_dir: str) -> dict:
@@ -298,10 +454,11 @@ class AdapterManager:
         :param config_dir - configuration directory. Must contain a file called
             `{adapter_id}_config.json`
         """
-        base_config = json.load(
-            open("{}/{}_config.json".format(config_dir, adapter_id)))
-        general_config = json.load(
-            open("{}/config.json".format(config_dir)))
+        # Both files are cached by the registry until they change on disk
+        base_config = adapter_registry.load_config(
+            "{}/{}_config.json".format(config_dir, adapter_id))
+        general_config = adapter_registry.load_config(
+            "{}/config.json".format(config_dir))
 
         full_adapter_conf = {}
         full_adapter_conf["adapter"] = base_config["adapter"]
@@ -312,7 +469,7 @@ class AdapterManager:
         return full_adapter_conf
 
     def send_resource_to_adapters(
-            self, r_id: str, delete_after_send: bool = False) -> None:
+            self, r_id: str, delete_after_send: bool = False, parallel: bool = None) -> dict:
         """
         Sends a resource to all the places it should go. The resource must
         have already been ingested through the Ingester. This method:
@@ -322,9 +479,31 @@ class AdapterManager:
             4. Stores copies to each adapter
             5. optionally, deletes any remaining files in the dropbox directory
 
+        Returns a report of the distribution, structured as follows:
+        ```
+        {
+            "resource": r_id,
+            "stored": ["adapter_id1", ...],
+            "failed": {"adapter_id2": <Exception>, ...},
+            "deferred": ["adapter_id3", ...]
+        }
+        ```
+
+        Stores to adapters that are out of service (see `AdapterHealth`) are deferred:
+        they're put on the repair queue, which copies the resource from its canonical
+        copy once the adapter is back.
+
+        Sequential distribution stops at, and re-raises, the first failure.
+        Parallel distribution stores to every adapter at once on a bounded thread
+        pool, so its latency approaches that of the slowest adapter rather than
+        the sum of all of them. Failures are collected into the report instead
+        of being raised.
+
             :param r_id - resource UUID you wish to distribute
             :param delete_after_send - boolean indicating whether to delete
                 files after storage
+            :param parallel - store to adapters concurrently. Defaults to
+                `options.parallel_distribution`
         """
         try:
             resource_metadata = self.get_resource_metadata(r_id)[0]
@@ -332,15 +511,303 @@ class AdapterManager:
             raise ResourceNotIngestedException
 
         # Make sure that resource is in dropbox:
+        expected_location = self._ensure_in_dropbox(resource_metadata)
+
+        targets = self._get_placement(resource_metadata[2].split(","))
+        report = {"resource": r_id, "stored": [], "failed": {}, "deferred": []}
+        self._store_to_adapters(r_id, targets, report, parallel)
+
+        if delete_after_send:
+            logger.debug(f"Deleting object {r_id} after send")
+            os.remove(expected_location)
+
+        return report
+
+    def _get_placement(self, levels: List[str]) -> dict:
+        """
+        Return the adapters that copies of a resource in :param levels belong in,
+        as a dict of adapter ID to adapter. An adapter shared by several levels holds one copy.
+        """
+        return {adapter_id: self.adapters[adapter_id] for adapter_id in self.placement.plan(levels)}
+
+    def _store_to_adapters(self, r_id: str, targets: dict, report: dict, parallel: bool = None) -> None:
+        """
+        Store :param r_id to each adapter in :param targets, a dict of adapter ID to adapter,
+        and record the results in :param report. The resource must already be in the dropbox.
+        See `send_resource_to_adapters`.
+        """
+        if parallel is None:
+            parallel = self.parallel_distribution
+        if parallel and self.metadata_man.in_transaction():
+            # Worker threads use their own metadata connections, which can't see
+            # (or write past) this thread's uncommitted transaction
+            logger.debug(
+                f"Metadata transaction open, distributing {r_id} sequentially")
+            parallel = False
+
+        targets = dict(targets)
+        for adapter_id in list(targets):
+            if not self.health.available(adapter_id):
+                self._defer_store(r_id, adapter_id, report)
+                del targets[adapter_id]
+
+        if parallel:
+            self._distribute_parallel(r_id, list(targets.values()), report)
+        else:
+            for adapter in targets.values():
+                logger.debug(f"Storing object {r_id} to adapter {adapter}")
+                try:
+                    self._call(adapter, "store", r_id)
+                except AdapterUnavailableException:
+                    self._defer_store(r_id, adapter.adapter_id, report)
+                    continue
+                report["stored"].append(adapter.adapter_id)
+
+    def stream_to_adapters(self, r_id: str, filename: str, source, levels: List[str], stage: bool = False) -> dict:
+        """
+        Store the canonical copy, and the copies for :param levels, of a resource that is
+        arriving as a stream, reading the stream only once.
+
+        The stream is fed to the canonical adapter and to every adapter that can store from
+        a stream (see `AbstractAdapter.store_stream`) at the same time, so nothing is written
+        to local disk except the copies themselves. Adapters that need a real file are stored to
+        from a copy staged in the dropbox, once the resource has been recorded. With :param stage,
+        every non-canonical copy is made that way, so a slow adapter doesn't hold up the stream.
+
+        The resource's checksum is the checksum of its canonical copy. A copy whose checksum
+        doesn't match it is deleted, and reported as failed.
+
+        Returns a report, structured as follows:
+        ```
+        {
+            "resource": r_id,
+            "checksum": (str) the resource's checksum,
+            "size": (int) bytes read from the stream,
+            "locator": (str) the canonical copy's locator,
+            "stored": ["adapter_id1", ...],
+            "failed": {"adapter_id2": <Exception>, ...},
+            "deferred": ["adapter_id3", ...] adapters out of service,
+            "pending": ["adapter_id4", ...] adapters to store to from the staged file,
+            "staged": (str) path of the staged file, or None
+        }
+        ```
+
+        Once the resource is in the `resources` table, call `finish_stream` with the report
+        to make the pending and deferred copies.
+
+        Raises IngestionFailedException, after removing any copies made, if the stream
+        can't be read or the canonical copy can't be stored.
+
+        :param r_id - UUID for the new resource
+        :param filename - the resource's filename
+        :param source - a binary file object, or an iterable of bytes
+        :param levels - names of the levels the resource belongs to
+        :param stage - make every non-canonical copy from a staged file
+        """
+        canonical = self.get_canonical_adapter()
+        report = {"resource": r_id, "checksum": None, "size": 0, "locator": None, "stored": [],
+                  "failed": {}, "deferred": [], "pending": [], "staged": None}
+
+        tee = StreamTee(source)
+        stream_canonical = self._supports(canonical, "store_stream")
+        if stream_canonical:
+            tee.add(CANONICAL_STREAM, partial(
+                self._call, canonical, "store_stream", r_id, filename, canonical=True), required=True)
+        for adapter_id in self.placement.plan(levels, exclude_canonical=True):
+            adapter = self.adapters[adapter_id]
+            if not self.health.available(adapter_id):
+                report["deferred"].append(adapter_id)
+            elif stage or not self._supports(adapter, "store_stream"):
+                report["pending"].append(adapter_id)
+            else:
+                tee.add(adapter_id, partial(self._call, adapter, "store_stream", r_id, filename, canonical=False))
+
+        staged = None
+        if report["pending"] or not stream_canonical:
+            # Staged under a private name, so a file of the same name in the dropbox isn't clobbered
+            fd, staged = tempfile.mkstemp(prefix=".stream-", dir=self.dropbox_dir)
+            os.close(fd)
+            tee.add(STAGED_STREAM, partial(write_and_checksum, dst=staged), required=not stream_canonical)
+
+        logger.debug(f"Streaming object {r_id} to adapters")
+        try:
+            results, errors, report["size"] = tee.run()
+        except IngestionFailedException:
+            # Every consumer was aborted, and has removed what it wrote
+            if staged is not None and os.path.isfile(staged):
+                os.remove(staged)
+            raise
+
+        if staged is not None and os.path.isfile(staged):
+            report["staged"] = staged
+        for name in results:
+            if name not in (CANONICAL_STREAM, STAGED_STREAM):
+                report["stored"].append(name)
+        for name, error in errors.items():
+            if name not in (CANONICAL_STREAM, STAGED_STREAM):
+                report["failed"][name] = error
+
+        failure = errors.get(CANONICAL_STREAM if stream_canonical else STAGED_STREAM)
+        if failure is not None:
+            self.discard_stream(r_id, report)
+            raise IngestionFailedException(f"storing canonical copy of {r_id} failed: {failure}") from failure
+
+        try:
+            if stream_canonical:
+                report["locator"], report["checksum"] = results[CANONICAL_STREAM]
+            else:
+                report["checksum"] = results[STAGED_STREAM]
+                report["locator"] = canonical._store_canonical(staged, r_id, report["checksum"], filename)
+        except Exception as e:
+            self.discard_stream(r_id, report)
+            raise IngestionFailedException(f"storing canonical copy of {r_id} failed: {e}") from e
+
+        for adapter_id in list(report["stored"]):
+            if results[adapter_id][1] != report["checksum"]:
+                logger.error(f"Streamed copy of {r_id} in {adapter_id} doesn't match the canonical copy")
+                report["stored"].remove(adapter_id)
+                report["failed"][adapter_id] = ChecksumMismatchException()
+                try:
+                    self._call(self.adapters[adapter_id], "delete", r_id)
+                except Exception as e:
+                    logger.error(f"Could not delete bad copy of {r_id} from {adapter_id}: {e}")
+        return report
+
+    def finish_stream(self, r_id: str, report: dict) -> dict:
+        """
+        Make the copies of a streamed resource that `stream_to_adapters` left for later,
+        now that the resource is in the `resources` table, and remove the staged file.
+        Updates, and returns, :param report.
+
+        :param r_id - UUID of the resource
+        :param report - the report from `stream_to_adapters`
+        """
+        for adapter_id in report["deferred"]:
+            self._queue_deferred_store(r_id, adapter_id)
+        if report["pending"]:
+            resource_metadata = self.get_resource_metadata(r_id)[0]
+            expected_location = "{}/{}".format(self.dropbox_dir, resource_metadata[3])
+            if report["staged"] is not None and not os.path.exists(expected_location):
+                os.replace(report["staged"], expected_location)
+                report["staged"] = expected_location
+            # Checks the staged file, and fetches it from the canonical copy if staging failed
+            self._ensure_in_dropbox(resource_metadata)
+            pending = report["pending"]
+            report["pending"] = []
+            self._store_to_adapters(r_id, {adapter_id: self.adapters[adapter_id] for adapter_id in pending}, report)
+        if report["staged"] is not None and os.path.isfile(report["staged"]):
+            os.remove(report["staged"])
+        return report
+
+    def discard_stream(self, r_id: str, report: dict) -> None:
+        """
+        Remove every copy made by `stream_to_adapters` for a resource whose ingest failed
+
+        :param r_id - UUID of the resource
+        :param report - the report from `stream_to_adapters`
+        """
+        for adapter_id in report["stored"]:
+            try:
+                self._call(self.adapters[adapter_id], "delete", r_id)
+            except Exception as e:
+                logger.error(f"Could not delete copy of failed ingest {r_id} from {adapter_id}: {e}")
+        try:
+            self.get_canonical_adapter()._delete_canonical(r_id)
+        except Exception as e:
+            logger.error(f"Could not delete canonical copy of failed ingest {r_id}: {e}")
+        if report["staged"] is not None and os.path.isfile(report["staged"]):
+            os.remove(report["staged"])
+
+    def _defer_store(self, r_id: str, adapter_id: str, report: dict) -> None:
+        """
+        Queue a store to an adapter that is out of service, to be made once it's back
+        """
+        logger.warning(f"Adapter {adapter_id} is out of service. Deferring store of object {r_id}")
+        self._queue_deferred_store(r_id, adapter_id)
+        report["deferred"].append(adapter_id)
+
+    def _queue_deferred_store(self, r_id: str, adapter_id: str) -> None:
+        """
+        Queue a deferred store on the repair queue, warning if nothing is draining it
+        """
+        self.repair_queue.enqueue(r_id, adapter_id, reason="store deferred, adapter out of service")
+        if not self.repair_queue.running:
+            logger.warning(
+                f"The store of object {r_id} to {adapter_id} is queued, but repairs aren't running, so it won't "
+                f"be made until `repair_queue.process` or `Libreary.start_repairs` is called, or the next check")
+
+    @staticmethod
+    def _supports(adapter: AbstractAdapter, method: str) -> bool:
+        """
+        True if :param adapter has the optional :param method (`store_stream`, `open`, `link`...).
+
+        An adapter that hasn't connected yet is asked through its class, so it isn't connected
+        just to find out. Connecting happens in `_call`, where a failure is recorded.
+        """
+        if isinstance(adapter, LazyAdapter) and not adapter.loaded:
+            try:
+                adapter_class = adapters_translate_table[adapter.adapter_type]
+            except Exception as e:
+                logger.error(f"Could not find the class of adapter {adapter.adapter_id}: {e}")
+                return False
+            return getattr(adapter_class, method, None) is not None
+        return getattr(adapter, method, None) is not None
+
+    def _call(self, adapter: AbstractAdapter, method: str, *args, **kwargs):
+        """
+        Call :param method on :param adapter, recording the outcome in the adapter's health.
+
+        Raises AdapterUnavailableException without calling the adapter if it's out of service.
+        Exceptions that show the adapter responded (a missing or corrupt copy, for example)
+        don't count against its health.
+        """
+        adapter_id = adapter.adapter_id
+        if not self.health.allow(adapter_id):
+            raise AdapterUnavailableException(f"Adapter {adapter_id} is out of service")
+        start = time.monotonic()
+        try:
+            result = getattr(adapter, method)(*args, **kwargs)
+        except (ChecksumMismatchException, NoCopyExistsException, ResourceNotIngestedException):
+            self.health.record_success(adapter_id, time.monotonic() - start)
+            raise
+        except Exception as e:
+            self.health.record_failure(adapter_id, time.monotonic() - start, e)
+            raise
+        self.health.record_success(adapter_id, time.monotonic() - start)
+        return result
+
+    def get_adapter_health(self) -> dict:
+        """
+        Return the health of every adapter that has been used. See `AdapterHealth.summary`
+        for the structure.
+        """
+        return self.health.summary()
+
+    def reset_adapter_health(self, adapter_id: str) -> None:
+        """
+        Return an adapter that was taken out of service to service straight away,
+        rather than waiting for it to be probed.
+
+        :param adapter_id - the adapter to return to service
+        """
+        self.health.reset(adapter_id)
+
+    def _ensure_in_dropbox(self, resource_metadata: List[str]) -> str:
+        """
+        Adapters store from the dropbox directory. Make sure a good copy of
+        a resource is there, retrieving it from the canonical adapter if needed.
+
+        Returns the path to the resource in the dropbox directory.
+
+        :param resource_metadata - the resource's row from the `resources` table
+        """
+        r_id = resource_metadata[5]
         filename = resource_metadata[3]
         expected_location = "{}/{}".format(self.dropbox_dir, filename)
 
         file_there = False
         if os.path.isfile(expected_location):
-            file_hash = hashlib.sha1(
-                open(
-                    expected_location,
-                    "rb").read()).hexdigest()
+            file_hash = checksum_file(expected_location)
             expected_hash = resource_metadata[4]
             if file_hash == expected_hash:
                 # there's a file in that location, and its checksum matches
@@ -350,39 +817,93 @@ class AdapterManager:
         if not file_there:
             logger.debug(
                 f"Could not find object {r_id} in Dropbox Directory. Moving it")
-            # retrieve moves it to the retrieval dir
-            current_path = self.adapters[self.canonical_adapter].retrieve(r_id)
-            # so we move it to the dropbox_dir
-            shutil.move(current_path, expected_location)
-
-        levels = resource_metadata[2].split(",")
-        for level in levels:
-            adapters = self.get_adapters_by_level(level)
-            for adapter in adapters:
-                logger.debug(f"Storing object {r_id} to adapter {adapter}")
-                adapter.store(r_id)
+            # Retrieved into a private directory, never the `output_dir`, where it could
+            # clobber, or be moved away from under, a user's retrieve of the same resource
+            staging_dir = tempfile.mkdtemp(prefix=".restore-", dir=self.dropbox_dir)
+            try:
+                current_path = self._call(self.get_canonical_adapter(), "retrieve", r_id, output_dir=staging_dir)
+                os.replace(current_path, expected_location)
+            finally:
+                shutil.rmtree(staging_dir, ignore_errors=True)
 
-        if delete_after_send:
-            logger.debug(f"Deleting object {r_id} after send")
-            os.remove(expected_location)
+        return expected_location
+
+    def _get_distribution_pool(self) -> ThreadPoolExecutor:
+        """
+        Return the thread pool used for parallel distribution, creating it on first use
+        """
+        with self._pool_lock:
+            if self._distribution_pool is None:
+                self._distribution_pool = ThreadPoolExecutor(
+                    max_workers=self.distribution_workers,
+                    thread_name_prefix="libreary-distribute")
+            return self._distribution_pool
+
+    def _get_adapter_semaphore(self, adapter_id: str) -> threading.BoundedSemaphore:
+        """
+        Return the semaphore limiting concurrent stores to :param adapter_id
+        """
+        with self._pool_lock:
+            if adapter_id not in self._adapter_semaphores:
+                limit = self.adapter_concurrency.get(
+                    adapter_id, DEFAULT_ADAPTER_CONCURRENCY)
+                self._adapter_semaphores[adapter_id] = threading.BoundedSemaphore(limit)
+            return self._adapter_semaphores[adapter_id]
+
+    def _store_limited(self, adapter: AbstractAdapter, r_id: str) -> None:
+        """
+        Store :param r_id to :param adapter, respecting the adapter's concurrency limit
+        """
+        with self._get_adapter_semaphore(adapter.adapter_id):
+            logger.debug(f"Storing object {r_id} to adapter {adapter}")
+            self._call(adapter, "store", r_id)
+
+    def _distribute_parallel(self, r_id: str, adapters: List[AbstractAdapter],
+                             report: dict) -> None:
+        """
+        Store :param r_id to every adapter in :param adapters concurrently, and
+        record each result in :param report
+        """
+        pool = self._get_distribution_pool()
+        futures = {adapter.adapter_id: pool.submit(self._store_limited, adapter, r_id)
+                   for adapter in adapters}
+        for adapter_id, future in futures.items():
+            try:
+                future.result()
+                report["stored"].append(adapter_id)
+            except AdapterUnavailableException:
+                self._defer_store(r_id, adapter_id, report)
+            except Exception as e:
+                logger.error(
+                    f"Storing object {r_id} to adapter {adapter_id} failed: {e}")
+                report["failed"][adapter_id] = e
+
+    def get_canonical_adapter(self) -> AbstractAdapter:
+        """
+        Return the canonical adapter, whether or not it's also part of a level
+        """
+        if self.canonical_adapter in self.adapters:
+            return self.adapters[self.canonical_adapter]
+        return self.get_adapter(
+            self.config["canonical_adapter_type"], self.canonical_adapter)
 
     def get_adapters_by_level(self, level: str) -> List[AbstractAdapter]:
         """
         Get a list of adapter objects based on a level.
         Returns a list of callable adapter objects.
 
+        Raises LevelNotFoundException if there's no such level.
+
         :param level - the name of the level you want the adapters for
         """
-        adapter_names = self.levels[level]["adapters"]
-        adapters = []
-        for adapter in adapter_names:
-            adapters.append(self.adapters[adapter["id"]])
-        return adapters
+        return [self.adapters[adapter_id] for adapter_id in self.placement.level_adapters(level)]
 
     def delete_resource_from_adapters(self, r_id: str) -> None:
         """Deletes a resource from all adapters it's stored in.
            Does not delete canonical copy
 
+           Raises AdapterUnavailableException straight away if one of the adapters is out of service
+
            :param r_id - UUID of resource to delete copies of
         """
         try:
@@ -390,31 +911,75 @@ class AdapterManager:
         except IndexError:
             raise ResourceNotIngestedException
 
-        levels = resource_metadata[2].split(",")
-        for level in levels:
-            adapters = self.get_adapters_by_level(level)
-            for adapter in adapters:
-                logger.debug(f"Deleting object {r_id} from {adapter}")
-                adapter.delete(r_id)
+        for adapter_id in self.placement.plan(resource_metadata[2], exclude_canonical=True, skip_unknown=True):
+            adapter = self.adapters[adapter_id]
+            logger.debug(f"Deleting object {r_id} from {adapter}")
+            self._call(adapter, "delete", r_id)
 
-    def change_resource_level(self, r_id: str, new_levels: List[str]) -> None:
+    def change_resource_level(self, r_id: str, new_levels: List[str], parallel: bool = None) -> dict:
         """
         Assign a new set of levels to a resource.
         Removes all levels from a resource, replaces them with :param new_levels
 
+        Only the copies that have to change are touched. The resource is stored to the adapters
+        that the new levels use and that don't already hold a copy, and deleted from the adapters
+        that hold a copy no longer needed by any level. Copies in adapters shared by the old and
+        new levels are left alone, and the canonical copy is never deleted.
+
+        Returns a report of the change, structured as follows:
+        ```
+        {
+            "resource": r_id,
+            "stored": ["adapter_id1", ...],
+            "deleted": ["adapter_id2", ...],
+            "failed": {"adapter_id3": <Exception>, ...},
+            "deferred": ["adapter_id4", ...]
+        }
+        ```
+
         :param r_id - UUID of resource you'd like to change the levels of
         :param new_levels: list of names of levels to assign to the resource
+        :param parallel - store to adapters concurrently. Defaults to `options.parallel_distribution`
         """
-
         logger.debug(f"Changing object {r_id} to new levels: {new_levels}")
-        # Because d_r_f_a doesn't delete canonical copy, we can simply use
-        # it to reset
-        self.delete_resource_from_adapters(r_id)
+        try:
+            resource_metadata = self.get_resource_metadata(r_id)[0]
+        except IndexError:
+            raise ResourceNotIngestedException
+
+        if any(level not in self.levels for level in new_levels):
+            # Only reload if a level was added since the adapters were loaded
+            self.reload_levels_adapters()
+            missing = [level for level in new_levels if level not in self.levels]
+            if missing:
+                logger.error(f"Cannot change object {r_id} to nonexistent levels {missing}")
+                raise LevelNotFoundException(", ".join(missing))
+
+        required = self._get_placement(new_levels)
+        copies = self.summarize_copies(r_id)
+        held = {copy[2] for copy in copies}
+        to_store = {adapter_id: adapter for adapter_id, adapter in required.items() if adapter_id not in held}
+        to_delete = [copy for copy in copies if not int(copy[6]) and copy[2] not in required]
+
+        report = {"resource": r_id, "stored": [], "deleted": [], "failed": {}, "deferred": []}
+        # Store new copies first, so the resource never has fewer copies than either set of levels needs
+        if to_store:
+            self._ensure_in_dropbox(resource_metadata)
+            self._store_to_adapters(r_id, to_store, report, parallel)
+
         self.metadata_man.update_resource_levels(r_id, new_levels)
-        # now that we've updated the levels, we refresh levels
-        self.reload_levels_adapters()
-        # now, we can just act as if it has never been sent off:
-        self.send_resource_to_adapters(r_id)
+
+        for copy in to_delete:
+            adapter_id = copy[2]
+            adapter = self.adapters.get(adapter_id) or self.get_adapter(copy[5], adapter_id)
+            logger.debug(f"Deleting object {r_id} from {adapter}")
+            try:
+                self._call(adapter, "delete", r_id)
+                report["deleted"].append(adapter_id)
+            except Exception as e:
+                logger.error(f"Deleting object {r_id} from adapter {adapter_id} failed: {e}")
+                report["failed"][adapter_id] = e
+        return report
 
     def summarize_copies(self, r_id: str) -> List[List[str]]:
         """
@@ -439,7 +1004,7 @@ class AdapterManager:
         """
         return self.metadata_man.get_canonical_copy_metadata(self, r_id)
 
-    def retrieve_by_preference(self, r_id: str) -> str:
+    def retrieve_by_preference(self, r_id: str, in_place: bool = False) -> str:
         """
         Retrieve a resource.
 
@@ -450,25 +1015,302 @@ class AdapterManager:
 
         Keep in mind that the output directory may be volatile and should not be used for storage.
 
+        If `options.retrieval_mode` is "hedged", this uses `retrieve_hedged` instead.
+
         :param r_id - UUID of resource you'd like to retrieve
+        :param in_place - hand back a link to, or the path of, a stored copy rather than copying it,
+            from adapters configured to (see `LocalAdapter.link`). The file must then only be read.
         """
-        # First, try the canonical copy:
-        try:
-            new_loc = self.adapters[self.canonical_adapter].retrieve(r_id)
-            return new_loc
-        except ChecksumMismatchException:
-            logger.error(
-                "Canonical Recovery Failed. Attempting to Restore Canonical Copy")
-            self.restore_canonical_copy(r_id)
+        if in_place:
+            new_loc = self._retrieve_in_place(r_id)
+            if new_loc is not None:
+                return new_loc
 
-        for adapter in self.adapters.values():
+        if self.retrieval_mode == "hedged":
+            return self.retrieve_hedged(r_id)
+
+        # Bad copies are repaired in the background, so the retrieve doesn't wait on them.
+        # Adapters that are out of service are skipped.
+        canonical = self.get_canonical_adapter()
+        adapters = [canonical] + [adapter for adapter in self.adapters.values()
+                                  if adapter.adapter_id != self.canonical_adapter]
+        for adapter in adapters:
+            if not self.health.available(adapter.adapter_id):
+                logger.debug(f"Skipping adapter {adapter.adapter_id}, which is out of service")
+                continue
             try:
-                new_loc = adapter.retrieve(r_id)
+                new_loc = self._timed_retrieve(adapter, r_id)
                 return new_loc
             except ChecksumMismatchException:
                 logger.error(
-                    "Canonical Recovery Failed. Attempting to Restore Canonical Copy")
-                self.restore_from_canonical_copy(adapter.adapter_id, r_id)
+                    f"Copy of {r_id} in {adapter.adapter_id} is corrupt. Queueing a repair")
+                self.repair_queue.enqueue(
+                    r_id, adapter.adapter_id, canonical=adapter is canonical,
+                    reason="checksum mismatch on retrieve")
+            except ResourceNotIngestedException:
+                raise
+            except (NoCopyExistsException, AdapterUnavailableException):
+                continue
+            except Exception as e:
+                logger.error(f"Retrieving {r_id} from {adapter.adapter_id} failed: {e}")
+
+        return None
+
+    def open_resource(self, r_id: str, offset: int = 0, length: int = None):
+        """
+        Open a resource for reading, straight from an adapter's copy, without
+        retrieving it to the `output_dir` first.
+
+        Adapters holding a copy are tried fastest first (see `_get_retrieval_candidates`).
+        When the whole resource is opened, the stream is checked against the resource's checksum
+        as it's read, and ChecksumMismatchException is raised when the end is reached if it
+        doesn't match. The bad copy is queued for repair. Part of a resource can't be checked
+        against the whole resource's checksum, so ranges aren't verified.
+
+        Returns a binary file object, or None if no adapter could open the resource.
+
+        :param r_id - UUID of the resource to open
+        :param offset - first byte to read
+        :param length - number of bytes to read, or None to read to the end
+        """
+        if offset < 0 or (length is not None and length < 0):
+            raise ValueError(f"Invalid range of {r_id}: offset {offset}, length {length}")
+        try:
+            checksum = self.get_resource_metadata(r_id)[0][4]
+        except IndexError:
+            raise ResourceNotIngestedException
+
+        canonical = self.get_canonical_adapter()
+        for adapter in self._get_retrieval_candidates(r_id):
+            try:
+                if not self._supports(adapter, "open"):
+                    continue
+                stream = self._call(adapter, "open", r_id, offset, length)
+            except ResourceNotIngestedException:
+                raise
+            except (NoCopyExistsException, AdapterUnavailableException):
+                continue
+            except Exception as e:
+                logger.error(f"Opening {r_id} in {adapter.adapter_id} failed: {e}")
+                continue
+            if offset != 0 or length is not None:
+                return stream
+            return VerifyingReader(stream, checksum, on_mismatch=partial(
+                self.repair_queue.enqueue, r_id, adapter.adapter_id, canonical=adapter is canonical,
+                reason="checksum mismatch on read"))
+        return None
+
+    def _retrieve_in_place(self, r_id: str) -> str:
+        """
+        Return a link to, or the path of, a stored copy of :param r_id, from the fastest
+        adapter that can make one. Returns None if none can.
+
+        Only adapters configured with a `retrieve_mode` other than "copy" are asked.
+        """
+        for adapter in self._get_retrieval_candidates(r_id):
+            try:
+                if not self._retrieves_in_place(adapter) or not self._supports(adapter, "link"):
+                    continue
+                new_loc = self._call(adapter, "link", r_id)
+            except ResourceNotIngestedException:
+                raise
+            except (NoCopyExistsException, AdapterUnavailableException):
+                continue
+            except Exception as e:
+                logger.error(f"Linking {r_id} from {adapter.adapter_id} failed: {e}")
+                continue
+            if new_loc is not None:
+                return new_loc
+        return None
+
+    def _retrieves_in_place(self, adapter: AbstractAdapter) -> bool:
+        """
+        True if :param adapter is configured with a `retrieve_mode` other than "copy". An adapter
+        that hasn't connected yet is answered from its configuration, so it isn't connected just to ask.
+        """
+        if isinstance(adapter, LazyAdapter) and not adapter.loaded:
+            config = self.create_config_for_adapter(adapter.adapter_id, adapter.adapter_type, self.config_dir)
+            return config["adapter"].get("retrieve_mode", RETRIEVE_COPY) != RETRIEVE_COPY
+        return getattr(adapter, "retrieve_mode", RETRIEVE_COPY) != RETRIEVE_COPY
+
+    def retrieve_hedged(self, r_id: str) -> str:
+        """
+        Retrieve a resource from whichever adapter serves it fastest.
+
+        Adapters holding a copy are ranked by their recent retrieve latency and throughput.
+        The retrieve starts on the fastest. If it's still running once it's in that adapter's
+        tail (`options.hedge_percentile` of its recent retrieve times), and hasn't written any
+        bytes since it was last looked at, the same retrieve is started on the next-best
+        adapter, and whichever finishes first wins. One that's slow but still making progress
+        is looked at again after the same delay. A failed retrieve moves straight on to the
+        next adapter.
+
+        Python threads can't be interrupted, so the losing retrieve runs to completion in the
+        background, and its file is discarded.
+
+        Returns the path to the retrieved file in `output_dir`, or None if no adapter could provide it.
+
+        :param r_id - UUID of resource you'd like to retrieve
+        """
+        candidates = self._get_retrieval_candidates(r_id)
+        if not candidates:
+            logger.error(f"No adapter holding {r_id} is in service")
+            return None
+        pool = self._get_retrieval_pool()
+        pending = {}
+
+        def launch():
+            adapter = candidates.pop(0)
+            staging_dir = tempfile.mkdtemp(prefix=".retrieve-", dir=self.ret_dir)
+            future = pool.submit(self._timed_retrieve, adapter, r_id, staging_dir)
+            pending[future] = (adapter, staging_dir)
+            return future
+
+        primary = launch()
+        hedged = False
+        # Bytes the primary had written when it was last looked at
+        progress = 0
+        while pending:
+            if primary not in pending:
+                # The primary failed while a hedge was running. The hedge takes its place
+                primary = next(iter(pending))
+                hedged = False
+                progress = 0
+            timeout = None
+            if not hedged and candidates:
+                timeout = self.latency.deadline(
+                    pending[primary][0].adapter_id, self.hedge_percentile, self.hedge_default_delay)
+            done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done:
+                adapter, staging_dir = pending[primary]
+                written = self._staged_bytes(staging_dir)
+                if written > progress:
+                    # Slow, but it's making progress. Look again after another deadline
+                    progress = written
+                    continue
+                logger.debug(
+                    f"Retrieve of {r_id} from {adapter.adapter_id} is slow. Hedging to {candidates[0].adapter_id}")
+                hedged = True
+                launch()
+                continue
+
+            for future in done:
+                adapter, staging_dir = pending.pop(future)
+                try:
+                    path = future.result()
+                except ChecksumMismatchException:
+                    logger.error(
+                        f"Copy of {r_id} in {adapter.adapter_id} is corrupt. Queueing a repair")
+                    self.repair_queue.enqueue(
+                        r_id, adapter.adapter_id, canonical=adapter.adapter_id == self.canonical_adapter,
+                        reason="checksum mismatch on retrieve")
+                    shutil.rmtree(staging_dir, ignore_errors=True)
+                    continue
+                except Exception as e:
+                    logger.error(f"Retrieving {r_id} from {adapter.adapter_id} failed: {e}")
+                    shutil.rmtree(staging_dir, ignore_errors=True)
+                    continue
+
+                for loser, (loser_adapter, loser_dir) in pending.items():
+                    loser.cancel()
+                    loser.add_done_callback(
+                        partial(self._discard_retrieve, loser_dir))
+                new_location = os.path.join(self.ret_dir, os.path.basename(path))
+                os.replace(path, new_location)
+                shutil.rmtree(staging_dir, ignore_errors=True)
+                logger.debug(f"Retrieved {r_id} from {adapter.adapter_id}")
+                return new_location
+
+            if not pending and candidates:
+                primary = launch()
+                hedged = False
+                progress = 0
+
+        logger.error(f"Could not retrieve {r_id} from any adapter")
+        return None
+
+    @staticmethod
+    def _staged_bytes(staging_dir: str) -> int:
+        """
+        Return the number of bytes a retrieve in progress has written to :param staging_dir
+        """
+        written = 0
+        for name in os.listdir(staging_dir):
+            try:
+                written += os.path.getsize(os.path.join(staging_dir, name))
+            except OSError:
+                # Renamed or removed as we looked
+                continue
+        return written
+
+    @staticmethod
+    def _discard_retrieve(staging_dir: str, future) -> None:
+        """
+        Remove the file fetched by a retrieve that lost a hedge
+        """
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def _get_retrieval_candidates(self, r_id: str) -> List[AbstractAdapter]:
+        """
+        Return the adapters holding a copy of :param r_id, fastest first.
+        Adapters with no history are tried canonical adapter first.
+        """
+        adapter_ids = [self.canonical_adapter]
+        for copy in self.metadata_man.summarize_copies(r_id):
+            if copy[2] not in adapter_ids and copy[2] in self.adapters:
+                adapter_ids.append(copy[2])
+        canonical = self.get_canonical_adapter()
+        get_fingerprint = getattr(canonical, "get_fingerprint", None)
+        try:
+            size = get_fingerprint(r_id, canonical=True)[1] if get_fingerprint else 0
+        except (NoCopyExistsException, OSError):
+            size = 0
+        adapter_ids = [adapter_id for adapter_id in adapter_ids if self.health.available(adapter_id)]
+        ranked = self.latency.rank(adapter_ids, size)
+        return [canonical if adapter_id == self.canonical_adapter else self.adapters[adapter_id]
+                for adapter_id in ranked]
+
+    def _get_retrieval_pool(self) -> ThreadPoolExecutor:
+        """
+        Return the thread pool used for hedged retrieves, creating it on first use
+        """
+        with self._pool_lock:
+            if self._retrieval_pool is None:
+                self._retrieval_pool = ThreadPoolExecutor(
+                    max_workers=self.retrieval_workers,
+                    thread_name_prefix="libreary-retrieve")
+            return self._retrieval_pool
+
+    def _timed_retrieve(self, adapter: AbstractAdapter, r_id: str, output_dir: str = None) -> str:
+        """
+        Retrieve :param r_id from :param adapter, and record how long it took
+        """
+        start = time.monotonic()
+        try:
+            if output_dir is None:
+                path = self._call(adapter, "retrieve", r_id)
+            else:
+                path = self._call(adapter, "retrieve", r_id, output_dir=output_dir)
+        except AdapterUnavailableException:
+            raise
+        except Exception:
+            self.latency.record_failure(adapter.adapter_id)
+            raise
+        self.latency.record(adapter.adapter_id, time.monotonic() - start, os.path.getsize(path))
+        return path
+
+    def check_level(self, level: str, deep: bool = False, repair: bool = True) -> dict:
+        """
+        Check, and repair, every copy of every resource in a level.
+        See `Scrubber.check_level` for the structure of the returned report.
+
+        :param level - name of the level to check
+        :param deep - compute the actual checksum of every copy
+        :param repair - attempt to repair missing and corrupt copies
+        """
+        logger.debug(f"Checking level {level}. Deep: {deep}")
+        return self.scrubber.check_level(level, deep=deep, repair=repair)
 
     def check_single_resource_single_adapter(
             self, r_id: str, adapter_type: str, adapter_id: str) -> bool:
@@ -476,44 +1318,29 @@ class AdapterManager:
         Ensure that a copy of an object matches its canonical checksum.
         This method trusts that the metadata db has the proper canonical checksum.
 
-        If a copy is found to be faulty, a restore is attempted.
-        If a copy is fount to not exist, it is created.
+        If a copy is found to be faulty or missing, a repair is queued, and False is returned.
 
         :param r_id - UUID of resource you'd like to check
-        :param r_id - adapter_id for copy of resource you are checking
+        :param adapter_type - type of the adapter holding the copy
+        :param adapter_id - adapter_id for copy of resource you are checking
         """
-        resource_info = self.get_resource_metadata(r_id)
+        try:
+            resource_info = self.get_resource_metadata(r_id)[0]
+        except IndexError:
+            raise ResourceNotIngestedException
         canonical_checksum = resource_info[4]
 
-        copies = self.get_all_copies_metadata(r_id)
-
-        for copy in copies:
-            if adapter_id == copy[2]:
-                found = True
-                if copy[2] != canonical_checksum:
-                    try:
-                        logger.debug(
-                            f"Trying to restore resource {r_id} from canonical copy")
-                        self.restore_from_canonical_copy(
-                            adapter_id, r_id)
-                    except RestorationFailedException:
-                        logger.error(
-                            "Restoration of {} in {} failed".format(
-                                r_id, adapter_id))
-                        found = False
-            # didn't find the copy from this adapter
-        if not found:
-            logger.debug(
-                f"Could not find resource {r_id} in adapter {adapter_id}")
-            try:
-                a = AdapterManager.create_adapter(
-                    adapter_type, adapter_id, self.config_dir, self.config["metadata"])
-                a.store(r_id)
-                found = True
-            except AdapterCreationFailedException:
-                logger.error("Could not create adapter {adapter_id}")
-                found = False
-        return found
+        copies = self.metadata_man.get_copy_info(r_id, adapter_id)
+        if len(copies) == 0:
+            reason = "missing"
+        elif copies[0][4] != canonical_checksum:
+            reason = "checksum mismatch"
+        else:
+            return True
+
+        logger.debug(f"Copy of resource {r_id} in adapter {adapter_id} is {reason}")
+        self.repair_queue.enqueue(r_id, adapter_id, reason=reason)
+        return False
 
     def verify_adapter_metadata(
             self, adapter_id: str, r_id: str, delete_after_check: bool = True) -> bool:
@@ -527,29 +1354,28 @@ class AdapterManager:
 
         Note, this retrieves the file, so it's relatively expensive.
 
-        If a copy is found to be faulty, a restore is attempted.
-        If a copy is fount to not exist, it is created.
+        If a copy is found to be faulty, a repair is queued, and False is returned.
 
+        :param adapter_id - adapter_id for copy of resource you are checking
         :param r_id - UUID of resource you'd like to check
-        :param r_id - adapter_id for copy of resource you are checking
         """
-        current_resource_info = self.get_resource_metadata(r_id)
+        current_resource_info = self.get_resource_metadata(r_id)[0]
         recorded_checksum = current_resource_info[4]
-        current_path = self.adapters[adapter_id].retrieve(r_id)
-        sha1Hash = hashlib.sha1(open(current_path, "rb").read())
-        new_checksum = sha1Hash.hexdigest()
+        try:
+            current_path = self.adapters[adapter_id].retrieve(r_id)
+        except ChecksumMismatchException:
+            # Adapters that verify on retrieve have already discarded the bad file
+            logger.debug(f"Copy of {r_id} in {adapter_id} is corrupt. Queueing a repair")
+            self.repair_queue.enqueue(r_id, adapter_id, reason="checksum mismatch on verify")
+            return False
+        new_checksum = checksum_file(current_path, use_cache=False)
 
         r_val = True
 
         if new_checksum != recorded_checksum:
-            try:
-                logger.debug(f"Restoring copy of {r_id} in {adapter_id}")
-                self.restore_from_canonical_copy(adapter_id, r_id)
-            except RestorationFailedException:
-                logger.error(
-                    "Restoration of {} in {} failed".format(
-                        r_id, adapter_id))
-                r_val = False
+            logger.debug(f"Copy of {r_id} in {adapter_id} is corrupt. Queueing a repair")
+            self.repair_queue.enqueue(r_id, adapter_id, reason="checksum mismatch on verify")
+            r_val = False
 
         if delete_after_check:
             os.remove(current_path)
@@ -580,9 +1406,9 @@ class AdapterManager:
         :param r_id - UUID of resource you'd like to restore
         """
         try:
-            resource_info = self.get_resource_metadata(r_id)
+            resource_info = self.get_resource_metadata(r_id)[0]
             real_checksum = resource_info[4]
-            levels = resource_info[2].split(",")
+            levels = resource_info[2]
             filename = resource_info[3]
         except IndexError:
             raise ResourceNotIngestedException
@@ -590,27 +1416,32 @@ class AdapterManager:
         self.adapters[self.canonical_adapter]._delete_canonical(r_id)
 
         current_location = 0
+        # A private directory, so a user's retrieve of the same resource isn't disturbed
+        staging_dir = tempfile.mkdtemp(prefix=".restore-", dir=self.dropbox_dir)
 
         try:
-            for level in levels:
-                adapters = self.get_adapters_by_level(level)
-                for adapter in adapters:
-                    try:
-                        logger.debug(
-                            f"Trying to restore copy of {r_id} from adapter {adapter}")
-                        current_location = adapter.retrieve(r_id)
-                        raise AdapterRestored
-                    except ResourceNotIngestedException:
-                        continue
-                    except ChecksumMismatchException:
-                        continue
-                    except NoCopyExistsException:
-                        continue
-                logger.error(f"Failed to restore copy of {r_id}")
-                return
+            for adapter_id in self.placement.plan(levels, exclude_canonical=True, skip_unknown=True):
+                adapter = self.adapters[adapter_id]
+                try:
+                    logger.debug(
+                        f"Trying to restore copy of {r_id} from adapter {adapter}")
+                    current_location = self._call(adapter, "retrieve", r_id, output_dir=staging_dir)
+                    raise AdapterRestored
+                except ResourceNotIngestedException:
+                    continue
+                except ChecksumMismatchException:
+                    continue
+                except NoCopyExistsException:
+                    continue
+                except AdapterUnavailableException:
+                    continue
+            logger.error(f"Failed to restore copy of {r_id}")
+            raise RestorationFailedException
         except AdapterRestored:
-            self.adapters[self.canonical_adapter].store_canonical(
+            self.adapters[self.canonical_adapter]._store_canonical(
                 current_location, r_id, real_checksum, filename)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
 
     def restore_from_canonical_copy(self, adapter_id: str, r_id: str) -> None:
         """
@@ -623,8 +1454,13 @@ class AdapterManager:
         """
         logger.debug(
             f"Restoring object {r_id} in adapter {adapter_id} from canonical copy.")
-        self.adapters[adapter_id].delete(r_id)
-        self.adapters[adapter_id].store(r_id)
+        try:
+            resource_metadata = self.get_resource_metadata(r_id)[0]
+        except IndexError:
+            raise ResourceNotIngestedException
+        self._ensure_in_dropbox(resource_metadata)
+        self._call(self.adapters[adapter_id], "delete", r_id)
+        self._call(self.adapters[adapter_id], "store", r_id)
 
     def compare_copies(self, r_id: str, adapter_id_1: str,
                        adapter_id_2: str, deep: bool = False) -> bool:
@@ -643,8 +1479,8 @@ class AdapterManager:
         :param deep - specify whether to run a deep or shallow check
         """
         try:
-            copy_info_1 = self.metadata_man.get_copy_info(r_id, adapter_id_1)
-            copy_info_2 = self.metadata_man.get_copy_info(r_id, adapter_id_2)
+            copy_info_1 = self.metadata_man.get_copy_info(r_id, adapter_id_1)[0]
+            copy_info_2 = self.metadata_man.get_copy_info(r_id, adapter_id_2)[0]
         except IndexError:
             logger.error(f"No copy of object {r_id} exists.")
             raise NoCopyExistsException
@@ -0,0 +1,155 @@
+import copy
+import hashlib
+import json
+import os
+import threading
+import logging
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class AdapterRegistry:
+    """
+    A process-wide registry of long-lived adapter and metadata manager objects.
+
+    Creating an adapter is expensive: its config is read from two JSON files, and
+    remote adapters authenticate and look up (or create) their bucket or folder
+    before they can be used. The registry builds each adapter once and hands the
+    same object to every caller that asks for it with the same configuration.
+
+    Adapters are keyed on their adapter ID, a hash of their full configuration,
+    and the metadata manager they were built with, so a changed config file or a
+    different metadata db always produces a fresh adapter.
+
+    Adapters are built outside the registry's lock, so an adapter that is slow to
+    connect only holds up callers waiting for that same adapter.
+
+    This class currently contains the following methods:
+
+    - load_config (read a JSON config file, cached until it changes on disk)
+    - get_adapter (return the registered adapter for a config, creating it if needed)
+    - get_metadata_manager (return the shared metadata manager for a metadata config)
+    - invalidate (forget registered adapters, so they're rebuilt on next use)
+    """
+
+    def __init__(self):
+        self._adapters = {}
+        self._metadata_managers = {}
+        self._configs = {}
+        # Held while an adapter is built, so each is only built once
+        self._building = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def config_hash(config: dict) -> str:
+        """
+        Return a stable hash of a configuration dictionary
+        """
+        return hashlib.sha1(json.dumps(
+            config, sort_keys=True, default=str).encode()).hexdigest()
+
+    def load_config(self, path: str) -> dict:
+        """
+        Load a JSON config file. The parsed file is cached until its size or
+        modification time changes. Callers get their own copy, so they're free to modify it.
+
+        :param path - path to the JSON file
+        """
+        st = os.stat(path)
+        fingerprint = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            cached = self._configs.get(path)
+            if cached is None or cached[0] != fingerprint:
+                with open(path) as fh:
+                    cached = (fingerprint, json.load(fh))
+                self._configs[path] = cached
+            return copy.deepcopy(cached[1])
+
+    def get_adapter(self, adapter_id: str, config: dict, metadata_man: object,
+                    factory: Callable) -> object:
+        """
+        Return the registered adapter for :param adapter_id and :param config,
+        creating it with `factory(config, metadata_man)` if there isn't one yet.
+
+        :param adapter_id - the adapter's identifier
+        :param config - the adapter's full configuration
+        :param metadata_man - the metadata manager the adapter should use
+        :param factory - callable that builds the adapter
+        """
+        key = (adapter_id, self.config_hash(config), id(metadata_man))
+        with self._lock:
+            adapter = self._registered(key, metadata_man)
+            if adapter is not None:
+                return adapter
+            build_lock = self._building.setdefault(key, threading.Lock())
+
+        with build_lock:
+            # Someone else may have built it while we waited
+            with self._lock:
+                adapter = self._registered(key, metadata_man)
+            if adapter is not None:
+                return adapter
+            logger.debug(f"Registering new adapter {adapter_id}")
+            try:
+                adapter = factory(config, metadata_man)
+            finally:
+                with self._lock:
+                    if self._building.get(key) is build_lock:
+                        del self._building[key]
+            with self._lock:
+                # Whichever instance was published first wins
+                registered = self._registered(key, metadata_man)
+                if registered is not None:
+                    return registered
+                self._adapters[key] = adapter
+                return adapter
+
+    def _registered(self, key: tuple, metadata_man: object) -> object:
+        """
+        Return the adapter registered under :param key, or None. Call with `self._lock` held.
+        """
+        adapter = self._adapters.get(key)
+        # id() can be reused once an object is garbage collected
+        if adapter is not None and adapter.metadata_man is metadata_man:
+            return adapter
+        return None
+
+    def get_metadata_manager(self, config: dict, factory: Callable) -> object:
+        """
+        Return the shared metadata manager for :param config, creating it with
+        `factory(config)` if there isn't one yet.
+
+        :param config - the metadata manager's configuration
+        :param factory - callable that builds the metadata manager
+        """
+        key = self.config_hash(config)
+        with self._lock:
+            if key not in self._metadata_managers:
+                logger.debug(
+                    f"Registering new metadata manager for {config.get('db_file')}")
+                self._metadata_managers[key] = factory(copy.deepcopy(config))
+            return self._metadata_managers[key]
+
+    def invalidate(self, adapter_id: str = None) -> None:
+        """
+        Forget registered adapters, so that they're rebuilt the next time they're requested.
+        Cached config files are dropped as well.
+
+        :param adapter_id - only forget this adapter. If None, forget all of them.
+        """
+        with self._lock:
+            if adapter_id is None:
+                self._adapters.clear()
+            else:
+                for key in [k for k in self._adapters if k[0] == adapter_id]:
+                    del self._adapters[key]
+            self._configs.clear()
+        logger.debug(f"Invalidated registered adapters: {adapter_id or 'all'}")
+
+    def __len__(self) -> int:
+        return len(self._adapters)
+
+
+# Shared by every AdapterManager, Ingester and Libreary in this process
+adapter_registry = AdapterRegistry()
@@ -1,6 +1,7 @@
-import hashlib
 import logging
 
+from libreary.hashing import checksum_file
+
 logger = logging.getLogger(__name__)
 
 
@@ -14,6 +15,26 @@ class AbstractAdapter:
         to different places across cyberspace. Working with many
         adapters in concert, one should be able do save sufficient
         copies to places they want them.
+
+    Adapters may also implement the following optional methods. They aren't defined
+    here, because callers check whether an adapter has them, and fall back to the
+    methods above when it doesn't:
+
+    - store_stream(r_id, filename, stream, canonical=False) -> (locator, checksum):
+        store a copy of a resource from a binary file object, as it arrives, and record it
+        in the `copies` table with the checksum of the bytes stored. The resource doesn't need
+        to be in the `dropbox_dir` or the `resources` table. Without it, adapters are stored
+        to from a file staged in the `dropbox_dir`.
+    - open(r_id, offset=0, length=None) -> binary file object: open this adapter's copy of a
+        resource for reading from byte `offset`, for `length` bytes (or to the end), without
+        copying it to the `output_dir` first. Only the range asked for should be fetched,
+        where the storage allows it.
+    - get_fingerprint(r_id, canonical=False) -> (copy_id, size, mtime_ns, inode): a cheap
+        fingerprint of a copy, without reading its contents. Deep checks skip rehashing a copy
+        whose fingerprint hasn't changed since it was last verified. Adapters that can't
+        fingerprint copies cheaply shouldn't implement this.
+    - link(r_id, output_dir=None) -> path: hand back a stored copy without copying it.
+        See `LocalAdapter.link`.
     """
 
     def __init__(config: dict):
@@ -59,7 +80,7 @@ class AbstractAdapter:
         """
         pass
 
-    def retrieve(resource_id: str) -> str:
+    def retrieve(resource_id: str, output_dir: str = None) -> str:
         """
         Retrieve a copy of a resource from this adapter.
 
@@ -71,6 +92,7 @@ class AbstractAdapter:
         May overwrite files in the `output_dir`
 
         :param r_id - the resource to retrieve's UUID
+        :param output_dir - directory to retrieve to, instead of the configured `output_dir`
         """
         pass
 
@@ -109,8 +131,7 @@ class AbstractAdapter:
         name = file_metadata[3]
         current_location = "{}/{}".format(dropbox_dir, name)
 
-        sha1Hash = hashlib.sha1(open(current_location, "rb").read())
-        sha1Hashed = sha1Hash.hexdigest()
+        sha1Hashed = checksum_file(current_location)
 
         other_copies = self.metadata_man.get_copy_info(
             r_id, self.adapter_id)
@@ -130,8 +151,7 @@ class AbstractAdapter:
         name = file_metadata[3]
         current_location = "{}/{}".format(dropbox_dir, name)
 
-        sha1Hash = hashlib.sha1(open(current_location, "rb").read())
-        sha1Hashed = sha1Hash.hexdigest()
+        sha1Hashed = checksum_file(current_location)
 
         other_copies = self.metadata_man.get_copy_info(
             r_id, self.adapter_id)
@@ -1,6 +1,19 @@
+import importlib
+
 from libreary.adapters.local import LocalAdapter
-from libreary.adapters.s3 import S3Adapter
-from libreary.adapters.drive import GoogleDriveAdapter
+
+# The remote adapters pull in heavy optional dependencies (boto3, googleapiclient),
+# so they're only imported when they're first accessed.
+_lazy_adapters = {
+    "S3Adapter": "libreary.adapters.s3",
+    "GoogleDriveAdapter": "libreary.adapters.drive",
+}
+
+
+def __getattr__(name: str):
+    if name in _lazy_adapters:
+        return getattr(importlib.import_module(_lazy_adapters[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 __all__ = ['S3Adapter',
@@ -1,7 +1,7 @@
 import os
-import hashlib
 import pickle
 from pathlib import Path
+from typing import BinaryIO, Iterator
 import logging
 
 
@@ -18,9 +18,13 @@ else:
 
 from libreary.exceptions import ResourceNotIngestedException, ChecksumMismatchException
 from libreary.exceptions import StorageFailedException, NoCopyExistsException, OptionalModuleMissingException
+from libreary.hashing import checksum_file
+from libreary.streaming import IterableReader
 
 # Google Drive Scope
 SCOPES = ['https://www.googleapis.com/auth/drive']
+# Bytes requested at a time when streaming a file from Drive
+DEFAULT_STREAM_CHUNK_SIZE = 4 * 1024 * 1024
 
 logger = logging.getLogger(__name__)
 
@@ -218,8 +222,7 @@ class GoogleDriveAdapter():
         name = file_metadata[3]
         current_location = "{}/{}".format(self.dropbox_dir, name)
 
-        sha1Hash = hashlib.sha1(open(current_location, "rb").read())
-        sha1Hashed = sha1Hash.hexdigest()
+        sha1Hashed = checksum_file(current_location)
 
         new_name = "{}_{}".format(r_id, name)
 
@@ -247,7 +250,7 @@ class GoogleDriveAdapter():
 
         return locator
 
-    def retrieve(self, r_id: str) -> str:
+    def retrieve(self, r_id: str, output_dir: str = None) -> str:
         """
         Retrieve a copy of a resource from this adapter.
 
@@ -259,6 +262,7 @@ class GoogleDriveAdapter():
         May overwrite files in the `output_dir`
 
         :param r_id - the resource to retrieve's UUID
+        :param output_dir - directory to retrieve to, instead of the configured `output_dir`
         """
         logger.debug(
             f"Retrieving object {r_id} from adapter {self.adapter_id}")
@@ -278,7 +282,7 @@ class GoogleDriveAdapter():
         copy_locator = copy_info[3]
         real_hash = copy_info[4]
 
-        new_location = "{}/{}".format(self.ret_dir, filename)
+        new_location = "{}/{}".format(output_dir or self.ret_dir, filename)
 
         if real_hash == expected_hash:
             self._download_file(copy_locator, new_location)
@@ -297,6 +301,9 @@ class GoogleDriveAdapter():
         :param new_loc - place the file should go
         """
         request = self.service.files().get_media(fileId=locator)
+        # Replace, rather than write through, a link left by an in-place retrieve
+        if os.path.lexists(new_loc):
+            os.remove(new_loc)
         Path(new_loc).touch()
         fh = open(new_loc, "wb")
         downloader = MediaIoBaseDownload(fh, request)
@@ -306,6 +313,65 @@ class GoogleDriveAdapter():
             if not status:
                 raise ChecksumMismatchException
 
+    def open(self, r_id: str, offset: int = 0, length: int = None) -> BinaryIO:
+        """
+        Open this adapter's copy of a resource for reading, without downloading it to a file.
+
+        Returns a binary file object which fetches the file from Drive in chunks, with
+        ranged `get_media` requests, as it's read. Only the range asked for is fetched.
+
+        :param r_id - the resource to open's UUID
+        :param offset - first byte to read
+        :param length - number of bytes to read, or None to read to the end
+        """
+        logger.debug(f"Opening object {r_id} in adapter {self.adapter_id}")
+        if len(self.metadata_man.get_resource_info(r_id)) == 0:
+            logger.error(f"Cannot open object {r_id}. Not ingested.")
+            raise ResourceNotIngestedException
+        try:
+            copy_locator = self.metadata_man.get_copy_info(r_id, self.adapter_id)[0][3]
+        except IndexError:
+            logger.error(
+                f"Tried to open a nonexistent copy of {r_id} from {self.adapter_id}")
+            raise NoCopyExistsException
+
+        return IterableReader(self._stream_file(copy_locator, offset, length))
+
+    def _stream_file(self, locator: str, offset: int, length: int) -> Iterator[bytes]:
+        """
+        Helper method to fetch part of a file from drive, a chunk at a time.
+
+        :param locator - google drive ID
+        :param offset - first byte to fetch
+        :param length - number of bytes to fetch, or None to fetch to the end
+        """
+        request = self.service.files().get_media(fileId=locator)
+        start = offset
+        last = None if length is None else offset + length - 1
+        while last is None or start <= last:
+            stop = start + DEFAULT_STREAM_CHUNK_SIZE - 1
+            if last is not None:
+                stop = min(stop, last)
+            response, content = request.http.request(
+                request.uri, headers={"range": f"bytes={start}-{stop}"})
+            if response.status == 416:
+                # The range starts past the end of the file
+                return
+            if response.status == 200:
+                # Drive ignored the range, and sent the whole file
+                yield content[start:None if last is None else last + 1]
+                return
+            if response.status != 206:
+                raise StorageFailedException(
+                    f"Fetching {locator} from Drive failed with status {response.status}")
+            if not content:
+                return
+            yield content
+            start += len(content)
+            size = response.get("content-range", "").rsplit("/", 1)[-1]
+            if size.isdigit() and start >= int(size):
+                return
+
     def update(self, r_id: str, updated: str) -> None:
         """
         Update a resource with a new object. Preserves UUID and all other metadata (levels, etc.)
@@ -333,8 +399,7 @@ class GoogleDriveAdapter():
 
         new_name = "canonical_{}_{}".format(r_id, filename)
 
-        sha1Hash = hashlib.sha1(open(current_path, "rb").read())
-        sha1Hashed = sha1Hash.hexdigest()
+        sha1Hashed = checksum_file(current_path)
         other_copies = self.metadata_man.get_canonical_copy_metadata(
             r_id)
         if len(other_copies) != 0:
@@ -417,8 +482,7 @@ class GoogleDriveAdapter():
             f"Getting actual checksum of object {r_id} from adapter {self.adapter_id}")
         new_path = self.retrieve(r_id)
 
-        sha1Hash = hashlib.sha1(open(new_path, "rb").read())
-        sha1Hashed = sha1Hash.hexdigest()
+        sha1Hashed = checksum_file(new_path, use_cache=False)
 
         if delete_after_download:
             logger.debug(f"Delete after download enabled on {self.adapter_id}")
@@ -0,0 +1,116 @@
+import importlib
+import threading
+import logging
+from collections.abc import MutableMapping
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class LazyAdapter:
+    """
+    A stand-in for an adapter that isn't created until it's first used.
+
+    Creating a remote adapter means network calls (authentication, listing buckets,
+    finding or creating folders). The AdapterManager knows about every adapter in
+    every level, but most processes only touch a few of them, so it hands out
+    LazyAdapters and lets each one connect the first time any of its methods or
+    attributes are used.
+
+    `adapter_id` and `adapter_type` are known up front and never trigger a connection.
+    Any error raised while creating the adapter surfaces on first use, and creation is
+    retried on the next use.
+    """
+
+    def __init__(self, adapter_id: str, adapter_type: str, loader: Callable):
+        """
+        Constructor for LazyAdapter.
+
+        :param adapter_id - the identifier of the adapter this stands in for
+        :param adapter_type - the name of the adapter's class
+        :param loader - callable with no arguments which creates and returns the real adapter
+        """
+        self.adapter_id = adapter_id
+        self.adapter_type = adapter_type
+        self._loader = loader
+        self._adapter = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        """
+        True once the real adapter has been created
+        """
+        return self._adapter is not None
+
+    def load(self) -> object:
+        """
+        Create the real adapter, if it hasn't been created already, and return it
+        """
+        if self._adapter is None:
+            with self._lock:
+                if self._adapter is None:
+                    logger.debug(
+                        f"Connecting adapter {self.adapter_id} of type {self.adapter_type}")
+                    self._adapter = self._loader()
+        return self._adapter
+
+    def __getattr__(self, name: str):
+        # Only called for attributes LazyAdapter doesn't have itself
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __repr__(self) -> str:
+        state = "connected" if self.loaded else "not connected"
+        return f"<LazyAdapter {self.adapter_id} ({self.adapter_type}, {state})>"
+
+
+class LazyImportTable(MutableMapping):
+    """
+    A name -> class translation table whose entries can be given as
+    "module.path:ClassName" strings. A string entry is imported the first time
+    it's looked up, and replaced with the class it names.
+
+    The remote adapters depend on large optional packages (boto3, googleapiclient),
+    so keeping them out of the import of `libreary` saves a noticeable amount of
+    startup time for processes that never use them.
+
+    Entries can also be plain classes, so existing code which adds its own adapters
+    to a translate table keeps working.
+    """
+
+    def __init__(self, entries: dict):
+        """
+        Constructor for LazyImportTable.
+
+        :param entries - dict mapping names to classes or "module.path:ClassName" strings
+        """
+        self._entries = dict(entries)
+
+    def __getitem__(self, name: str):
+        value = self._entries[name]
+        if isinstance(value, str):
+            module_name, attribute = value.split(":")
+            logger.debug(f"Importing {value}")
+            value = getattr(importlib.import_module(module_name), attribute)
+            self._entries[name] = value
+        return value
+
+    def __setitem__(self, name: str, value) -> None:
+        self._entries[name] = value
+
+    def __delitem__(self, name: str) -> None:
+        del self._entries[name]
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def is_loaded(self, name: str) -> bool:
+        """
+        True if the entry for :param name has already been imported
+        """
+        return not isinstance(self._entries[name], str)
@@ -1,13 +1,23 @@
 import os
-from shutil import copyfile
-import hashlib
+import stat
+from typing import BinaryIO, Optional
 import logging
 
 from libreary.exceptions import ResourceNotIngestedException, ChecksumMismatchException
-from libreary.exceptions import StorageFailedException, NoCopyExistsException
+from libreary.exceptions import StorageFailedException, NoCopyExistsException, ConfigurationError
+from libreary.hashing import checksum_file, copy_and_checksum, write_and_checksum
+from libreary.streaming import RangeReader
+from libreary.storage_layout import StorageLayout, CHECKSUM
 
 logger = logging.getLogger(__name__)
 
+# Ways `link` can hand back a stored copy
+RETRIEVE_COPY = "copy"
+RETRIEVE_HARDLINK = "hardlink"
+RETRIEVE_SYMLINK = "symlink"
+RETRIEVE_PATH = "path"
+RETRIEVE_MODES = (RETRIEVE_COPY, RETRIEVE_HARDLINK, RETRIEVE_SYMLINK, RETRIEVE_PATH)
+
 
 class LocalAdapter:
     """
@@ -41,7 +51,16 @@ class LocalAdapter:
         "adapter": {
             "storage_dir": "Directory to store objects in",
             "adapter_identifier": "Friendly identifier",
-            "adapter_type": "LocalAdapter"
+            "adapter_type": "LocalAdapter",
+            "verify_copies": "(optional, boolean) re-read each copy after writing it",
+            "fast_copy": "(optional, boolean) let the kernel copy files, or make reflinks, where the
+                filesystems allow it. Defaults to true",
+            "retrieve_mode": "(optional) how user retrieves hand back a copy: 'copy' (the default),
+                'hardlink', 'symlink' or 'path'. See `link`",
+            "layout": "(optional) how copies are arranged in storage_dir: 'flat' (the default), or fanned
+                out into subdirectories by 'uuid' or 'checksum'. See `libreary.storage_layout`",
+            "layout_depth": "(optional, int) levels of subdirectories. Defaults to 2",
+            "layout_width": "(optional, int) hex digits per subdirectory name. Defaults to 2"
         },
         "options": {
             "dropbox_dir": "path to dropbox directory",
@@ -58,6 +77,10 @@ class LocalAdapter:
             self.dropbox_dir = config["options"]["dropbox_dir"]
             self.adapter_type = "LocalAdapter"
             self.ret_dir = config["options"]["output_dir"]
+            self.verify_copies = config["adapter"].get("verify_copies", False)
+            self.fast_copy = config["adapter"].get("fast_copy", True)
+            self.retrieve_mode = config["adapter"].get("retrieve_mode", RETRIEVE_COPY)
+            self.layout = StorageLayout.from_config(config["adapter"])
 
             self.metadata_man = metadata_man
             if self.metadata_man is None:
@@ -68,6 +91,10 @@ class LocalAdapter:
             logger.error("Invalid configuration for Local Adapter")
             raise KeyError
 
+        if self.retrieve_mode not in RETRIEVE_MODES:
+            raise ConfigurationError(
+                f"retrieve_mode must be one of {', '.join(RETRIEVE_MODES)}, not {self.retrieve_mode}")
+
     def store(self, r_id: str) -> str:
         """
         Store a copy of a resource in this adapter.
@@ -82,18 +109,6 @@ class LocalAdapter:
         checksum = file_metadata[4]
         name = file_metadata[3]
         current_location = "{}/{}".format(self.dropbox_dir, name)
-        new_location = os.path.expanduser(
-            "{}/{}".format(self.storage_dir, name))
-        new_dir = os.path.expanduser("/".join(new_location.split("/")[:-1]))
-
-        sha1Hash = hashlib.sha1(open(current_location, "rb").read())
-        sha1Hashed = sha1Hash.hexdigest()
-
-        if not os.path.isdir(new_dir):
-            os.makedirs(new_dir)
-
-        if os.path.isfile(new_location):
-            new_location = "{}_{}_{}".format("/".join(new_location.split('/')[:-1]), name, r_id)
 
         other_copies = self.metadata_man.get_copy_info(
             r_id, self.adapter_id)
@@ -103,11 +118,9 @@ class LocalAdapter:
                 f"Other copies of {r_id} from {self.adapter_id} exist")
             return
 
-        if sha1Hashed == checksum:
-            copyfile(current_location, new_location)
-        else:
-            logger.error(f"Checksum Mismatch on object {r_id}")
-            raise ChecksumMismatchException
+        new_location = self._new_location(r_id, name, checksum)
+
+        sha1Hashed = self._copy_verified(current_location, new_location, checksum, r_id, use_cache=True)
 
         self.metadata_man.add_copy(
             r_id,
@@ -117,7 +130,48 @@ class LocalAdapter:
             self.adapter_type,
             canonical=False)
 
-    def retrieve(self, r_id: str) -> str:
+    def store_stream(self, r_id: str, filename: str, stream: BinaryIO, canonical: bool = False) -> tuple:
+        """
+        Store a copy of a resource from a binary file object, hashing it as it's written.
+
+        Unlike `store`, this doesn't need the resource to be in the `dropbox_dir`, or to be in
+        the `resources` table yet, so the copy can be written while the resource is still
+        arriving. The copy is recorded in the `copies` table with the checksum of the bytes
+        written, and it's up to the caller to make sure that matches the resource.
+
+        Returns `(locator, checksum)`.
+
+        :param r_id - the resource to store's UUID
+        :param filename - the resource's filename
+        :param stream - binary file object to read the resource from
+        :param canonical - store the canonical copy
+        """
+        logger.debug(
+            f"Streaming {'canonical ' if canonical else ''}copy of object {r_id} to adapter {self.adapter_id}")
+        if self.layout.layout == CHECKSUM:
+            # Where the copy goes depends on its checksum, so it's written under a
+            # temporary name, on the same filesystem, and moved into place
+            incoming = os.path.expanduser("{}/.incoming".format(self.storage_dir))
+            os.makedirs(incoming, exist_ok=True)
+            temp_location = "{}/{}{}".format(incoming, r_id, ".canonical" if canonical else "")
+            sha1Hashed = write_and_checksum(stream, temp_location)
+            new_location = self._new_location(r_id, filename, sha1Hashed, canonical)
+            os.replace(temp_location, new_location)
+        else:
+            new_location = self._new_location(r_id, filename, canonical=canonical)
+            sha1Hashed = write_and_checksum(stream, new_location)
+
+        self.metadata_man.add_copy(
+            r_id,
+            self.adapter_id,
+            new_location,
+            sha1Hashed,
+            self.adapter_type,
+            canonical=canonical)
+
+        return new_location, sha1Hashed
+
+    def retrieve(self, r_id: str, output_dir: str = None) -> str:
         """
         Retrieve a copy of a resource from this adapter.
 
@@ -128,7 +182,11 @@ class LocalAdapter:
 
         May overwrite files in the `output_dir`
 
+        The copy is hashed as it is written, and ChecksumMismatchException is
+        raised if it doesn't match the checksum recorded for this copy.
+
         :param r_id - the resource to retrieve's UUID
+        :param output_dir - directory to retrieve to, instead of the configured `output_dir`
         """
         logger.debug(
             f"Retrieving object {r_id} from adapter {self.adapter_id}")
@@ -146,17 +204,167 @@ class LocalAdapter:
             raise NoCopyExistsException
         expected_hash = copy_info[4]
         copy_path = copy_info[3]
-        real_hash = copy_info[4]
 
-        new_location = "{}/{}".format(self.ret_dir, filename)
+        new_location = "{}/{}".format(output_dir or self.ret_dir, filename)
 
-        if real_hash == expected_hash:
-            copyfile(copy_path, new_location)
-        else:
+        self._copy_verified(copy_path, new_location, expected_hash, r_id)
+
+        return new_location
+
+    def link(self, r_id: str, output_dir: str = None) -> Optional[str]:
+        """
+        Retrieve a resource without copying it, according to the adapter's `retrieve_mode`:
+
+        - "hardlink": a hard link to the stored copy, in the `output_dir`. Only possible when
+            the `output_dir` is on the same filesystem as the `storage_dir`
+        - "symlink": a symbolic link to the stored copy, in the `output_dir`
+        - "path": the path of the stored copy itself
+
+        Either way, this takes constant time and space, however big the resource is.
+
+        The caller gets the stored copy itself, not a copy of it, so it must only be read.
+        As a safeguard, the stored copy is made read-only, and its last verification is
+        forgotten, so the next deep check hashes it in full rather than trusting its fingerprint.
+
+        Returns the path, or None if the copy should be retrieved with `retrieve` instead:
+        when `retrieve_mode` is "copy", or a link can't be made here.
+
+        :param r_id - the resource to retrieve's UUID
+        :param output_dir - directory to link into, instead of the configured `output_dir`
+        """
+        if self.retrieve_mode == RETRIEVE_COPY:
+            return None
+        logger.debug(
+            f"Retrieving object {r_id} from adapter {self.adapter_id} by {self.retrieve_mode}")
+        try:
+            filename = self.metadata_man.get_resource_info(r_id)[0][3]
+        except IndexError:
+            logger.error(f"Cannot Retrieve object {r_id}. Not ingested.")
+            raise ResourceNotIngestedException
+        try:
+            copy_info = self.metadata_man.get_copy_info(
+                r_id, self.adapter_id)[0]
+        except IndexError:
+            logger.error(
+                f"Tried to retrieve a nonexistent copy of {r_id} from {self.adapter_id}")
+            raise NoCopyExistsException
+        copy_path = os.path.abspath(os.path.expanduser(copy_info[3]))
+        new_location = "{}/{}".format(output_dir or self.ret_dir, filename)
+
+        if self.retrieve_mode == RETRIEVE_HARDLINK and \
+                os.stat(copy_path).st_dev != os.stat(os.path.dirname(os.path.abspath(new_location))).st_dev:
+            logger.debug(f"Cannot hard link {copy_path} into another filesystem. Copying instead")
+            return None
+
+        if self.retrieve_mode == RETRIEVE_PATH:
+            self._protect(copy_info[0], copy_path)
+            return copy_path
+
+        try:
+            if os.path.lexists(new_location):
+                os.remove(new_location)
+            if self.retrieve_mode == RETRIEVE_HARDLINK:
+                os.link(copy_path, new_location)
+            else:
+                os.symlink(copy_path, new_location)
+        except OSError as e:
+            logger.warning(f"Could not {self.retrieve_mode} {copy_path} to {new_location}: {e}. Copying instead")
+            return None
+        # Only once the link is made, so a retrieve that falls back to copying leaves the copy alone
+        self._protect(copy_info[0], copy_path)
+        return new_location
+
+    def _protect(self, copy_id: int, copy_path: str) -> None:
+        """
+        Make a stored copy read-only, and have the next deep check hash it in full,
+        as it's handed out by `link`.
+
+        :param copy_id - the copy's id in the `copies` table
+        :param copy_path - path to the stored copy
+        """
+        mode = stat.S_IMODE(os.stat(copy_path).st_mode)
+        read_only = mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+        if read_only != mode:
+            os.chmod(copy_path, read_only)
+        self.metadata_man.invalidate_copy_verification(copy_id)
+
+    def open(self, r_id: str, offset: int = 0, length: int = None) -> BinaryIO:
+        """
+        Open this adapter's copy of a resource for reading, without copying it anywhere.
+
+        Returns a binary file object reading the stored copy directly, from byte :param offset,
+        for :param length bytes (or to the end of the copy, if :param length is None).
+
+        :param r_id - the resource to open's UUID
+        :param offset - first byte to read
+        :param length - number of bytes to read
+        """
+        logger.debug(f"Opening object {r_id} in adapter {self.adapter_id}")
+        if len(self.metadata_man.get_resource_info(r_id)) == 0:
+            logger.error(f"Cannot open object {r_id}. Not ingested.")
+            raise ResourceNotIngestedException
+        try:
+            copy_path = self.metadata_man.get_copy_info(r_id, self.adapter_id)[0][3]
+        except IndexError:
+            logger.error(
+                f"Tried to open a nonexistent copy of {r_id} from {self.adapter_id}")
+            raise NoCopyExistsException
+
+        fh = open(copy_path, "rb")
+        try:
+            fh.seek(offset)
+        except BaseException:
+            fh.close()
+            raise
+        return RangeReader(fh, length)
+
+    def _new_location(self, r_id: str, filename: str, checksum: str = None, canonical: bool = False) -> str:
+        """
+        Return where a new copy of a resource goes, according to the adapter's `layout`,
+        and make sure its directory exists. In the flat layout, a name that's already
+        taken gets the resource's UUID as a suffix.
+
+        :param r_id - UUID of the resource
+        :param filename - the resource's filename
+        :param checksum - the resource's checksum
+        :param canonical - whether it's the canonical copy
+        """
+        new_location = self.layout.path(self.storage_dir, r_id, filename, checksum, canonical)
+        os.makedirs(os.path.dirname(new_location) or ".", exist_ok=True)
+        if not self.layout.hashed and os.path.isfile(new_location):
+            new_location = "{}_{}".format(new_location, r_id)
+        return new_location
+
+    def _copy_verified(self, current_location: str, new_location: str,
+                       expected_hash: str, r_id: str, use_cache: bool = False) -> str:
+        """
+        Copy a file, hashing it, and make sure the result matches :param expected_hash.
+        On a mismatch, the partial copy is removed and ChecksumMismatchException is raised,
+        so callers only record copies that have been verified.
+
+        The copy is made the cheapest way the filesystems allow (see `libreary.copying`),
+        unless `fast_copy` is turned off.
+
+        Returns the checksum of the copied bytes.
+
+        :param current_location - path to copy from
+        :param new_location - path to copy to
+        :param expected_hash - checksum the copy must have
+        :param r_id - UUID of the resource being copied, for logging
+        :param use_cache - trust a cached checksum of the source, which was just hashed, when
+            the copy is a reflink of it. Any other copy is read back. Retrieves don't, so they
+            catch stored copies that have rotted.
+        """
+        sha1Hashed = copy_and_checksum(
+            current_location, new_location, verify_destination=self.verify_copies,
+            fast_copy=self.fast_copy, use_cache=use_cache)
+
+        if sha1Hashed != expected_hash:
             logger.error(f"Checksum Mismatch on object {r_id}")
+            os.remove(new_location)
             raise ChecksumMismatchException
 
-        return new_location
+        return sha1Hashed
 
     def update(self, r_id: str, updated_path: str) -> None:
         """
@@ -186,18 +394,6 @@ class LocalAdapter:
         logger.debug(
             f"Storing canonical copy of object {r_id} to {self.adapter_id}")
         current_location = current_path
-        new_location = os.path.expanduser(
-            "{}/canonical_{}".format(self.storage_dir, filename))
-        new_dir = os.path.expanduser("/".join(new_location.split("/")[:-1]))
-
-        sha1Hash = hashlib.sha1(open(current_location, "rb").read())
-        sha1Hashed = sha1Hash.hexdigest()
-
-        if not os.path.isdir(new_dir):
-            os.makedirs(new_dir)
-
-        if os.path.isfile(new_location):
-            new_location = "{}_{}".format(new_location, r_id)
 
         other_copies = self.metadata_man.get_canonical_copy_metadata(
             r_id)
@@ -206,11 +402,9 @@ class LocalAdapter:
                 f"Other canonical copies of {r_id} from {self.adapter_id} exist")
             raise StorageFailedException
 
-        if sha1Hashed == checksum:
-            copyfile(current_location, new_location)
-        else:
-            logger.error(f"Checksum Mismatch on object {r_id}")
-            raise ChecksumMismatchException
+        new_location = self._new_location(r_id, filename, checksum, canonical=True)
+
+        sha1Hashed = self._copy_verified(current_location, new_location, checksum, r_id, use_cache=True)
 
         self.metadata_man.add_copy(
             r_id,
@@ -241,7 +435,8 @@ class LocalAdapter:
 
         copy_path = copy_info[3]
 
-        os.remove(copy_path)
+        if os.path.isfile(copy_path):
+            os.remove(copy_path)
 
         self.metadata_man.delete_copy_metadata(copy_info[0])
 
@@ -254,11 +449,17 @@ class LocalAdapter:
         """
         logger.debug(
             f"Deleting canonical copy of object {r_id} from {self.adapter_id}")
-        copy_info = self.metadata_man.get_canonical_copy_metadata(
-            r_id)[0]
+        try:
+            copy_info = self.metadata_man.get_canonical_copy_metadata(
+                r_id)[0]
+        except IndexError:
+            logger.debug(f"No canonical copy of object {r_id} to delete")
+            return
         copy_path = copy_info[3]
 
-        os.remove(copy_path)
+        # The file may already be gone, if we're cleaning up after it went missing
+        if os.path.isfile(copy_path):
+            os.remove(copy_path)
 
         self.metadata_man.delete_copy_metadata(copy_info[0])
 
@@ -279,6 +480,23 @@ class LocalAdapter:
             raise NoCopyExistsException
         copy_info = copy_info[0]
         path = copy_info[3]
-        hash_obj = hashlib.sha1(open(path, "rb").read())
-        checksum = hash_obj.hexdigest()
+        checksum = checksum_file(path, use_cache=False)
         return checksum
+
+    def get_fingerprint(self, r_id: str, canonical: bool = False) -> tuple:
+        """
+        Returns (copy_id, size, mtime_ns, inode) for a copy of a resource, from a
+        single stat() call. Any rewrite of the file changes at least one of these.
+
+        :param r_id - resource we want the fingerprint of
+        :param canonical - fingerprint the canonical copy rather than the regular one
+        """
+        if canonical:
+            copy_info = self.metadata_man.get_canonical_copy_metadata(r_id)
+        else:
+            copy_info = self.metadata_man.get_copy_info(r_id, self.adapter_id)
+        if len(copy_info) == 0:
+            raise NoCopyExistsException
+        copy_info = copy_info[0]
+        st = os.stat(copy_info[3])
+        return (copy_info[0], st.st_size, st.st_mtime_ns, st.st_ino)
@@ -1,6 +1,7 @@
+import io
 import json
 import os
-import hashlib
+from typing import BinaryIO
 import logging
 
 try:
@@ -14,6 +15,7 @@ else:
 
 from libreary.exceptions import ResourceNotIngestedException, ChecksumMismatchException, NoCopyExistsException
 from libreary.exceptions import StorageFailedException, ConfigurationError, OptionalModuleMissingException
+from libreary.hashing import checksum_file, HashingReader
 
 logger = logging.getLogger(__name__)
 
@@ -106,7 +108,7 @@ class S3Adapter:
         self.client = boto3.client('s3')
         self.s3 = boto3.resource('s3')
 
-    def create_session(self) -> boto3.session.Session:
+    def create_session(self) -> 'boto3.session.Session':
         """Create a session.
 
         First we look in self.key_file for a path to a json file with the
@@ -182,8 +184,7 @@ class S3Adapter:
         name = file_metadata[3]
         current_location = "{}/{}".format(self.dropbox_dir, name)
 
-        sha1Hash = hashlib.sha1(open(current_location, "rb").read())
-        sha1Hashed = sha1Hash.hexdigest()
+        sha1Hashed = checksum_file(current_location)
 
         other_copies = self.metadata_man.get_copy_info(
             r_id, self.adapter_id)
@@ -229,8 +230,7 @@ class S3Adapter:
             f"Storing canonical object {r_id} to adapter {self.adapter_id}")
         current_location = current_path
 
-        sha1Hash = hashlib.sha1(open(current_location, "rb").read())
-        sha1Hashed = sha1Hash.hexdigest()
+        sha1Hashed = checksum_file(current_location)
 
         locator = "canonical_{}_{}".format(r_id, filename)
 
@@ -257,7 +257,43 @@ class S3Adapter:
 
         return locator
 
-    def retrieve(self, r_id: str) -> str:
+    def store_stream(self, r_id: str, filename: str, stream: BinaryIO, canonical: bool = False) -> tuple:
+        """
+        Store a copy of a resource from a binary file object, uploading it as it's read.
+
+        Unlike `store`, this doesn't need the resource to be in the `dropbox_dir`, or to be in
+        the `resources` table yet. The copy is recorded in the `copies` table with the checksum
+        of the bytes uploaded, and it's up to the caller to make sure that matches the resource.
+
+        Returns `(locator, checksum)`.
+
+        :param r_id - the resource to store's UUID
+        :param filename - the resource's filename
+        :param stream - binary file object to read the resource from
+        :param canonical - store the canonical copy
+        """
+        logger.debug(
+            f"Streaming {'canonical ' if canonical else ''}copy of object {r_id} to adapter {self.adapter_id}")
+        if canonical:
+            locator = "canonical_{}_{}".format(r_id, filename)
+        else:
+            locator = '{}_{}'.format(r_id, filename)
+
+        reader = HashingReader(stream)
+        self.s3.Bucket(self.bucket_name).upload_fileobj(reader, locator)
+        sha1Hashed = reader.hexdigest()
+
+        self.metadata_man.add_copy(
+            r_id,
+            self.adapter_id,
+            locator,
+            sha1Hashed,
+            self.adapter_type,
+            canonical=canonical)
+
+        return locator, sha1Hashed
+
+    def retrieve(self, r_id: str, output_dir: str = None) -> str:
         """
         Retrieve a copy of a resource from this adapter.
 
@@ -269,6 +305,7 @@ class S3Adapter:
         May overwrite files in the `output_dir`
 
         :param r_id - the resource to retrieve's UUID
+        :param output_dir - directory to retrieve to, instead of the configured `output_dir`
         """
         try:
             filename = self.metadata_man.get_resource_info(r_id)[0][3]
@@ -287,7 +324,7 @@ class S3Adapter:
         copy_locator = copy_info[3]
         real_hash = copy_info[4]
 
-        new_location = "{}/{}".format(self.ret_dir, filename)
+        new_location = "{}/{}".format(output_dir or self.ret_dir, filename)
 
         if real_hash == expected_hash:
             self.s3.Bucket(
@@ -300,6 +337,42 @@ class S3Adapter:
 
         return new_location
 
+    def open(self, r_id: str, offset: int = 0, length: int = None) -> BinaryIO:
+        """
+        Open this adapter's copy of a resource for reading, without downloading it to a file.
+
+        Returns the body of a GET of the object, which streams it from S3 as it's read.
+        If only part of the resource is wanted, only that range is requested.
+
+        :param r_id - the resource to open's UUID
+        :param offset - first byte to read
+        :param length - number of bytes to read, or None to read to the end
+        """
+        logger.debug(f"Opening object {r_id} in adapter {self.adapter_id}")
+        if len(self.metadata_man.get_resource_info(r_id)) == 0:
+            logger.error(f"Cannot open object {r_id}. Not ingested.")
+            raise ResourceNotIngestedException
+        try:
+            copy_locator = self.metadata_man.get_copy_info(r_id, self.adapter_id)[0][3]
+        except IndexError:
+            logger.error(
+                f"Tried to open a nonexistent copy of {r_id} from {self.adapter_id}")
+            raise NoCopyExistsException
+
+        if length == 0:
+            return io.BytesIO(b"")
+        request = {"Bucket": self.bucket_name, "Key": copy_locator}
+        if offset or length is not None:
+            end = "" if length is None else offset + length - 1
+            request["Range"] = f"bytes={offset}-{end}"
+        try:
+            return self.client.get_object(**request)["Body"]
+        except ClientError as e:
+            # Asking for a range starting past the end of the object
+            if e.response.get("Error", {}).get("Code") == "InvalidRange":
+                return io.BytesIO(b"")
+            raise
+
     def update(resource_id: str, updated_path: str) -> None:
         """
         Update a resource with a new object. Preserves UUID and all other metadata (levels, etc.)
@@ -325,13 +398,13 @@ class S3Adapter:
         if len(copy_info) == 0:
             # We've already deleted, probably as part of another level
             return
+        copy_info = copy_info[0]
         locator = copy_info[3]
 
         self.client.delete_object(
             Bucket=self.bucket_name, Key=locator)
-        self.cursor.execute("delete from copies where copy_id=?",
-                            [copy_info[0]])
-        self.conn.commit()
+
+        self.metadata_man.delete_copy_metadata(copy_info[0])
 
     def _delete_canonical(self, r_id: str) -> None:
         """
@@ -373,8 +446,7 @@ class S3Adapter:
             f"Getting actual checksum of object {r_id} from adapter {self.adapter_id}")
         new_path = self.retrieve(r_id)
 
-        sha1Hash = hashlib.sha1(open(new_path, "rb").read())
-        sha1Hashed = sha1Hash.hexdigest()
+        sha1Hashed = checksum_file(new_path, use_cache=False)
 
         if delete_after_download:
             logger.debug(f"Delete after download enabled on {self.adapter_id}")
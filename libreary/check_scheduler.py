@@ -0,0 +1,242 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+import logging
+
+from libreary.scrubber import OK, REPAIRED
+from libreary.metadata.base import check_slot
+
+logger = logging.getLogger(__name__)
+
+# By default, a level's frequency is the number of days between checks of each resource
+DEFAULT_FREQUENCY_UNIT = 24 * 60 * 60
+DEFAULT_TICK_INTERVAL = 60
+DEFAULT_SCHEDULED_CHECK_WORKERS = 2
+LAST_TICK_STATE = "check_scheduler.last_tick"
+
+
+class CheckScheduler:
+    """
+    An in-process scheduler which checks each resource as often as its levels ask for.
+
+    A level's `frequency` is the period between checks of each of its resources, in
+    units of `check_frequency_unit` seconds (days, by default). A resource in several
+    levels is checked on the shortest of their periods.
+
+    Rather than checking every resource at once when a period comes round, each
+    resource is given a fixed slot within its period, derived from a hash of its
+    UUID. Slots are spread evenly, so the checking load is spread evenly across the
+    period too. Every tick, the scheduler checks the resources whose slot fell since
+    the previous tick. The time of the last completed tick is saved in the metadata
+    db, so time spent stopped is caught up on after a restart.
+
+    Slots are stored, and indexed, in the metadata db, so a tick only reads the
+    resources that are due, rather than every resource in the archive.
+
+    Checks go through the Scrubber, so they're limited by its per-adapter I/O budgets.
+
+    This class currently contains the following methods:
+
+    - get_period (how often a resource should be checked)
+    - is_due (whether a resource's slot falls in a time window)
+    - slot_ranges (the slots that fall in a time window)
+    - due_resources (all resources due in a time window)
+    - tick (check everything that has come due since the last tick)
+    - start (run ticks in a background thread)
+    - stop (stop the background thread)
+    """
+
+    def __init__(self, adapter_man: object, metadata_man: object,
+                 scrubber: object, options: dict = None):
+        """
+        Constructor for the CheckScheduler object. This object can be created manually, but
+        in most cases, it will be constructed by the LIBRE-ary main object.
+
+        :param adapter_man - the AdapterManager, which knows each level's frequency
+        :param metadata_man - the metadata manager describing the resources
+        :param scrubber - the Scrubber used to check resources
+        :param options - the `options` section of the LIBRE-ary config. The following keys are used:
+        ```{json}
+        {
+            "check_frequency_unit": (optional, int) seconds per unit of level frequency. Defaults to 86400 (one day),
+            "check_tick_interval": (optional, int) seconds between ticks. Defaults to 60,
+            "scheduled_check_workers": (optional, int) resources checked concurrently. Defaults to 2,
+            "scheduled_checks_deep": (optional, boolean) run deep checks. Defaults to true
+        }
+        ```
+        """
+        options = options or {}
+        self.adapter_man = adapter_man
+        self.metadata_man = metadata_man
+        self.scrubber = scrubber
+        self.frequency_unit = options.get("check_frequency_unit", DEFAULT_FREQUENCY_UNIT)
+        self.tick_interval = options.get("check_tick_interval", DEFAULT_TICK_INTERVAL)
+        self.workers = options.get("scheduled_check_workers", DEFAULT_SCHEDULED_CHECK_WORKERS)
+        self.deep = options.get("scheduled_checks_deep", True)
+        self._thread = None
+        self._stop = threading.Event()
+        self._tick_lock = threading.Lock()
+
+    def get_period(self, resource: List[str]) -> float:
+        """
+        Return the number of seconds between checks of :param resource, or None if none
+        of its levels has a frequency set
+
+        :param resource - the resource's row from the `resources` table
+        """
+        periods = []
+        for level in resource[2].split(","):
+            if level not in self.adapter_man.levels:
+                continue
+            try:
+                frequency = float(self.adapter_man.levels[level]["frequency"])
+            except (TypeError, ValueError):
+                continue
+            if frequency > 0:
+                periods.append(frequency * self.frequency_unit)
+        return min(periods) if periods else None
+
+    @staticmethod
+    def slot_ranges(period: float, start: float, end: float) -> List[Tuple[float, float]]:
+        """
+        Return the ranges of slots (see `check_slot`) that come due in the window [start, end)
+        for resources checked every :param period seconds, as a list of `(low, high)`.
+
+        A resource with slot `s` is due at `(s + k) * period` for every integer k.
+        """
+        if end - start >= period:
+            return [(0.0, 1.0)]
+        low = (start % period) / period
+        high = (end % period) / period
+        if low <= high:
+            return [(low, high)]
+        # The window wraps round the end of a period
+        return [(low, 1.0), (0.0, high)]
+
+    @staticmethod
+    def is_due(r_id: str, period: float, start: float, end: float) -> bool:
+        """
+        Returns True if one of :param r_id's check slots falls in the window [start, end).
+        """
+        slot = check_slot(r_id)
+        return any(low <= slot < high for low, high in CheckScheduler.slot_ranges(period, start, end))
+
+    def due_resources(self, start: float, end: float):
+        """
+        Yield the rows of every resource with a check slot in the window [start, end)
+
+        Levels are grouped by period, and only the resources in each group's slot ranges are
+        read, so the cost of a tick grows with the number of resources due, not the archive.
+        """
+        levels_by_period = {}
+        for level in self.adapter_man.levels.values():
+            try:
+                frequency = float(level["frequency"])
+            except (TypeError, ValueError):
+                continue
+            if frequency > 0:
+                levels_by_period.setdefault(frequency * self.frequency_unit, []).append(level["name"])
+
+        for period, levels in levels_by_period.items():
+            for low, high in self.slot_ranges(period, start, end):
+                for batch in self.metadata_man.iter_resources_by_slot(low, high, levels):
+                    for resource in batch:
+                        # A resource in several levels is checked on the shortest period
+                        # only, which also means it's only yielded once
+                        if self.get_period(resource) == period:
+                            yield resource
+
+    def tick(self, now: float = None) -> dict:
+        """
+        Check every resource that has come due since the last tick. Returns a summary:
+        ```
+        {
+            "start": (float) unix time the window started,
+            "end": (float) unix time the window ended,
+            "checked": (int) number of resources checked,
+            "failed": ["r_id", ...] resources with a copy that couldn't be verified or repaired
+        }
+        ```
+
+        :param now - end of the window. Defaults to the current time
+        """
+        with self._tick_lock:
+            end = now if now is not None else time.time()
+            last_tick = self.metadata_man.get_scheduler_state(LAST_TICK_STATE)
+            start = float(last_tick) if last_tick is not None else end - self.tick_interval
+            summary = {"start": start, "end": end, "checked": 0, "failed": []}
+            if end <= start:
+                return summary
+
+            with ThreadPoolExecutor(max_workers=self.workers,
+                                    thread_name_prefix="libreary-scheduled-check") as pool:
+                futures = {}
+                for resource in self.due_resources(start, end):
+                    futures[resource[5]] = pool.submit(
+                        self.scrubber.check_resource, resource[5], deep=self.deep)
+                    # Don't queue up more than a few checks per worker at a time
+                    if len(futures) >= self.workers * 16:
+                        self._collect(futures, summary)
+                        futures = {}
+                self._collect(futures, summary)
+
+            # Only record the window once it's done, so an interrupted tick is redone
+            self.metadata_man.set_scheduler_state(LAST_TICK_STATE, repr(end))
+            logger.debug(
+                f"Scheduled checks: {summary['checked']} checked, {len(summary['failed'])} failed")
+            return summary
+
+    @staticmethod
+    def _collect(futures: dict, summary: dict) -> None:
+        """
+        Wait for a group of scheduled checks, and add their results to :param summary
+        """
+        for r_id, future in futures.items():
+            summary["checked"] += 1
+            try:
+                results = future.result()
+            except Exception as e:
+                logger.error(f"Scheduled check of object {r_id} failed: {e}")
+                summary["failed"].append(r_id)
+                continue
+            if not all(result["result"] in (OK, REPAIRED) for result in results):
+                summary["failed"].append(r_id)
+
+    @property
+    def running(self) -> bool:
+        """
+        True while the background thread is running
+        """
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """
+        Start running ticks every `check_tick_interval` seconds in a background thread
+        """
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="libreary-check-scheduler", daemon=True)
+        self._thread.start()
+        logger.debug("Started check scheduler")
+
+    def stop(self, timeout: float = None) -> None:
+        """
+        Stop the background thread, after any tick in progress finishes
+
+        :param timeout - seconds to wait for the thread to stop
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+        logger.debug("Stopped check scheduler")
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.tick_interval):
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"Check scheduler tick failed: {e}")
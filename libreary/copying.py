@@ -0,0 +1,201 @@
+import errno
+import os
+import sys
+import threading
+from typing import Iterable, Optional
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    _fcntl_enabled = False
+else:
+    _fcntl_enabled = True
+
+logger = logging.getLogger(__name__)
+
+REFLINK = "reflink"
+COPY_FILE_RANGE = "copy_file_range"
+SENDFILE = "sendfile"
+BUFFERED = "buffered"
+# In order of preference
+STRATEGIES = (REFLINK, COPY_FILE_RANGE, SENDFILE, BUFFERED)
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# Bytes handed to the kernel per copy_file_range or sendfile call
+KERNEL_COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Errors meaning "this filesystem (or pair of filesystems) can't do that", rather than a failed copy
+_UNSUPPORTED_ERRNOS = {errno.EOPNOTSUPP, errno.ENOTSUP, errno.EXDEV, errno.EINVAL,
+                       errno.ENOSYS, errno.ENOTTY, errno.EBADF}
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _reflink(fsrc: int, fdst: int, size: int) -> None:
+    try:
+        fcntl.ioctl(fdst, FICLONE, fsrc)
+    except OSError as e:
+        if e.errno in _UNSUPPORTED_ERRNOS:
+            raise _Unsupported from e
+        raise
+
+
+def _copy_file_range(fsrc: int, fdst: int, size: int) -> None:
+    copied = 0
+    while True:
+        try:
+            n = os.copy_file_range(fsrc, fdst, KERNEL_COPY_CHUNK_SIZE)
+        except OSError as e:
+            if copied == 0 and e.errno in _UNSUPPORTED_ERRNOS:
+                raise _Unsupported from e
+            raise
+        if n == 0:
+            break
+        copied += n
+    if copied == 0 and size > 0:
+        # Some filesystems (procfs, some FUSE mounts) report success without copying
+        raise _Unsupported
+
+
+def _sendfile(fsrc: int, fdst: int, size: int) -> None:
+    copied = 0
+    while True:
+        try:
+            n = os.sendfile(fdst, fsrc, copied, KERNEL_COPY_CHUNK_SIZE)
+        except OSError as e:
+            if copied == 0 and e.errno in _UNSUPPORTED_ERRNOS:
+                raise _Unsupported from e
+            raise
+        if n == 0:
+            break
+        copied += n
+    if copied == 0 and size > 0:
+        raise _Unsupported
+
+
+_COPIERS = {REFLINK: _reflink, COPY_FILE_RANGE: _copy_file_range, SENDFILE: _sendfile}
+
+
+def strategy_available(strategy: str) -> bool:
+    """
+    Returns True if this platform could use :param strategy at all. Whether a particular
+    pair of filesystems supports it is only found out by trying.
+    """
+    if strategy == REFLINK:
+        return _fcntl_enabled and sys.platform.startswith("linux")
+    if strategy == COPY_FILE_RANGE:
+        return hasattr(os, "copy_file_range")
+    if strategy == SENDFILE:
+        return hasattr(os, "sendfile") and sys.platform.startswith("linux")
+    return strategy == BUFFERED
+
+
+class FileCopier:
+    """
+    Copies files between local paths the cheapest way the filesystems involved allow.
+    In order of preference:
+
+    1. reflink (`FICLONE`): the copy shares the source's extents, so it takes constant
+        time and no extra space, on filesystems such as btrfs and XFS
+    2. `copy_file_range`: the kernel copies the data, without it passing through
+        userspace, and can offload it to the filesystem or storage
+    3. `sendfile`: the kernel copies the data
+    4. buffered: the data is read into, and written from, userspace
+
+    The best strategy is found by trying each in turn the first time a file is copied
+    from one filesystem to another, and is remembered, so later copies go straight to it.
+    Strategies are remembered per pair of devices, so there are only ever a few of them,
+    however many directories are copied to.
+
+    This class currently contains the following methods:
+
+    - copy (copy between two open files)
+    - get_strategy (the strategy found for a source and a destination filesystem)
+    - forget (forget the strategies found, so they're detected again)
+    """
+
+    def __init__(self, strategies: Iterable[str] = STRATEGIES):
+        """
+        Constructor for FileCopier.
+
+        :param strategies - strategies to try, in order of preference. Any this platform
+            can't use are left out. Buffered copies are always the last resort.
+        """
+        self.strategies = tuple(strategy for strategy in strategies
+                                if strategy != BUFFERED and strategy_available(strategy))
+        self._detected = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(fsrc: int, dst_dir: str) -> tuple:
+        return (os.fstat(fsrc).st_dev, os.stat(dst_dir).st_dev)
+
+    def get_strategy(self, fsrc: int, dst_dir: str) -> Optional[str]:
+        """
+        Return the strategy found for copying from the filesystem holding the open file
+        :param fsrc to the filesystem holding :param dst_dir, or None if nothing has been
+        copied between them yet.
+        """
+        with self._lock:
+            return self._detected.get(self._key(fsrc, dst_dir))
+
+    def forget(self) -> None:
+        """
+        Forget every strategy found. Call this if a storage directory is remounted.
+        """
+        with self._lock:
+            self._detected = {}
+
+    def copy(self, fsrc: int, fdst: int, dst_dir: str) -> str:
+        """
+        Copy the whole of the open file :param fsrc into the empty open file :param fdst
+        with the best strategy the filesystems support. Returns the strategy used.
+
+        If only a buffered copy would work, nothing is copied, and BUFFERED is returned, so
+        the caller can do the buffered copy itself, and process the data on its way through.
+
+        :param fsrc - file descriptor of the source, open for reading, at the start
+        :param fdst - file descriptor of the destination, open for writing, and empty
+        :param dst_dir - directory of the destination. Strategies are remembered for its filesystem
+        """
+        key = self._key(fsrc, dst_dir)
+        with self._lock:
+            detected = self._detected.get(key)
+        if detected == BUFFERED:
+            return BUFFERED
+
+        size = os.fstat(fsrc).st_size
+        # If the remembered strategy stops working, the others are tried again
+        candidates = self.strategies
+        if detected is not None:
+            candidates = (detected,) + tuple(strategy for strategy in candidates if strategy != detected)
+        for strategy in candidates:
+            try:
+                _COPIERS[strategy](fsrc, fdst, size)
+            except _Unsupported:
+                logger.debug(f"Cannot copy to {dst_dir} with {strategy}")
+                # Put both files back the way they were before trying the next one
+                os.lseek(fsrc, 0, os.SEEK_SET)
+                os.ftruncate(fdst, 0)
+                os.lseek(fdst, 0, os.SEEK_SET)
+                continue
+            if strategy != detected and size > 0:
+                self._remember(key, strategy, dst_dir)
+            return strategy
+
+        if size > 0:
+            self._remember(key, BUFFERED, dst_dir)
+        return BUFFERED
+
+    def _remember(self, key: tuple, strategy: str, dst_dir: str) -> None:
+        with self._lock:
+            logger.info(f"Copying files to {dst_dir} with {strategy}")
+            self._detected[key] = strategy
+
+
+# Shared by every LocalAdapter in this process, so each pair of filesystems is only probed once
+file_copier = FileCopier()
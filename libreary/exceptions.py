@@ -48,3 +48,11 @@ class ConfigurationError(Exception):
 
 class NoSuchMetadataFieldExeption(Exception):
     pass
+
+
+class LevelNotFoundException(Exception):
+    pass
+
+
+class AdapterUnavailableException(Exception):
+    pass
@@ -0,0 +1,431 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import BinaryIO, Callable, Optional
+
+from libreary.exceptions import ChecksumMismatchException
+from libreary.copying import file_copier, BUFFERED, REFLINK
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ALGORITHM = "sha1"
+
+# 1 MiB keeps peak memory flat while staying well above the size at which
+# hashlib drops the GIL during `update` (2047 bytes), so hashing on one
+# thread doesn't stall the others.
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+MIN_CHUNK_SIZE = 64 * 1024
+
+DEFAULT_CACHE_SIZE = 4096
+
+_chunk_size = DEFAULT_CHUNK_SIZE
+
+
+def set_default_chunk_size(chunk_size: int) -> None:
+    """
+    Set the chunk size used when no explicit chunk size is passed.
+
+    This is usually called by the LIBRE-ary main object, based on
+        `config["options"]["hash_chunk_size"]`
+
+    :param chunk_size - number of bytes to read per chunk. Values smaller than
+        `MIN_CHUNK_SIZE` are raised to it.
+    """
+    global _chunk_size
+    _chunk_size = _clamp_chunk_size(chunk_size)
+    logger.debug(f"Hash chunk size set to {_chunk_size} bytes")
+
+
+def get_default_chunk_size() -> int:
+    """
+    Return the chunk size used when no explicit chunk size is passed.
+    """
+    return _chunk_size
+
+
+def _clamp_chunk_size(chunk_size: int) -> int:
+    if chunk_size is None:
+        return _chunk_size
+    return max(int(chunk_size), MIN_CHUNK_SIZE)
+
+
+def new_hash(algorithm: str = DEFAULT_ALGORITHM):
+    """
+    Create a new hash object for :param algorithm
+    """
+    return hashlib.new(algorithm)
+
+
+def update_from_fileobj(hash_obj, fh: BinaryIO,
+                        chunk_size: int = None) -> int:
+    """
+    Feed the remaining contents of a binary file object into :param hash_obj.
+
+    A single buffer is allocated and reused through `readinto`, so memory use
+    is bounded by the chunk size regardless of the size of the object.
+    File objects without `readinto` fall back to `read`.
+
+    Returns the number of bytes consumed.
+
+    :param hash_obj - a hashlib hash object
+    :param fh - a file object opened in binary mode
+    :param chunk_size - number of bytes to read per chunk
+    """
+    chunk_size = _clamp_chunk_size(chunk_size)
+    total = 0
+
+    if not hasattr(fh, "readinto"):
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                return total
+            hash_obj.update(chunk)
+            total += len(chunk)
+
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    while True:
+        n = fh.readinto(buf)
+        if not n:
+            return total
+        hash_obj.update(view[:n])
+        total += n
+
+
+def checksum_fileobj(fh: BinaryIO, chunk_size: int = None,
+                     algorithm: str = DEFAULT_ALGORITHM) -> str:
+    """
+    Return the hex digest of the remaining contents of a binary file object.
+
+    :param fh - a file object opened in binary mode
+    :param chunk_size - number of bytes to read per chunk
+    :param algorithm - name of a hashlib algorithm
+    """
+    hash_obj = new_hash(algorithm)
+    update_from_fileobj(hash_obj, fh, chunk_size=chunk_size)
+    return hash_obj.hexdigest()
+
+
+class ChecksumCache:
+    """
+    A bounded LRU cache of file checksums, keyed on a stat fingerprint.
+
+    A single ingest hashes the dropbox file in the ingester, the adapter manager,
+    and in every adapter's `store`. Caching on
+    (device, inode, size, mtime_ns, ctime_ns) lets all of them share one read,
+    while any rewrite, truncation or replacement of the file changes the key.
+
+    The cache only ever answers "what did this exact file hash to last time",
+    so integrity checks that are looking for bit rot must not use it.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(st: os.stat_result) -> tuple:
+        """
+        Build the cache key for a stat result
+        """
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+    def get(self, st: os.stat_result,
+            algorithm: str = DEFAULT_ALGORITHM) -> Optional[str]:
+        """
+        Return the cached digest for a stat result, or None.
+
+        :param st - stat result of the file
+        :param algorithm - name of a hashlib algorithm
+        """
+        key = (self.fingerprint(st), algorithm)
+        with self._lock:
+            digest = self._entries.get(key)
+            if digest is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return digest
+
+    def put(self, st: os.stat_result, digest: str,
+            algorithm: str = DEFAULT_ALGORITHM) -> None:
+        """
+        Remember the digest for a stat result, evicting the least recently used
+        entry if the cache is full.
+
+        :param st - stat result of the file, taken before it was read
+        :param digest - the file's hex digest
+        :param algorithm - name of a hashlib algorithm
+        """
+        if self.max_entries <= 0:
+            return
+        key = (self.fingerprint(st), algorithm)
+        with self._lock:
+            self._entries[key] = digest
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def resize(self, max_entries: int) -> None:
+        """
+        Change the maximum number of entries, evicting entries if needed.
+
+        :param max_entries - new bound. 0 disables the cache.
+        """
+        with self._lock:
+            self.max_entries = max_entries
+            while len(self._entries) > max(self.max_entries, 0):
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """
+        Drop every entry
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Shared by the ingester, the adapter manager and every adapter in this process
+checksum_cache = ChecksumCache()
+
+
+def _remember(path_or_fd, before: os.stat_result, digest: str,
+              algorithm: str) -> None:
+    """
+    Cache :param digest if the file didn't change while we were reading it.
+    """
+    after = os.stat(path_or_fd)
+    if ChecksumCache.fingerprint(before) == ChecksumCache.fingerprint(after):
+        checksum_cache.put(before, digest, algorithm)
+
+
+def checksum_file(path: str, chunk_size: int = None,
+                  algorithm: str = DEFAULT_ALGORITHM, use_cache: bool = True) -> str:
+    """
+    Return the hex digest of the file at :param path, streaming it in chunks.
+
+    This is the checksum every adapter and the ingester use, so it must stay
+    byte-for-byte compatible with `hashlib.sha1(data).hexdigest()`
+
+    :param path - path to the file to hash
+    :param chunk_size - number of bytes to read per chunk
+    :param algorithm - name of a hashlib algorithm
+    :param use_cache - look the file up in, and add it to, the shared `checksum_cache`.
+        Pass False when the point is to detect corruption of data at rest.
+    """
+    # buffering=0 gives a raw FileIO, so readinto lands directly in our buffer
+    with open(path, "rb", buffering=0) as fh:
+        if not use_cache:
+            return checksum_fileobj(fh, chunk_size=chunk_size, algorithm=algorithm)
+
+        before = os.fstat(fh.fileno())
+        digest = checksum_cache.get(before, algorithm)
+        if digest is not None:
+            return digest
+
+        digest = checksum_fileobj(fh, chunk_size=chunk_size, algorithm=algorithm)
+        _remember(fh.fileno(), before, digest, algorithm)
+        return digest
+
+
+def copy_and_checksum(src: str, dst: str, chunk_size: int = None,
+                      algorithm: str = DEFAULT_ALGORITHM, verify_destination: bool = False,
+                      fast_copy: bool = True, use_cache: bool = False) -> str:
+    """
+    Copy :param src to :param dst, and return the hex digest of the bytes that were written.
+
+    Where the filesystems allow it, the copy is made by the kernel, or as a reflink (see
+    `libreary.copying.FileCopier`), so the data doesn't pass through userspace to be written,
+    and only the copy is read back to hash it. Otherwise, the bytes are hashed as they're copied,
+    so the source is read exactly once.
+
+    If :param verify_destination is True, the copy is checked against the source. For a
+    buffered copy, the destination is re-hashed. The data was just written, so this is
+    normally served from the page cache rather than the disk. On a mismatch the
+    destination is removed and ChecksumMismatchException is raised.
+
+    :param src - path to copy from
+    :param dst - path to copy to. Replaced if it exists.
+    :param chunk_size - number of bytes to read per chunk
+    :param algorithm - name of a hashlib algorithm
+    :param verify_destination - check the destination against the source after copying
+    :param fast_copy - let the kernel copy the data where it can
+    :param use_cache - if the source's digest is in the shared `checksum_cache`, trust it
+        for a reflink, rather than reading the copy back, so a reflink costs no reads at all.
+        A reflink shares the source's extents, so it can't differ from them. Copies made by
+        `copy_file_range` or `sendfile` write new data, so they're always read back.
+    """
+    chunk_size = _clamp_chunk_size(chunk_size)
+    # Replace, rather than write through, a link left by an in-place retrieve
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    with open(src, "rb", buffering=0) as fsrc, open(dst, "wb") as fdst:
+        before = os.fstat(fsrc.fileno())
+        strategy = BUFFERED
+        if fast_copy:
+            strategy = file_copier.copy(fsrc.fileno(), fdst.fileno(), os.path.dirname(os.path.abspath(dst)))
+
+        if strategy == BUFFERED:
+            hash_obj = new_hash(algorithm)
+            buf = bytearray(chunk_size)
+            view = memoryview(buf)
+            while True:
+                n = fsrc.readinto(buf)
+                if not n:
+                    break
+                hash_obj.update(view[:n])
+                fdst.write(view[:n])
+            digest = hash_obj.hexdigest()
+            written = None
+            # We've paid for a full read of the source, so later hashes of it are free
+            _remember(fsrc.fileno(), before, digest, algorithm)
+        else:
+            digest = checksum_cache.get(before, algorithm) if use_cache and strategy == REFLINK else None
+            written = None
+            if digest is None:
+                written = checksum_file(dst, chunk_size=chunk_size, algorithm=algorithm, use_cache=False)
+                digest = written
+                if not verify_destination and strategy == REFLINK:
+                    # The copy shares the source's data, so this is the source's digest too,
+                    # if it didn't change meanwhile
+                    _remember(fsrc.fileno(), before, digest, algorithm)
+
+    if verify_destination:
+        if written is None:
+            written = checksum_file(dst, chunk_size=chunk_size, algorithm=algorithm, use_cache=False)
+        else:
+            # The digest came from the copy, so check it against the source instead
+            digest = checksum_file(src, chunk_size=chunk_size, algorithm=algorithm, use_cache=False)
+        if written != digest:
+            logger.error(f"Copy of {src} to {dst} does not match its source")
+            os.remove(dst)
+            raise ChecksumMismatchException
+
+    return written if written is not None else digest
+
+
+def write_and_checksum(fh: BinaryIO, dst: str, chunk_size: int = None,
+                       algorithm: str = DEFAULT_ALGORITHM) -> str:
+    """
+    Write the remaining contents of a binary file object to :param dst, hashing the
+    bytes as they pass through. Returns the hex digest of the bytes that were written.
+
+    If reading or writing fails, the partial file is removed.
+
+    :param fh - a file object opened in binary mode, such as an upload stream
+    :param dst - path to write to. Overwritten if it exists.
+    :param chunk_size - number of bytes to read per chunk
+    :param algorithm - name of a hashlib algorithm
+    """
+    chunk_size = _clamp_chunk_size(chunk_size)
+    hash_obj = new_hash(algorithm)
+    try:
+        with open(dst, "wb") as fdst:
+            while True:
+                chunk = fh.read(chunk_size)
+                if not chunk:
+                    break
+                hash_obj.update(chunk)
+                fdst.write(chunk)
+    except BaseException:
+        if os.path.isfile(dst):
+            os.remove(dst)
+        raise
+    return hash_obj.hexdigest()
+
+
+class HashingReader:
+    """
+    Wraps a binary file object, hashing everything read through it.
+    Useful when another library (an upload client, for example) does the reading.
+    """
+
+    def __init__(self, fh: BinaryIO, algorithm: str = DEFAULT_ALGORITHM):
+        """
+        Constructor for HashingReader.
+
+        :param fh - a file object opened in binary mode
+        :param algorithm - name of a hashlib algorithm
+        """
+        self.fh = fh
+        self.hash_obj = new_hash(algorithm)
+        self.size = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        # Some file-like objects (botocore's StreamingBody, for one) don't take -1
+        data = self.fh.read() if size is None or size < 0 else self.fh.read(size)
+        self.hash_obj.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigest(self) -> str:
+        """
+        Return the hex digest of everything read so far
+        """
+        return self.hash_obj.hexdigest()
+
+    def close(self) -> None:
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class VerifyingReader(HashingReader):
+    """
+    Wraps a binary file object holding a whole resource, hashing everything read through
+    it. When the end of the stream is reached, the digest is compared with the resource's
+    checksum, and ChecksumMismatchException is raised if they differ, so a reader that
+    reads to the end never silently gets corrupt data.
+    """
+
+    def __init__(self, fh: BinaryIO, expected: str, algorithm: str = DEFAULT_ALGORITHM,
+                 on_mismatch: Callable[[], None] = None):
+        """
+        Constructor for VerifyingReader.
+
+        :param fh - a file object opened in binary mode, at the start of the resource
+        :param expected - hex digest the whole stream must have
+        :param algorithm - name of a hashlib algorithm
+        :param on_mismatch - called once, before raising, if the stream doesn't match
+        """
+        super().__init__(fh, algorithm)
+        self.expected = expected
+        self.on_mismatch = on_mismatch
+        self.verified = False
+        self._checked = False
+
+    def read(self, size: int = -1) -> bytes:
+        data = super().read(size)
+        if size is None or size < 0 or (size > 0 and not data):
+            self._verify()
+        return data
+
+    def _verify(self) -> None:
+        if self.verified:
+            return
+        if self.hexdigest() == self.expected:
+            self.verified = True
+            return
+        if not self._checked:
+            self._checked = True
+            logger.error(f"Stream of {self.size} bytes doesn't match checksum {self.expected}")
+            if self.on_mismatch is not None:
+                self.on_mismatch()
+        raise ChecksumMismatchException
@@ -0,0 +1,270 @@
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+DEFAULT_MAX_RESET_TIMEOUT = 10 * 60
+DEFAULT_DECAY = 0.2
+
+
+class CircuitBreaker:
+    """
+    A circuit breaker for a single adapter.
+
+    The breaker starts closed, and calls go through. After `failure_threshold`
+    consecutive failures it opens, and calls are refused straight away rather than
+    waiting on a backend that is down. Once `reset_timeout` seconds have passed, it's
+    half-open: a single probe call is let through. If the probe succeeds, the breaker
+    closes again. If it fails, the breaker reopens, and the timeout doubles (up to
+    `max_reset_timeout`) so that a long outage isn't probed too often.
+
+    The breaker also keeps counts and an average latency of calls, for reporting.
+    """
+
+    def __init__(self, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout: float = DEFAULT_RESET_TIMEOUT,
+                 max_reset_timeout: float = DEFAULT_MAX_RESET_TIMEOUT):
+        """
+        Constructor for CircuitBreaker.
+
+        :param failure_threshold - consecutive failures that open the breaker
+        :param reset_timeout - seconds an open breaker waits before letting a probe through
+        :param max_reset_timeout - longest wait between probes, in seconds
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._state = CLOSED
+        self._timeout = reset_timeout
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = None
+        self.last_error = None
+        self.last_failure_at = None
+
+    @property
+    def state(self) -> str:
+        """
+        The breaker's state: "closed", "open" or "half_open"
+        """
+        with self._lock:
+            return self._get_state(time.monotonic())
+
+    def _get_state(self, now: float) -> str:
+        if self._state == OPEN and now - self._opened_at >= self._timeout:
+            self._state = HALF_OPEN
+            self._probing = False
+        return self._state
+
+    def retry_in(self) -> float:
+        """
+        Return the number of seconds until an open breaker lets a probe through, or 0
+        """
+        with self._lock:
+            if self._get_state(time.monotonic()) != OPEN:
+                return 0
+            return max(0, self._opened_at + self._timeout - time.monotonic())
+
+    def available(self) -> bool:
+        """
+        Returns True if a call would be let through right now. Unlike `allow`, this
+        doesn't claim the half-open probe.
+        """
+        with self._lock:
+            state = self._get_state(time.monotonic())
+            return state == CLOSED or (state == HALF_OPEN and not self._probing)
+
+    def allow(self) -> bool:
+        """
+        Returns True if a call may go through. In the half-open state, only the first
+        caller is let through, as the probe.
+        """
+        with self._lock:
+            state = self._get_state(time.monotonic())
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def _record_latency(self, duration: float) -> None:
+        if duration is None:
+            return
+        if self.latency is None:
+            self.latency = duration
+        else:
+            self.latency = DEFAULT_DECAY * duration + (1 - DEFAULT_DECAY) * self.latency
+
+    def record_success(self, duration: float = None) -> None:
+        """
+        Record a call that succeeded, closing the breaker
+
+        :param duration - seconds the call took
+        """
+        with self._lock:
+            self.successes += 1
+            self.consecutive_failures = 0
+            self._record_latency(duration)
+            self._state = CLOSED
+            self._timeout = self.reset_timeout
+            self._probing = False
+
+    def record_failure(self, duration: float = None, error: Exception = None) -> bool:
+        """
+        Record a call that failed. Returns True if this opened the breaker.
+
+        :param duration - seconds the call took
+        :param error - the exception the call raised
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.failures += 1
+            self.consecutive_failures += 1
+            self._record_latency(duration)
+            self.last_error = f"{type(error).__name__}: {error}" if error is not None else None
+            self.last_failure_at = time.time()
+            state = self._get_state(now)
+            if state == HALF_OPEN:
+                # The probe failed, so back off further before the next one
+                self._timeout = min(self.max_reset_timeout, self._timeout * 2)
+            elif state == OPEN or self.consecutive_failures < self.failure_threshold:
+                return False
+            self._state = OPEN
+            self._opened_at = now
+            self._probing = False
+            return True
+
+    def reset(self) -> None:
+        """
+        Close the breaker, as if the adapter had just succeeded
+        """
+        with self._lock:
+            self._state = CLOSED
+            self._timeout = self.reset_timeout
+            self._probing = False
+            self.consecutive_failures = 0
+
+    def snapshot(self) -> dict:
+        """
+        Return the breaker's state and statistics as a dict
+        """
+        retry_in = self.retry_in()
+        with self._lock:
+            return {"state": self._get_state(time.monotonic()),
+                    "successes": self.successes,
+                    "failures": self.failures,
+                    "consecutive_failures": self.consecutive_failures,
+                    "latency": self.latency,
+                    "last_error": self.last_error,
+                    "last_failure_at": self.last_failure_at,
+                    "retry_in": retry_in}
+
+
+class AdapterHealth:
+    """
+    Tracks the health of every adapter, with a CircuitBreaker for each.
+
+    This class currently contains the following methods:
+
+    - available (whether an adapter would accept a call right now)
+    - allow (whether a call may go through, claiming the half-open probe)
+    - record_success (record a successful call)
+    - record_failure (record a failed call)
+    - get_state (an adapter's breaker state)
+    - retry_at (when an open adapter will next be tried)
+    - reset (close an adapter's breaker by hand)
+    - summary (the state and statistics of every adapter)
+    """
+
+    def __init__(self, options: dict = None):
+        """
+        Constructor for AdapterHealth. In most cases, this is constructed by the AdapterManager.
+
+        :param options - the `options` section of the LIBRE-ary config. The following keys are used:
+        ```{json}
+        {
+            "circuit_failure_threshold": (optional, int) consecutive failures before an adapter is
+                taken out of service. Defaults to 5,
+            "circuit_reset_timeout": (optional, int) seconds before an adapter taken out of service is
+                tried again. Defaults to 30,
+            "circuit_max_reset_timeout": (optional, int) longest wait between tries of an adapter
+                that is still failing. Defaults to 600
+        }
+        ```
+        """
+        options = options or {}
+        self.failure_threshold = options.get("circuit_failure_threshold", DEFAULT_FAILURE_THRESHOLD)
+        self.reset_timeout = options.get("circuit_reset_timeout", DEFAULT_RESET_TIMEOUT)
+        self.max_reset_timeout = options.get("circuit_max_reset_timeout", DEFAULT_MAX_RESET_TIMEOUT)
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get_breaker(self, adapter_id: str) -> CircuitBreaker:
+        """
+        Return :param adapter_id's breaker, creating it on first use
+        """
+        with self._lock:
+            if adapter_id not in self._breakers:
+                self._breakers[adapter_id] = CircuitBreaker(
+                    self.failure_threshold, self.reset_timeout, self.max_reset_timeout)
+            return self._breakers[adapter_id]
+
+    def available(self, adapter_id: str) -> bool:
+        return self.get_breaker(adapter_id).available()
+
+    def allow(self, adapter_id: str) -> bool:
+        return self.get_breaker(adapter_id).allow()
+
+    def record_success(self, adapter_id: str, duration: float = None) -> None:
+        self.get_breaker(adapter_id).record_success(duration)
+
+    def record_failure(self, adapter_id: str, duration: float = None, error: Exception = None) -> None:
+        breaker = self.get_breaker(adapter_id)
+        if breaker.record_failure(duration, error):
+            logger.error(
+                f"Adapter {adapter_id} failed {breaker.consecutive_failures} times in a row. "
+                f"Taking it out of service for {breaker.retry_in():.0f}s")
+
+    def get_state(self, adapter_id: str) -> str:
+        return self.get_breaker(adapter_id).state
+
+    def retry_at(self, adapter_id: str) -> float:
+        """
+        Return the unix time at which :param adapter_id will next be tried
+        """
+        return time.time() + self.get_breaker(adapter_id).retry_in()
+
+    def reset(self, adapter_id: str) -> None:
+        logger.info(f"Returning adapter {adapter_id} to service")
+        self.get_breaker(adapter_id).reset()
+
+    def summary(self) -> dict:
+        """
+        Return the state of every adapter that has been called:
+        ```
+        {
+            "adapter_id": {
+                "state": "closed", "open" or "half_open",
+                "successes": (int), "failures": (int), "consecutive_failures": (int),
+                "latency": (float) average seconds per call,
+                "last_error": (str), "last_failure_at": (float) unix time,
+                "retry_in": (float) seconds until an open adapter is tried again
+            }
+        }
+        ```
+        """
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {adapter_id: breaker.snapshot() for adapter_id, breaker in breakers.items()}
@@ -0,0 +1,272 @@
+import queue
+import threading
+import zlib
+from typing import Iterable, List
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HASH_WORKERS = 4
+DEFAULT_STORE_WORKERS = 2
+DEFAULT_DISTRIBUTION_WORKERS = 4
+DEFAULT_INGEST_BATCH_SIZE = 100
+DEFAULT_INGEST_QUEUE_SIZE = 64
+# Seconds a partial batch waits for more files before it's written anyway
+DEFAULT_BATCH_FLUSH_INTERVAL = 0.5
+FILENAME_LOCK_STRIPES = 64
+
+HASH = "hash"
+CANONICAL = "canonical"
+METADATA = "metadata"
+DISTRIBUTE = "distribute"
+
+# Marks the end of a stage's input
+_DONE = object()
+
+
+class IngestPipeline:
+    """
+    Ingests many files at once, as a pipeline of overlapping stages:
+
+    1. hash: checksum each file and assign it a UUID
+    2. canonical: store each file's canonical copy
+    3. metadata: add the files' `resources` entries, and their canonical copies'
+        `copies` entries, one transaction per batch
+    4. distribute: send each file's copies to its levels' adapters. Each adapter adds
+        its copy's `copies` entry as soon as the copy is stored
+
+    Each stage runs on its own threads, and the stages are joined by bounded
+    queues. While one file is being distributed, the next is having its canonical
+    copy stored, and the one after that is being hashed. A slow stage holds the
+    others back rather than letting work pile up in memory, however many files
+    are ingested.
+
+    Results are yielded as files finish, not in the order they were given.
+
+    This class currently contains the following methods:
+
+    - run (ingest files, yielding a result for each)
+    """
+
+    def __init__(self, ingester: object, adapter_man: object, metadata_man: object, options: dict = None):
+        """
+        Constructor for the IngestPipeline object. In most cases, it will be constructed
+        by the LIBRE-ary main object.
+
+        :param ingester - the Ingester, which provides each stage's steps
+        :param adapter_man - the AdapterManager used to distribute copies
+        :param metadata_man - the metadata manager
+        :param options - the `options` section of the LIBRE-ary config. The following keys are used:
+        ```{json}
+        {
+            "ingest_hash_workers": (optional, int) files hashed concurrently. Defaults to 4,
+            "ingest_store_workers": (optional, int) canonical copies stored concurrently. Defaults to 2,
+            "ingest_distribution_workers": (optional, int) files distributed concurrently. Defaults to 4,
+            "ingest_batch_size": (optional, int) files per metadata transaction. Defaults to 100,
+            "ingest_queue_size": (optional, int) files waiting between two stages. Defaults to 64
+        }
+        ```
+        """
+        options = options or {}
+        self.ingester = ingester
+        self.adapter_man = adapter_man
+        self.metadata_man = metadata_man
+        self.hash_workers = options.get("ingest_hash_workers", DEFAULT_HASH_WORKERS)
+        self.store_workers = options.get("ingest_store_workers", DEFAULT_STORE_WORKERS)
+        self.distribution_workers = options.get("ingest_distribution_workers", DEFAULT_DISTRIBUTION_WORKERS)
+        self.batch_size = options.get("ingest_batch_size", DEFAULT_INGEST_BATCH_SIZE)
+        self.queue_size = options.get("ingest_queue_size", DEFAULT_INGEST_QUEUE_SIZE)
+        self.flush_interval = DEFAULT_BATCH_FLUSH_INTERVAL
+        # Files with the same name share canonical and dropbox paths, so they take turns
+        self._filename_locks = [threading.Lock() for _ in range(FILENAME_LOCK_STRIPES)]
+
+    def run(self, paths: Iterable[str], levels: List[str], description: str = "",
+            delete_after_store: bool = False):
+        """
+        Ingest every file in :param paths, yielding a result for each as it finishes:
+        ```
+        {
+            "path": (str) the file ingested,
+            "resource": (str) the new object's UUID, or None if it wasn't ingested,
+            "error": (Exception) what went wrong, or None,
+            "stage": (str) the stage that failed ("hash", "canonical", "metadata" or "distribute"), or None,
+            "report": (dict) the distribution report, see `AdapterManager.send_resource_to_adapters`
+        }
+        ```
+
+        A file that fails before its metadata is written isn't ingested at all. A file that
+        fails to distribute is ingested, with its canonical copy, and its missing copies are
+        restored by the next check.
+
+        If the caller stops iterating early, no more files are started, and the files
+        already in the pipeline are finished before this returns.
+
+        :param paths - paths of the files to ingest. Can be any iterable, including a generator
+        :param levels - names of the levels the files belong to. They must exist
+        :param description - a description for every file
+        :param delete_after_store - delete each file from the dropbox once it's distributed
+        """
+        # Fail before anything is stored if a level doesn't exist
+        self.adapter_man.placement.plan(levels)
+        return self._run(paths, levels, description, delete_after_store)
+
+    def _run(self, paths: Iterable[str], levels: List[str], description: str, delete_after_store: bool):
+        closing = threading.Event()
+        hash_queue = queue.Queue(self.queue_size)
+        store_queue = queue.Queue(self.queue_size)
+        metadata_queue = queue.Queue(self.queue_size)
+        distribute_queue = queue.Queue(self.queue_size)
+        results = queue.Queue(self.queue_size)
+
+        def distribute(item):
+            with self._get_filename_lock(item):
+                item["report"] = self.adapter_man.send_resource_to_adapters(
+                    item["resource"], delete_after_send=delete_after_store, parallel=False)
+
+        threads = [threading.Thread(target=self._feed, args=(paths, hash_queue, closing),
+                                    name="libreary-ingest-feed", daemon=True)]
+        threads += self._stage(HASH, self._hash, self.hash_workers, hash_queue, store_queue, results)
+        threads += self._stage(CANONICAL, self._store_canonical, self.store_workers,
+                               store_queue, metadata_queue, results)
+        threads.append(threading.Thread(
+            target=self._record, args=(levels, description, metadata_queue, distribute_queue, results),
+            name="libreary-ingest-metadata", daemon=True))
+        threads += self._stage(DISTRIBUTE, distribute, self.distribution_workers,
+                               distribute_queue, results, results)
+        for thread in threads:
+            thread.start()
+
+        finished = False
+        try:
+            while True:
+                result = results.get()
+                if result is _DONE:
+                    finished = True
+                    return
+                yield self._result(result)
+        finally:
+            # Stop feeding new files, and let the ones in flight finish
+            closing.set()
+            while not finished:
+                finished = results.get() is _DONE
+            for thread in threads:
+                thread.join()
+
+    @staticmethod
+    def _result(item: dict) -> dict:
+        return {"path": item["path"],
+                "resource": item.get("resource") if item.get("stage") in (None, DISTRIBUTE) else None,
+                "error": item.get("error"),
+                "stage": item.get("stage"),
+                "report": item.get("report")}
+
+    def _get_filename_lock(self, item: dict) -> threading.Lock:
+        return self._filename_locks[zlib.crc32(item["filename"].encode()) % FILENAME_LOCK_STRIPES]
+
+    @staticmethod
+    def _feed(paths: Iterable[str], outbox: queue.Queue, closing: threading.Event) -> None:
+        try:
+            for path in paths:
+                if closing.is_set():
+                    break
+                outbox.put({"path": path})
+        except Exception as e:
+            logger.error(f"Listing files to ingest failed: {e}")
+        finally:
+            outbox.put(_DONE)
+
+    def _hash(self, item: dict) -> None:
+        item.update(self.ingester.prepare(item["path"]))
+
+    def _store_canonical(self, item: dict) -> None:
+        with self._get_filename_lock(item):
+            # Recorded with the rest of the batch, so a canonical copy's entry is never
+            # committed without its resource's
+            self.ingester.store_canonical(item, defer_copy=True)
+
+    def _stage(self, stage: str, step, workers: int, inbox: queue.Queue,
+               outbox: queue.Queue, results: queue.Queue) -> List[threading.Thread]:
+        """
+        Create :param workers threads which take files from :param inbox, run :param step on
+        each, and pass them on to :param outbox. Files that fail go straight to :param results.
+        Once the input is finished, the last thread to stop marks the end of :param outbox.
+        """
+        remaining = [workers]
+        lock = threading.Lock()
+
+        def work():
+            while True:
+                item = inbox.get()
+                if item is _DONE:
+                    # Leave the marker for the other workers
+                    inbox.put(_DONE)
+                    with lock:
+                        remaining[0] -= 1
+                        last = remaining[0] == 0
+                    if last:
+                        outbox.put(_DONE)
+                    return
+                try:
+                    step(item)
+                except Exception as e:
+                    logger.error(f"Ingesting {item['path']} failed at the {stage} stage: {e}")
+                    item["error"] = e
+                    item["stage"] = stage
+                    results.put(item)
+                    continue
+                outbox.put(item)
+
+        return [threading.Thread(target=work, name=f"libreary-ingest-{stage}", daemon=True)
+                for _ in range(workers)]
+
+    def _record(self, levels: List[str], description: str, inbox: queue.Queue,
+                outbox: queue.Queue, results: queue.Queue) -> None:
+        """
+        Add the `resources` and canonical `copies` entries for files from :param inbox in batches, and pass
+        them on to :param outbox. A partial batch is written once no more files have
+        arrived for a short while, so files don't wait on a slow hashing stage.
+        """
+        batch = []
+        while True:
+            try:
+                item = inbox.get(timeout=self.flush_interval if batch else None)
+            except queue.Empty:
+                self._flush(batch, levels, description, outbox, results)
+                batch = []
+                continue
+            if item is _DONE:
+                self._flush(batch, levels, description, outbox, results)
+                outbox.put(_DONE)
+                return
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._flush(batch, levels, description, outbox, results)
+                batch = []
+
+    def _flush(self, batch: List[dict], levels: List[str], description: str,
+               outbox: queue.Queue, results: queue.Queue) -> None:
+        if not batch:
+            return
+        try:
+            self.ingester.record(batch, levels, description)
+            recorded = batch
+        except Exception as e:
+            # Find the files that were to blame, so the rest of the batch still goes in
+            logger.warning(f"Recording a batch of {len(batch)} ingests failed, retrying one at a time: {e}")
+            recorded = []
+            for item in batch:
+                try:
+                    self.ingester.record([item], levels, description)
+                    recorded.append(item)
+                except Exception as e:
+                    logger.error(f"Ingesting {item['path']} failed at the {METADATA} stage: {e}")
+                    item["error"] = e
+                    item["stage"] = METADATA
+                    try:
+                        self.ingester.discard_canonical(item)
+                    except Exception as cleanup_error:
+                        logger.error(
+                            f"Could not delete canonical copy of failed ingest {item['resource']}: {cleanup_error}")
+                    results.put(item)
+        for item in recorded:
+            outbox.put(item)
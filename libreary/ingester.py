@@ -1,5 +1,4 @@
 import os
-import hashlib
 import uuid
 from typing import List
 import logging
@@ -9,6 +8,7 @@ from libreary.exceptions import ChecksumMismatchException
 from libreary.adapters import LocalAdapter
 from libreary.metadata import SQLite3MetadataManager
 from libreary.exceptions import NoCopyExistsException
+from libreary.hashing import checksum_file
 
 logger = logging.getLogger(__name__)
 
@@ -63,38 +63,40 @@ class Ingester:
         - Creates the entry in the `resources` table describing the resource
         - Optionally, delete the file out of the dropbox dir.
 
+        The canonical copy is stored, and its `copies` entry committed, before the metadata
+        transaction starts, so the transaction never waits on adapter I/O. If the metadata
+        can't be written, the canonical copy is deleted again.
+
         :param current_file_path -
         """
-        filename = current_file_path.split("/")[-1]
-        sha1Hash = hashlib.sha1(open(current_file_path, "rb").read())
-        checksum = sha1Hash.hexdigest()
-
-        canonical_adapter = AdapterManager.create_adapter(
-            self.canonical_adapter_type, self.canonical_adapter_id, self.config_dir, self.config["metadata"])
-
-        obj_uuid = str(uuid.uuid4())
-
-        logger.debug(f"Ingesting resource {obj_uuid} with filename {filename}")
-
-        canonical_adapter_locator = canonical_adapter._store_canonical(
-            current_file_path, obj_uuid, checksum, filename)
+        item = self.prepare(current_file_path)
+        self.store_canonical(item)
 
         levels = ",".join([str(level) for level in levels])
+        obj_uuid = item["resource"]
+
+        def record():
+            # Ingest to db
+            self.metadata_man.ingest_to_db(
+                item["locator"],
+                levels,
+                item["filename"],
+                item["checksum"],
+                item["resource"],
+                description)
+
+            # Ingest file metadata:
+            if len(metadata_schema) == len(metadata) and len(metadata_schema) != 0:
+                self.metadata_man.set_object_metadata_schema(
+                    obj_uuid, metadata_schema)
+                self.metadata_man.set_all_object_metadata(obj_uuid, metadata)
 
-        # Ingest to db
-        self.metadata_man.ingest_to_db(
-            canonical_adapter_locator,
-            levels,
-            filename,
-            checksum,
-            obj_uuid,
-            description)
-
-        # Ingest file metadata:
-        if len(metadata_schema) == len(metadata) and len(metadata_schema) != 0:
-            self.metadata_man.set_object_metadata_schema(
-                obj_uuid, metadata_schema)
-            self.metadata_man.set_all_object_metadata(obj_uuid, metadata)
+        try:
+            self.metadata_man.run_in_transaction(record)
+        except Exception:
+            logger.error(f"Recording resource {obj_uuid} failed. Deleting its canonical copy")
+            self.discard_canonical(item)
+            raise
 
         # If file is not in dropbox, copy it there
 
@@ -103,6 +105,79 @@ class Ingester:
 
         return obj_uuid
 
+    def prepare(self, current_file_path: str) -> dict:
+        """
+        First step of an ingest: checksum a file and assign it a UUID.
+
+        Returns a dict describing the file, which `store_canonical` and `record` fill in:
+        `{"path": (str), "filename": (str), "checksum": (str), "resource": (str) UUID}`
+
+        :param current_file_path - path to the file being ingested
+        """
+        return {"path": current_file_path,
+                "filename": current_file_path.split("/")[-1],
+                "checksum": checksum_file(current_file_path),
+                "resource": str(uuid.uuid4())}
+
+    def store_canonical(self, item: dict, defer_copy: bool = False) -> str:
+        """
+        Second step of an ingest: create the canonical copy of a file prepared by `prepare`.
+        Sets, and returns, `item["locator"]`.
+
+        :param item - the file's description, from `prepare`
+        :param defer_copy - don't add the canonical copy's `copies` entry yet. It's kept in
+            `item["copies"]`, and `record` adds it along with the resource's entry
+        """
+        canonical_adapter = AdapterManager.get_registered_adapter(
+            self.canonical_adapter_type, self.canonical_adapter_id, self.config_dir, self.metadata_man)
+
+        logger.debug(f"Ingesting resource {item['resource']} with filename {item['filename']}")
+
+        if not defer_copy:
+            item["locator"] = canonical_adapter._store_canonical(
+                item["path"], item["resource"], item["checksum"], item["filename"])
+            return item["locator"]
+        with self.metadata_man.deferred_copies() as copies:
+            item["locator"] = canonical_adapter._store_canonical(
+                item["path"], item["resource"], item["checksum"], item["filename"])
+        item["copies"] = copies
+        return item["locator"]
+
+    def record(self, items: List[dict], levels: List[str], description: str) -> None:
+        """
+        Last step of an ingest: add the `resources` entries for several files, whose canonical
+        copies have been stored by `store_canonical`, together with any `copies` entries it
+        deferred, in a single transaction.
+
+        :param items - the files' descriptions
+        :param levels - list of names of the levels the files belong to
+        :param description - a description of the files
+        """
+        levels = ",".join([str(level) for level in levels])
+
+        def record_all():
+            self.metadata_man.ingest_many_to_db(
+                [(item["locator"], levels, item["filename"], item["checksum"], item["resource"], description)
+                 for item in items])
+            self.metadata_man.add_copies([copy for item in items for copy in item.get("copies", [])])
+
+        self.metadata_man.run_in_transaction(record_all)
+        for item in items:
+            item.pop("copies", None)
+
+    def discard_canonical(self, item: dict) -> None:
+        """
+        Delete the canonical copy of a file whose ingest failed after `store_canonical`
+
+        :param item - the file's description
+        """
+        canonical_adapter = AdapterManager.get_registered_adapter(
+            self.canonical_adapter_type, self.canonical_adapter_id, self.config_dir, self.metadata_man)
+        if item.get("copies"):
+            # Adapters find the copy to delete through its `copies` entry
+            self.metadata_man.add_copies(item.pop("copies"))
+        canonical_adapter._delete_canonical(item["resource"])
+
     def verify_ingestion(self, r_id: str) -> bool:
         """
         Make sure an object has been properly ingested.
@@ -127,7 +202,7 @@ class Ingester:
         Delete a resource from the LIBREary.
 
         This method deletes the canonical copy and removes the corresponding entry in the `resources`
-            table.
+            table, along with the object's metadata, in one transaction once the canonical copy is gone.
 
         :param r_id - the UUID of the resouce you're deleting
         """
@@ -138,13 +213,13 @@ class Ingester:
         except IndexError:
             logger.debug(f"Already deleted {r_id}")
 
-        canonical_adapter = AdapterManager.create_adapter(
-            self.canonical_adapter_type, self.canonical_adapter_id, self.config_dir, self.config["metadata"])
+        canonical_adapter = AdapterManager.get_registered_adapter(
+            self.canonical_adapter_type, self.canonical_adapter_id, self.config_dir, self.metadata_man)
 
         try:
             checksum = canonical_adapter.get_actual_checksum(r_id)
         except NoCopyExistsException:
-            self.metadata_man.delete_resource(r_id)
+            self._forget_resource(r_id)
             return
 
         if checksum == canonical_checksum:
@@ -153,5 +228,17 @@ class Ingester:
         else:
             raise ChecksumMismatchException
 
+        self._forget_resource(r_id)
+
+    def _forget_resource(self, r_id: str) -> None:
+        """
+        Remove a resource's entry in the `resources` table, and its object metadata
+        """
         logger.debug(f"Deleting object {r_id} from resources database")
-        self.metadata_man.delete_resource(r_id)
+
+        def forget():
+            if len(self.metadata_man.list_object_metadata_schema(r_id)) > 0:
+                self.metadata_man.delete_object_metadata_entirely(r_id)
+            self.metadata_man.delete_resource(r_id)
+
+        self.metadata_man.run_in_transaction(forget)
@@ -0,0 +1,124 @@
+import math
+import threading
+from collections import deque
+from typing import List
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DECAY = 0.2
+DEFAULT_WINDOW = 64
+DEFAULT_PERCENTILE = 95
+DEFAULT_HEDGE_DELAY = 1.0
+MIN_HEDGE_DELAY = 0.01
+# Too few samples to trust a percentile of
+MIN_SAMPLES = 5
+
+
+class LatencyTracker:
+    """
+    Keeps track of how quickly each adapter serves retrieves, so they can be ranked.
+
+    For each adapter, this keeps exponentially decayed moving averages (EWMAs) of
+    retrieve duration and throughput, plus a window of recent durations for
+    percentile deadlines. A failed retrieve counts as a very slow one, so a failing
+    adapter drops down the ranking and recovers as it starts succeeding again.
+    """
+
+    def __init__(self, decay: float = DEFAULT_DECAY, window: int = DEFAULT_WINDOW):
+        """
+        Constructor for LatencyTracker.
+
+        :param decay - weight of each new sample in the moving averages, between 0 and 1
+        :param window - number of recent durations kept per adapter for percentiles
+        """
+        self.decay = decay
+        self.window = window
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _get_stats(self, adapter_id: str) -> dict:
+        if adapter_id not in self._stats:
+            self._stats[adapter_id] = {"duration": None, "throughput": None,
+                                       "recent": deque(maxlen=self.window)}
+        return self._stats[adapter_id]
+
+    def _update(self, average: float, sample: float) -> float:
+        if average is None:
+            return sample
+        return self.decay * sample + (1 - self.decay) * average
+
+    def record(self, adapter_id: str, duration: float, size: int = 0) -> None:
+        """
+        Record a successful retrieve
+
+        :param adapter_id - adapter that served the retrieve
+        :param duration - seconds the retrieve took
+        :param size - bytes retrieved
+        """
+        with self._lock:
+            stats = self._get_stats(adapter_id)
+            stats["duration"] = self._update(stats["duration"], duration)
+            if size and duration > 0:
+                stats["throughput"] = self._update(stats["throughput"], size / duration)
+            stats["recent"].append(duration)
+
+    def record_failure(self, adapter_id: str) -> None:
+        """
+        Record a failed retrieve, as if it took twice as long as the slowest recent one
+        """
+        with self._lock:
+            stats = self._get_stats(adapter_id)
+            penalty = 2 * max(stats["recent"], default=DEFAULT_HEDGE_DELAY)
+            stats["duration"] = self._update(stats["duration"], penalty)
+            stats["recent"].append(penalty)
+
+    def predict(self, adapter_id: str, size: int = 0) -> float:
+        """
+        Return the expected number of seconds for :param adapter_id to retrieve :param size bytes,
+        or None if it hasn't served any retrieves yet
+        """
+        with self._lock:
+            stats = self._stats.get(adapter_id)
+            if stats is None or stats["duration"] is None:
+                return None
+            if size and stats["throughput"]:
+                return size / stats["throughput"]
+            return stats["duration"]
+
+    def rank(self, adapter_ids: List[str], size: int = 0) -> List[str]:
+        """
+        Return :param adapter_ids sorted fastest first. Adapters with no history keep their
+        relative order, after every adapter that has one.
+        """
+        def key(item):
+            index, adapter_id = item
+            predicted = self.predict(adapter_id, size)
+            return (predicted is None, predicted or 0, index)
+        return [adapter_id for index, adapter_id in sorted(enumerate(adapter_ids), key=key)]
+
+    def deadline(self, adapter_id: str, percentile: float = DEFAULT_PERCENTILE,
+                 default: float = DEFAULT_HEDGE_DELAY) -> float:
+        """
+        Return the :param percentile of :param adapter_id's recent retrieve durations, in seconds.
+        A retrieve still running after this long is in the adapter's tail.
+
+        :param default - returned when there aren't enough samples yet
+        """
+        with self._lock:
+            stats = self._stats.get(adapter_id)
+            recent = sorted(stats["recent"]) if stats is not None else []
+        if len(recent) < MIN_SAMPLES:
+            return default
+        index = min(len(recent) - 1, max(0, math.ceil(percentile / 100 * len(recent)) - 1))
+        return max(MIN_HEDGE_DELAY, recent[index])
+
+    def summary(self) -> dict:
+        """
+        Return the current averages for each adapter:
+        `{"adapter_id": {"duration": (float) seconds, "throughput": (float) bytes/sec, "samples": (int)}}`
+        """
+        with self._lock:
+            return {adapter_id: {"duration": stats["duration"], "throughput": stats["throughput"],
+                                 "samples": len(stats["recent"])}
+                    for adapter_id, stats in self._stats.items()}
@@ -1,10 +1,16 @@
 import json
-from typing import List
+import uuid
+from typing import BinaryIO, Iterable, List, Union
 import logging
 
 from libreary.adapter_manager import AdapterManager
 from libreary.ingester import Ingester
+from libreary.scrubber import OK, REPAIRED
+from libreary.check_scheduler import CheckScheduler
+from libreary.ingest_pipeline import IngestPipeline
 from libreary.metadata.sqlite3 import SQLite3MetadataManager
+from libreary import hashing
+from libreary.adapter_registry import adapter_registry
 
 logger = logging.getLogger(__name__)
 
@@ -24,12 +30,22 @@ class Libreary:
     This class currently contains the following methods:
 
     - ingest (load a resource into LIBRE-ary)
+    - ingest_many (load many resources into LIBRE-ary, as a pipeline)
+    - ingest_stream (load a resource from a file object or an iterable of bytes)
     - retrieve (retrieve a copy of an object)
+    - open (read an object, or part of one, without retrieving a copy)
     - delete (delete an object)
     - update (update an object)
     - search (search for information about objects)
-    - run_full_check (check all resources to verify integrity)
+    - run_check (check all resources to verify integrity)
     - check_single_resource (check only a single resource)
+    - check_level (check all resources in a level)
+    - get_repair_metrics (depth and age of the background repair queue)
+    - start_repairs (repair queued copies in the background)
+    - stop_repairs
+    - get_adapter_health (which adapters are in service)
+    - start_scheduled_checks (check resources in the background, according to level frequency)
+    - stop_scheduled_checks
     """
 
     def __init__(self, config_dir: str):
@@ -57,7 +73,27 @@ class Libreary:
                 "options": {
                     "dropbox_dir": "Path to dropbox directory, where files you want to ingest should be placed",
                     "output_dir": "Path to directory you want files to be retrieved to",
-                    "config_dir": "Path to config directory"
+                    "config_dir": "Path to config directory",
+                    "hash_chunk_size": (optional, int) bytes read per chunk when computing checksums,
+                    "checksum_cache_size": (optional, int) number of file checksums to remember.
+                        0 disables the cache,
+                    "scrub_workers": (optional, int) concurrent integrity checks per adapter,
+                    "adapter_scrub_workers": (optional) {"adapter_id": concurrent integrity checks for that adapter},
+                    "verification_horizon": (optional, int) seconds a deep check trusts an unchanged, verified copy,
+                    "full_rehash_every": (optional, int) rehash unchanged copies on every Nth deep check anyway,
+                    "check_budgets": (optional) {"adapter_id": {"bytes_per_sec": (int), "iops": (int)}}
+                        limits on check I/O,
+                    "check_frequency_unit": (optional, int) seconds per unit of level frequency. Defaults to one day,
+                    "retrieval_mode": (optional) "preference" or "hedged".
+                        See `AdapterManager` for the hedging options,
+                    "circuit_failure_threshold": (optional, int) consecutive failures before an adapter
+                        is taken out of service,
+                    "background_repairs": (optional, boolean) repair queued copies in the background from startup.
+                        Defaults to false. Copies queued for repair, including stores deferred while an adapter
+                        was out of service, are then only made by `start_repairs`, `run_check` or `check_level`,
+                        and each deferred store logs a warning,
+                    "ingest_batch_size": (optional, int) objects per metadata transaction in `ingest_many`.
+                        See `IngestPipeline` for the other ingest_* options
                 },
                 "canonical_adapter":"Adapter Identifier for Canonical Adapter"
             }
@@ -81,19 +117,33 @@ class Libreary:
             self.dropbox_dir = self.config["options"]["dropbox_dir"]
             self.ret_dir = self.config["options"]["output_dir"]
 
+            hash_chunk_size = self.config["options"].get("hash_chunk_size")
+            if hash_chunk_size is not None:
+                hashing.set_default_chunk_size(hash_chunk_size)
+            checksum_cache_size = self.config["options"].get("checksum_cache_size")
+            if checksum_cache_size is not None:
+                hashing.checksum_cache.resize(checksum_cache_size)
+
             # Objects we need
-            self.metadata_man = metadata_manager_translate_table[self.config["metadata"]["manager_type"]](
-                self.config["metadata"])
+            # One metadata manager per metadata db, shared across the process
+            self.metadata_man = adapter_registry.get_metadata_manager(
+                self.config["metadata"],
+                metadata_manager_translate_table[self.config["metadata"]["manager_type"]])
             self.adapter_man = AdapterManager(
                 self.config, metadata_man=self.metadata_man)
             self.ingester = Ingester(
                 self.config, metadata_man=self.metadata_man)
+            self.scrubber = self.adapter_man.scrubber
+            self.check_scheduler = CheckScheduler(
+                self.adapter_man, self.metadata_man, self.scrubber, self.config["options"])
+            self.ingest_pipeline = IngestPipeline(
+                self.ingester, self.adapter_man, self.metadata_man, self.config["options"])
             logger.debug("LIBREary configuration valid. Proceeding.")
         except KeyError:
             logger.error("Invalid LIBREary config. Exiting.")
             raise KeyError
 
-    def run_check(deep: bool = False) -> List[str]:
+    def run_check(self, deep: bool = False, resume: bool = True) -> dict:
         """
         Check all of the objects in the LIBRE-ary. This follows the following process:
 
@@ -109,12 +159,71 @@ class Libreary:
                     If it doesn't:
                         Attempt to recover it.
 
+        Copies are checked in parallel, with a separate worker pool for each adapter.
+        Progress is checkpointed in the metadata db, so an interrupted check resumes
+        where it stopped. See `Scrubber.run` for the structure of the returned summary.
 
         :param deep speficies whether to use a deep search. A deep search will calculate actual checksums
         of each copy of each object, while a shallow one will trust that the checksum in the metadata
         database matches that of the actual object.
+        :param resume - continue an interrupted check rather than starting over
         """
         logger.debug(f"Running check of all objects in LIBREary. Deep: {deep}")
+        return self.scrubber.run(deep=deep, resume=resume)
+
+    def check_level(self, level: str, deep: bool = False) -> dict:
+        """
+        Check every object in a level: each object's canonical copy, and its copy in each of
+        the level's adapters. Missing and corrupt copies are repaired from the canonical copy.
+
+        Returns a report of the copies checked, and which were missing, corrupt or repaired.
+        See `Scrubber.check_level` for its structure.
+
+        :param level - name of the level to check
+        :param deep - compute the actual checksum of every copy, rather than trusting the metadata db
+        """
+        return self.adapter_man.check_level(level, deep=deep)
+
+    def get_repair_metrics(self) -> dict:
+        """
+        Return the depth and age of the background repair queue, and counts of repair outcomes.
+        See `RepairQueue.metrics` for the structure.
+        """
+        return self.adapter_man.repair_queue.metrics()
+
+    def start_repairs(self) -> None:
+        """
+        Start repairing queued copies in the background. Bad copies found while serving
+        requests are only queued for repair, and are left queued until this is called
+        (or `options.background_repairs` is set). See `RepairQueue`.
+        """
+        self.adapter_man.repair_queue.start()
+
+    def stop_repairs(self) -> None:
+        """
+        Stop repairing queued copies in the background, once the repairs in progress finish
+        """
+        self.adapter_man.repair_queue.stop()
+
+    def get_adapter_health(self) -> dict:
+        """
+        Return whether each adapter is in service, with counts of its recent successes and failures.
+        See `AdapterHealth.summary` for the structure.
+        """
+        return self.adapter_man.get_adapter_health()
+
+    def start_scheduled_checks(self) -> None:
+        """
+        Start checking resources in the background, as often as their levels' frequencies ask for.
+        The checking load is spread evenly across each level's period. See `CheckScheduler`.
+        """
+        self.check_scheduler.start()
+
+    def stop_scheduled_checks(self) -> None:
+        """
+        Stop checking resources in the background
+        """
+        self.check_scheduler.stop()
 
     def ingest(self, current_file_path: str, levels: List[str],
                description: str, delete_after_store: bool = False, metadata_schema: List[str] = [], metadata: List[dict] = []) -> str:
@@ -138,6 +247,11 @@ class Libreary:
              {"field": "owner", "value": "ben glick"}]
         """
 
+        # No metadata transaction is held open across adapter I/O, which would block every
+        # other writer for as long as the uploads take. The resource and its object metadata
+        # are committed together once the canonical copy is stored, and each adapter records
+        # its copy as soon as it's stored, so the metadata db matches the adapters whichever
+        # store fails.
         # Don't want ingester to delete it, because then AM will need to
         # retrieve.
         obj_id = self.ingester.ingest(
@@ -153,7 +267,72 @@ class Libreary:
             f"Ingesting object {obj_id} to LIBREary. Description: {description}")
         return obj_id
 
-    def retrieve(self, r_id: str) -> str:
+    def ingest_many(self, paths: Iterable[str], levels: List[str], description: str = "",
+                    delete_after_store: bool = False):
+        """
+        Ingest many objects at once. Hashing, storing canonical copies, writing metadata and
+        distributing copies run as overlapping stages on their own threads, with metadata
+        written in batches. See `IngestPipeline`.
+
+        Returns a generator, yielding a result for each file as it finishes:
+        ```
+        {"path": (str), "resource": (str) UUID or None, "error": (Exception) or None,
+         "stage": (str) the stage that failed or None, "report": (dict) distribution report}
+        ```
+        Files are only read as the generator is consumed, so memory use stays flat however
+        many files there are.
+
+        :param paths - paths of the files to ingest. Can be any iterable, including a generator
+        :param levels - a list of names of levels. These levels must exist in the
+            `levels` table in the metadata db
+        :param description - a description for every object
+        :param delete_after_store - Boolean. If True, each object is deleted from the dropbox once it's stored.
+        """
+        logger.debug(f"Ingesting many objects to LIBREary at levels {levels}")
+        return self.ingest_pipeline.run(paths, levels, description, delete_after_store)
+
+    def ingest_stream(self, source: Union[BinaryIO, Iterable[bytes]], filename: str, levels: List[str],
+                      description: str, metadata_schema: List[str] = [], metadata: List[dict] = [],
+                      stage: bool = False) -> str:
+        """
+        Ingest a new object from a stream, such as an upload or a network response, without
+        writing it to the dropbox first. The stream is read once: it's checksummed and sent to the
+        canonical adapter, and to every adapter that can store from a stream, as it arrives.
+        Copies for adapters that can't are made afterwards, from a copy staged in the dropbox.
+        See `AdapterManager.stream_to_adapters`.
+
+        Returns the new object's ID.
+
+        :param source - a binary file object, or an iterable of bytes
+        :param filename - the object's filename
+        :param levels - a list of names of levels. These levels must exist in the
+            `levels` table in the metadata db
+        :param description - a description of this object
+        :param metadata_schema - list of names of metadata fields to be associated with object
+        :param metadata - values of the fields in the metadata schema. See `ingest`
+        :param stage - make every copy except the canonical copy from a staged file
+        """
+        obj_id = str(uuid.uuid4())
+        logger.debug(f"Ingesting object {obj_id} from a stream, at levels {levels}")
+        report = self.adapter_man.stream_to_adapters(obj_id, filename, source, levels, stage=stage)
+
+        def record():
+            self.metadata_man.ingest_to_db(
+                report["locator"], ",".join([str(level) for level in levels]), filename,
+                report["checksum"], obj_id, description)
+            if len(metadata_schema) == len(metadata) and len(metadata_schema) != 0:
+                self.metadata_man.set_object_metadata_schema(obj_id, metadata_schema)
+                self.metadata_man.set_all_object_metadata(obj_id, metadata)
+
+        try:
+            self.metadata_man.run_in_transaction(record)
+        except Exception:
+            self.adapter_man.discard_stream(obj_id, report)
+            raise
+        self.adapter_man.finish_stream(obj_id, report)
+        return obj_id
+
+    def retrieve(self, r_id: str, in_place: bool = False) -> str:
         """
         Retrieve an object. This will save a copy of the object
             as `<self.output_dir>/<object_filename>`
@@ -162,14 +341,40 @@ class Libreary:
 
         Adapters and other objects frequently may delete or write files in these directories.
 
+        With :param in_place, LocalAdapters configured with a `retrieve_mode` other than "copy" hand
+        back a read-only hard link or symlink to their stored copy, or its path, instead of copying it,
+        which takes constant time and space. See `LocalAdapter.link`. The object must then only be read.
+
         :param r_id - The resource UUID that corresponds to the object you'd like to retrieve.
+        :param in_place - allow adapters to hand back their stored copy rather than a copy of it.
+            Only pass True if you're not going to modify the retrieved file.
 
         Returns a path to the retireved object.
         """
         logger.debug(f"Retrieving object {r_id}")
-        new_location = self.adapter_man.retrieve_by_preference(r_id)
+        new_location = self.adapter_man.retrieve_by_preference(r_id, in_place=in_place)
         return new_location
 
+    def open(self, r_id: str, offset: int = 0, length: int = None):
+        """
+        Open an object for reading, without retrieving a copy of it. The object is read
+        straight from whichever adapter serves it fastest: a local copy is opened in place,
+        and remote copies are fetched as they're read, so serving a preview or part of a
+        large object doesn't cost a full copy.
+
+        When the whole object is opened, it's checked against its checksum as it's read, and
+        ChecksumMismatchException is raised once the end is reached if it doesn't match.
+
+        Returns a binary file object, which should be closed when finished with,
+        or None if no copy could be opened.
+
+        :param r_id - The resource UUID that corresponds to the object you'd like to read.
+        :param offset - first byte to read
+        :param length - number of bytes to read, or None to read to the end of the object
+        """
+        logger.debug(f"Opening object {r_id}")
+        return self.adapter_man.open_resource(r_id, offset, length)
+
     def delete(self, r_id: str) -> None:
         """
         Delete an object from LIBRE-ary. This:
@@ -178,14 +383,16 @@ class Libreary:
             3. Removes the canonical copy
 
         Be careful with this function, as there is no undo option.
+
+        Each copy's entry in the `copies` table is removed as soon as the copy is, and the
+        resource and its object metadata are only removed once every copy is gone. If an
+        adapter fails, the metadata db still describes the copies that are left, and the
+        delete can simply be run again.
         """
         logger.debug(f"Deleting object {r_id}")
 
-        # Delete metadata only if object has metadata
-        if len(self.metadata_man.list_object_metadata_schema(r_id)) > 0:
-            self.metadata_man.delete_object_metadata_entirely(r_id)
-
         self.adapter_man.delete_resource_from_adapters(r_id)
+        # Also deletes the object's metadata
         self.ingester.delete_resource((r_id))
 
     def update(self, r_id: str, updated_path: str) -> None:
@@ -229,8 +436,12 @@ class Libreary:
         database matches that of the actual object.
 
         :param r_id - the resource ID of the object you'd like to check
+
+        Returns True iff every copy was fine, or was repaired.
         """
         logger.debug(f"Checking object {r_id}")
+        results = self.scrubber.check_resource(r_id, deep=deep)
+        return all(result["result"] in (OK, REPAIRED) for result in results)
 
     def add_level(self, name: str, frequency: int,
                   adapters: List[dict], copies=1) -> None:
@@ -238,7 +449,8 @@ class Libreary:
         Add a level to the metadata database.
 
         :param name - name for the level
-        :param frequency - check frequency for level. Currently unimplemented
+        :param frequency - period between scheduled checks of each resource in the level, in units
+            of `options.check_frequency_unit` (days, by default). See `start_scheduled_checks`
         :param adapters - dict object specifying adapters the level uses. Example:
             ```{json}
             [
@@ -266,5 +478,5 @@ class Libreary:
         :param level_name - name of the level to delete
         """
         logger.debug(f"Deleting Level {level_name}")
-        self.metadata_man.remove_level(level_name)
+        self.metadata_man.delete_level(level_name)
         self.adapter_man.reload_levels_adapters()
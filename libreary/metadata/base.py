@@ -1,12 +1,50 @@
+import zlib
 from typing import List
 
 
+def check_slot(r_id: str) -> float:
+    """
+    Return the fixed point in [0, 1) at which :param r_id is checked within each period of its
+    levels' check frequency, taken from a hash of its UUID. Metadata managers store it, so a
+    check scheduler can look up the resources due in a window without visiting every resource.
+    """
+    return zlib.crc32(r_id.encode()) / 2 ** 32
+
+
 class BaseMetadataManager(object):
     """docstring for BaseMetadataManager
 
     This object contains the following methods:
 
     - verify_db_structure
+    - get_schema_version
+    - migrate
+    - transaction
+    - run_in_transaction
+    - in_transaction
+    - add_copies
+    - deferred_copies
+    - iter_resources
+    - iter_level_copies
+    - iter_adapter_copies
+    - iter_resources_by_slot
+    - update_copy_locators
+    - start_scrub
+    - get_unfinished_scrub
+    - finish_scrub
+    - add_scrub_checkpoints
+    - get_scrub_checkpoints
+    - get_copy_verification
+    - record_copy_verifications
+    - invalidate_copy_verification
+    - get_scheduler_state
+    - set_scheduler_state
+    - enqueue_repair
+    - claim_repairs
+    - finish_repair
+    - requeue_running_repairs
+    - list_repairs
+    - get_repair_queue_stats
 
     """
 
@@ -16,6 +54,21 @@ class BaseMetadataManager(object):
     def verify_db_structure(self) -> bool:
         pass
 
+    def get_schema_version(self) -> int:
+        pass
+
+    def migrate(self) -> int:
+        pass
+
+    def transaction(self):
+        pass
+
+    def run_in_transaction(self, func, *args, **kwargs):
+        pass
+
+    def in_transaction(self) -> bool:
+        pass
+
     def add_level(self, name: str, frequency: int,
                   adapters: List[dict], copies=1) -> None:
         pass
@@ -24,6 +77,9 @@ class BaseMetadataManager(object):
                      levels: List[str], filename: str, checksum: str, obj_uuid: str, description: str) -> None:
         pass
 
+    def ingest_many_to_db(self, resources: List[tuple]) -> None:
+        pass
+
     def list_resources(self) -> List[List[str]]:
         pass
 
@@ -59,5 +115,77 @@ class BaseMetadataManager(object):
                  sha1Hashed: str, adapter_type: str, canonical: bool = False):
         pass
 
+    def add_copies(self, copies: List[List]) -> None:
+        pass
+
+    def deferred_copies(self):
+        pass
+
+    def iter_resources(self, batch_size: int = 500):
+        pass
+
+    def iter_level_copies(self, level: str, batch_size: int = 500):
+        pass
+
+    def iter_adapter_copies(self, adapter_id: str, batch_size: int = 500):
+        pass
+
+    def iter_resources_by_slot(self, low: float, high: float, levels: List[str] = None,
+                               batch_size: int = 500):
+        pass
+
+    def update_copy_locators(self, updates: List[List]) -> None:
+        pass
+
+    def start_scrub(self, deep: bool) -> int:
+        pass
+
+    def get_unfinished_scrub(self, deep: bool) -> int:
+        pass
+
+    def finish_scrub(self, scrub_id: int, status: str = "finished") -> None:
+        pass
+
+    def add_scrub_checkpoints(self, scrub_id: int, checkpoints: List[List[str]]) -> None:
+        pass
+
+    def get_scrub_checkpoints(self, scrub_id: int, r_ids: List[str]) -> dict:
+        pass
+
+    def get_copy_verification(self, copy_id: int) -> List:
+        pass
+
+    def record_copy_verifications(self, verifications: List[List]) -> None:
+        pass
+
+    def invalidate_copy_verification(self, copy_id: int) -> None:
+        pass
+
+    def get_scheduler_state(self, name: str) -> str:
+        pass
+
+    def set_scheduler_state(self, name: str, value: str) -> None:
+        pass
+
+    def enqueue_repair(self, r_id: str, adapter_id: str, canonical: bool = False,
+                       reason: str = None) -> bool:
+        pass
+
+    def claim_repairs(self, claimed_by: str, limit: int, now: float = None) -> List[List]:
+        pass
+
+    def finish_repair(self, repair_id: int, status: str, error: str = None,
+                      next_attempt_at: float = None, count_attempt: bool = True) -> None:
+        pass
+
+    def requeue_running_repairs(self, older_than: float) -> int:
+        pass
+
+    def list_repairs(self, status: str = None) -> List[List]:
+        pass
+
+    def get_repair_queue_stats(self) -> List[List]:
+        pass
+
     def search(self, search_term: str) -> List[List[str]]:
         pass
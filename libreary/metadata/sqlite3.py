@@ -1,13 +1,65 @@
 import sqlite3
 import os
 import json
+import time
+import threading
+from contextlib import contextmanager
 from typing import List
 import logging
 
 from libreary.exceptions import ResourceNotIngestedException, NoSuchMetadataFieldExeption
+from libreary.metadata.base import check_slot
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_JOURNAL_MODE = "wal"
+DEFAULT_SYNCHRONOUS = "normal"
+DEFAULT_BUSY_TIMEOUT = 30
+DEFAULT_WRITE_RETRIES = 5
+
+# Schema migrations, applied in order by `SQLite3MetadataManager.migrate`.
+# Each entry is (version, description, [statements]). Once a migration has
+# shipped, don't edit it - append a new one instead.
+MIGRATIONS = [
+    (1, "Secondary indexes for per-object lookups", [
+        "create index if not exists idx_resources_uuid on resources(uuid)",
+        "create index if not exists idx_copies_resource_adapter on copies(resource_id, adapter_identifier)",
+        "create index if not exists idx_copies_resource_canonical on copies(resource_id, canonical)",
+        "create index if not exists idx_copies_checksum on copies(checksum)",
+        "create index if not exists idx_object_metadata_object_key on object_metadata(object_id, key)",
+        "create index if not exists idx_object_metadata_schema_object on object_metadata_schema(object_id)",
+    ]),
+    (2, "Scrub runs and checkpoints", [
+        "create table if not exists scrub_runs (scrub_id integer primary key, started_at text, finished_at text, deep integer, status text)",
+        "create table if not exists scrub_checkpoints (scrub_id integer, resource_id text, adapter_identifier text, result text, checked_at text, "
+        "primary key (scrub_id, resource_id, adapter_identifier))",
+    ]),
+    (3, "Per-copy verification ledger", [
+        "create table if not exists copy_verifications (copy_id integer primary key, size integer, mtime_ns integer, "
+        "inode integer, verified_at real, result text, cycles integer)",
+    ]),
+    (4, "Check scheduler state", [
+        "create table if not exists scheduler_state (name text primary key, value text)",
+    ]),
+    (5, "Repair queue", [
+        "create table if not exists repair_queue (repair_id integer primary key, resource_id text, adapter_identifier text, "
+        "canonical integer, reason text, status text, attempts integer, enqueued_at real, next_attempt_at real, "
+        "updated_at real, claimed_by text, last_error text)",
+        # At most one outstanding repair per copy
+        "create unique index if not exists idx_repair_queue_outstanding on repair_queue(resource_id, adapter_identifier) "
+        "where status in ('pending', 'running')",
+        "create index if not exists idx_repair_queue_due on repair_queue(status, next_attempt_at)",
+    ]),
+    (6, "Per-adapter copy index", [
+        "create index if not exists idx_copies_adapter on copies(adapter_identifier, copy_id)",
+    ]),
+    (7, "Check slots", [
+        "create table if not exists check_slots (resource_id text primary key, slot real)",
+        "create index if not exists idx_check_slots_slot on check_slots(slot, resource_id)",
+        "insert or ignore into check_slots select uuid, libreary_check_slot(uuid) from resources",
+    ]),
+]
+
 
 class SQLite3MetadataManager(object):
     """docstring for SQLite3MetadataManager
@@ -25,25 +77,249 @@ class SQLite3MetadataManager(object):
         :param config, which should be structured as follows:
         ```{json}
         {
-        "db_file": "path to SQLite3 DB file for metadata"
+        "db_file": "path to SQLite3 DB file for metadata",
+        "journal_mode": "(optional) SQLite journal mode. Defaults to wal",
+        "synchronous": "(optional) SQLite synchronous level. Defaults to normal",
+        "mmap_size": "(optional, int) bytes of the db file to memory-map",
+        "busy_timeout": "(optional, int) seconds to wait on a locked db before failing. Defaults to 30",
+        "write_retries": "(optional, int) times to retry a write that still finds the db locked. Defaults to 5"
         }
         ```
+
+        Each thread that uses the manager gets its own connection, so readers never
+        queue behind a writer on another thread. With the default WAL journal, readers
+        and the (single) writer don't block each other at the SQLite level either.
         """
         try:
             self.metadata_db = os.path.realpath(
                 config.get("db_file"))
-            self.conn = sqlite3.connect(self.metadata_db)
-            self.cursor = self.conn.cursor()
             self.type = config.get("manager_type")
+            self.journal_mode = config.get("journal_mode", DEFAULT_JOURNAL_MODE)
+            self.synchronous = config.get("synchronous", DEFAULT_SYNCHRONOUS)
+            self.mmap_size = config.get("mmap_size")
+            self.busy_timeout = config.get("busy_timeout", DEFAULT_BUSY_TIMEOUT)
+            self.write_retries = config.get("write_retries", DEFAULT_WRITE_RETRIES)
+            self._local = threading.local()
+            self._connections = []
+            self._connections_lock = threading.Lock()
             logger.debug(
                 "Metadata Manager Configuration Valid. Creating Metadata Manager")
         except KeyError:
             logger.error("Ingester Configuration Invalid")
             raise KeyError
 
+        self.migrate()
+
+    def _thread_state(self) -> threading.local:
+        """
+        Return the calling thread's connection state, opening its connection on first use
+        """
+        if getattr(self._local, "conn", None) is None:
+            self._local.conn = self._connect()
+            self._local.cursor = self._local.conn.cursor()
+            self._local.transaction_depth = 0
+        return self._local
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """
+        The calling thread's connection to the metadata db
+        """
+        return self._thread_state().conn
+
+    @property
+    def cursor(self) -> sqlite3.Cursor:
+        """
+        The calling thread's cursor
+        """
+        return self._thread_state().cursor
+
+    @property
+    def _transaction_depth(self) -> int:
+        return self._thread_state().transaction_depth
+
+    @_transaction_depth.setter
+    def _transaction_depth(self, depth: int) -> None:
+        self._thread_state().transaction_depth = depth
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Open a new connection and apply the configured pragmas
+        """
+        conn = sqlite3.connect(self.metadata_db, timeout=self.busy_timeout)
+        conn.execute(f"pragma journal_mode={self.journal_mode}")
+        conn.execute(f"pragma synchronous={self.synchronous}")
+        if self.mmap_size is not None:
+            conn.execute(f"pragma mmap_size={int(self.mmap_size)}")
+        conn.create_function("libreary_check_slot", 1, check_slot, deterministic=True)
+        with self._connections_lock:
+            self._connections.append(conn)
+        logger.debug(
+            f"Opened metadata db connection for thread {threading.get_ident()}")
+        return conn
+
+    def close(self) -> None:
+        """
+        Close every connection this manager has opened, on any thread.
+        The manager opens new connections if it's used again.
+        """
+        with self._connections_lock:
+            connections = self._connections
+            self._connections = []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.ProgrammingError:
+                # Connections may only be closed from the thread that made them
+                logger.debug("Could not close metadata db connection from this thread")
+        self._local = threading.local()
+
+    @staticmethod
+    def _is_busy(e: sqlite3.OperationalError) -> bool:
+        message = str(e).lower()
+        return "locked" in message or "busy" in message
+
+    def _write(self, sql: str, params=()) -> sqlite3.Cursor:
+        """
+        Execute a write statement, retrying with backoff if the db is still locked
+        after the connection's busy timeout.
+
+        Inside a `transaction()` block, a locked db is raised straight away instead. Under
+        WAL, a transaction whose snapshot is out of date can never get the write lock, however
+        long the statement is retried, so the whole transaction has to be rolled back and run
+        again. See `run_in_transaction`.
+
+        :param sql - the statement to execute
+        :param params - parameters for the statement
+        """
+        attempt = 0
+        while True:
+            try:
+                return self.cursor.execute(sql, params)
+            except sqlite3.OperationalError as e:
+                if not self._is_busy(e) or attempt >= self.write_retries or self._transaction_depth > 0:
+                    raise e
+                attempt += 1
+                logger.debug(
+                    f"Metadata db busy, retrying write ({attempt}/{self.write_retries})")
+                time.sleep(min(0.05 * 2 ** attempt, 2))
+
     def verify_db_structure(self) -> bool:
         pass
 
+    def get_schema_version(self) -> int:
+        """
+        Return the version of the newest migration applied to the metadata db.
+        A db that has never been migrated is at version 0.
+        """
+        self.cursor.execute(
+            "create table if not exists schema_version (version integer primary key, description text, applied_at text)")
+        version = self.cursor.execute(
+            "select max(version) from schema_version").fetchone()[0]
+        return version or 0
+
+    def migrate(self) -> int:
+        """
+        Bring the metadata db up to date by applying every migration in `MIGRATIONS`
+        newer than the db's current schema version.
+
+        Each migration runs in its own transaction, together with the
+        `schema_version` row that records it, so an interrupted migration
+        is retried in full on the next startup.
+
+        Returns the schema version after migrating.
+        """
+        current = self.get_schema_version()
+        for version, description, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            logger.debug(
+                f"Migrating metadata db to version {version}: {description}")
+            try:
+                self.cursor.execute("begin")
+                for statement in statements:
+                    self.cursor.execute(statement)
+                self.cursor.execute(
+                    "insert into schema_version values (?, ?, datetime('now'))", (version, description))
+                self.conn.commit()
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                logger.error(
+                    f"Metadata db migration to version {version} failed: {e}")
+                raise e
+            current = version
+        return current
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group several metadata operations into a single transaction:
+
+        ```
+        with metadata_man.transaction():
+            metadata_man.ingest_to_db(...)
+            metadata_man.add_copy(...)
+        ```
+
+        Operations inside the block don't commit individually. The whole block is
+        committed once when it exits normally, and rolled back if an exception
+        escapes it.
+
+        Transactions nest: an inner `transaction()` folds into the outermost one,
+        and only the outermost block commits or rolls back.
+        """
+        self._transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                logger.debug("Rolling back metadata transaction")
+                self.conn.rollback()
+            raise
+        else:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self.conn.commit()
+
+    def run_in_transaction(self, func, *args, **kwargs):
+        """
+        Call :param func with :param args and :param kwargs inside a `transaction()` block,
+        and return what it returns. If the db is locked, the transaction is rolled back, and
+        run again from the start, with backoff, up to `write_retries` times.
+
+        :param func must only do metadata work, as it may be called more than once.
+        Called inside another transaction, it folds into that one, and isn't retried.
+        """
+        if self._transaction_depth > 0:
+            return func(*args, **kwargs)
+        attempt = 0
+        while True:
+            try:
+                with self.transaction():
+                    return func(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if not self._is_busy(e) or attempt >= self.write_retries:
+                    raise e
+                attempt += 1
+                logger.debug(
+                    f"Metadata db busy, retrying transaction ({attempt}/{self.write_retries})")
+                time.sleep(min(0.05 * 2 ** attempt, 2))
+
+    def in_transaction(self) -> bool:
+        """
+        Returns True if a `transaction()` block is currently open
+        """
+        return self._transaction_depth > 0
+
+    def _commit(self) -> None:
+        """
+        Commit, unless we're inside a `transaction()` block, in which case
+        the outermost block will commit for us.
+        """
+        if self._transaction_depth == 0:
+            self.conn.commit()
+
     def add_level(self, name: str, frequency: int,
                   adapters: List[dict], copies=1) -> None:
         """
@@ -69,14 +345,14 @@ class SQLite3MetadataManager(object):
         """
         logger.debug(f"Adding level {name}")
         str_adapters = json.dumps(adapters)
-        self.cursor.execute(
+        self._write(
             "insert into levels values (?, ?, ?, ?, ?)",
             (None,
              name,
              frequency,
              str_adapters,
              copies))
-        self.conn.commit()
+        self._commit()
 
     def delete_level(self, name: str) -> None:
         """
@@ -87,24 +363,23 @@ class SQLite3MetadataManager(object):
         :param name - name of level to delete
         """
         logger.debug(f"Deleting level {name}")
-        self.cursor.execute(
-            "delete from levels where name=?",
-            (name,))
-        self.conn.commit()
-        resources = self.list_resources()
-
-        for resource in resources:
-            uuid = resource[5]
-            try:
-                levels = resource[2].split(",")
-                levels.remove(name)
-            except IndexError:
-                continue
-            except ValueError:
-                continue
-            print(levels)
-            self.cursor.execute(
-                "update resources set levels=? where uuid=?", (json.dumps(levels), str(uuid)))
+        with self.transaction():
+            self._write(
+                "delete from levels where name=?",
+                (name,))
+            resources = self.list_resources()
+
+            for resource in resources:
+                uuid = resource[5]
+                try:
+                    levels = resource[2].split(",")
+                    levels.remove(name)
+                except IndexError:
+                    continue
+                except ValueError:
+                    continue
+                self._write(
+                    "update resources set levels=? where uuid=?", (",".join(levels), str(uuid)))
 
     def ingest_to_db(self, canonical_adapter_locator: str,
                      levels: str, filename: str, checksum: str, obj_uuid: str, description: str) -> None:
@@ -120,10 +395,23 @@ class SQLite3MetadataManager(object):
         :param description - a friendly, searchable description of the object
         """
         logger.debug(f"Ingesting object {obj_uuid} with name {filename}")
-        self.cursor.execute("insert into resources values (?, ?, ?, ?, ?, ?, ?)",
-                            (None, canonical_adapter_locator, levels, filename, checksum, obj_uuid, description))
+        with self.transaction():
+            self._write("insert into resources values (?, ?, ?, ?, ?, ?, ?)",
+                        (None, canonical_adapter_locator, levels, filename, checksum, obj_uuid, description))
+            self._write("insert or replace into check_slots values (?, ?)", (obj_uuid, check_slot(obj_uuid)))
+
+    def ingest_many_to_db(self, resources: List[tuple]) -> None:
+        """
+        Ingest several objects' metadata to the metadata database, in a single transaction.
 
-        self.conn.commit()
+        :param resources - list of tuples of the arguments to `ingest_to_db`, in order:
+            `(canonical_adapter_locator, levels, filename, checksum, obj_uuid, description)`
+        """
+        logger.debug(f"Ingesting {len(resources)} objects")
+        with self.transaction():
+            for resource in resources:
+                self._write("insert into resources values (?, ?, ?, ?, ?, ?, ?)", (None,) + tuple(resource))
+                self._write("insert or replace into check_slots values (?, ?)", (resource[4], check_slot(resource[4])))
 
     def list_resources(self) -> List[List[str]]:
         """
@@ -156,8 +444,9 @@ class SQLite3MetadataManager(object):
 
         :param r_id - the resource's uuid
         """
-        self.cursor.execute("delete from resources where uuid=?", (r_id,))
-        self.conn.commit()
+        with self.transaction():
+            self._write("delete from resources where uuid=?", (r_id,))
+            self._write("delete from check_slots where resource_id=?", (r_id,))
 
     def minimal_test_ingest(self, locator: str, real_checksum: str, r_id: str):
         """
@@ -174,9 +463,9 @@ class SQLite3MetadataManager(object):
         :param real_checksum - object checksum
         :param r_id - r_id of test resource
         """
-        self.cursor.execute("insert into resources values (?, ?, ?, ?, ?, ?, ?)",
-                            (None, locator, "low,", "libreary_test_file.txt", real_checksum, r_id, "A resource for testing LIBREary adapters with"))
-        self.conn.commit()
+        self._write("insert into resources values (?, ?, ?, ?, ?, ?, ?)",
+                    (None, locator, "low,", "libreary_test_file.txt", real_checksum, r_id, "A resource for testing LIBREary adapters with"))
+        self._commit()
 
     def get_levels(self):
         """
@@ -192,8 +481,8 @@ class SQLite3MetadataManager(object):
         :param new_levels - list of names of new levels
         """
         sql = "update resources set levels = ? where uuid=?"
-        self.cursor.execute(sql, (r_id, ",".join([level for level in new_levels])))
-        self.conn.commit()
+        self._write(sql, (",".join(new_levels), r_id))
+        self._commit()
 
     def summarize_copies(self, r_id: str) -> List[List[str]]:
         """
@@ -239,21 +528,397 @@ class SQLite3MetadataManager(object):
         :param copy_id -  The copy id (not resource uuid) to delete
         """
         print(copy_id)
-        self.cursor.execute("delete from copies where copy_id=?",
-                            (copy_id,))
-        self.conn.commit()
+        self._write("delete from copies where copy_id=?",
+                    (copy_id,))
+        # Copy ids can be reused, so don't leave a stale verification behind
+        self._write("delete from copy_verifications where copy_id=?",
+                    (copy_id,))
+        self._commit()
 
     def add_copy(self, r_id: str, adapter_id: str, new_location: str,
                  sha1Hashed: str, adapter_type: str, canonical: bool = False):
         """
         Add a copy of an object to the metadata database
 
+        Inside a `deferred_copies` block, the copy is collected rather than written.
+        """
+        row = [None, r_id, adapter_id, new_location, sha1Hashed, adapter_type, canonical]
+        deferred = getattr(self._thread_state(), "deferred_copies", None)
+        if deferred is not None:
+            deferred.append(row)
+            return
+        self._write("insert into copies values ( ?, ?, ?, ?, ?, ?, ?)", row)
+        self._commit()
+
+    def add_copies(self, copies: List[List]) -> None:
+        """
+        Add several copies to the metadata database, in a single transaction
 
+        :param copies - rows collected by `deferred_copies`
         """
-        self.cursor.execute(
-            "insert into copies values ( ?, ?, ?, ?, ?, ?, ?)",
-            [None, r_id, adapter_id, new_location, sha1Hashed, adapter_type, canonical])
-        self.conn.commit()
+        with self.transaction():
+            for row in copies:
+                self._write("insert into copies values ( ?, ?, ?, ?, ?, ?, ?)", row)
+
+    @contextmanager
+    def deferred_copies(self):
+        """
+        Collect the copies that `add_copy` is asked to add on this thread, inside the block,
+        instead of writing them. The list they're collected in is yielded, for `add_copies`
+        to write later, in the same transaction as the resources they belong to:
+
+        ```
+        with metadata_man.deferred_copies() as copies:
+            locator = adapter._store_canonical(...)
+        ...
+        with metadata_man.transaction():
+            metadata_man.ingest_many_to_db(...)
+            metadata_man.add_copies(copies)
+        ```
+        """
+        state = self._thread_state()
+        previous = getattr(state, "deferred_copies", None)
+        state.deferred_copies = []
+        try:
+            yield state.deferred_copies
+        finally:
+            state.deferred_copies = previous
+
+    def iter_resources(self, batch_size: int = 500):
+        """
+        Iterate over every resource, yielding lists of at most :param batch_size rows.
+        Each row has the same layout as `list_resources`.
+
+        Batches are fetched by resource id (keyset pagination), so memory use doesn't
+        grow with the size of the archive, and resources added during iteration
+        are picked up if their id is higher than the last one seen.
+
+        :param batch_size - maximum number of resources per batch
+        """
+        last_id = -1
+        while True:
+            batch = self.cursor.execute(
+                "select * from resources where id > ? order by id limit ?", (last_id, batch_size)).fetchall()
+            if not batch:
+                return
+            yield batch
+            last_id = batch[-1][0]
+
+    def iter_level_copies(self, level: str, batch_size: int = 500):
+        """
+        Iterate over every resource in a level together with all of its copies.
+
+        Yields lists of at most :param batch_size `(resource, copies)` pairs, where `resource`
+        has the same layout as `get_resource_info` and `copies` is a list of rows with the same
+        layout as `summarize_copies`. Each batch is fetched with a single joined query.
+
+        :param level - name of the level
+        :param batch_size - maximum number of resources per batch
+        """
+        sql = """select r.*, c.* from
+                     (select * from resources where id > ? and instr(',' || levels || ',', ?) > 0 order by id limit ?) r
+                     left join copies c on c.resource_id = r.uuid
+                 order by r.id, c.copy_id"""
+        # instr, rather than like, so `_` and `%` in level names aren't wildcards, and case matters
+        pattern = "," + level + ","
+        last_id = -1
+        while True:
+            rows = self.cursor.execute(sql, (last_id, pattern, batch_size)).fetchall()
+            if not rows:
+                return
+            batch = []
+            for row in rows:
+                resource, copy = row[:7], row[7:]
+                if not batch or batch[-1][0][0] != resource[0]:
+                    batch.append((resource, []))
+                # A resource with no copies comes back once, with a null copy
+                if copy[0] is not None:
+                    batch[-1][1].append(copy)
+            yield batch
+            last_id = batch[-1][0][0]
+
+    def iter_resources_by_slot(self, low: float, high: float, levels: List[str] = None,
+                               batch_size: int = 500):
+        """
+        Iterate over the resources whose check slot (see `check_slot`) is in [low, high),
+        yielding lists of at most :param batch_size rows, with the same layout as `list_resources`.
+
+        Slots are indexed, so this only visits the resources in the range, however big the archive is.
+
+        :param low - lowest slot, in [0, 1)
+        :param high - slot to stop before, in (0, 1]
+        :param levels - only resources in at least one of these levels. None for every resource
+        :param batch_size - maximum number of resources per batch
+        """
+        sql = ("select r.*, s.slot from check_slots s join resources r on r.uuid = s.resource_id "
+               "where s.slot >= ? and s.slot < ? and (s.slot, s.resource_id) > (?, ?)")
+        level_params = []
+        if levels is not None:
+            if not levels:
+                return
+            sql += " and ({})".format(" or ".join(["instr(',' || r.levels || ',', ?) > 0"] * len(levels)))
+            level_params = ["," + level + "," for level in levels]
+        sql += " order by s.slot, s.resource_id limit ?"
+        last = (-1.0, "")
+        while True:
+            rows = self.cursor.execute(sql, (low, high) + last + tuple(level_params) + (batch_size,)).fetchall()
+            if not rows:
+                return
+            yield [row[:-1] for row in rows]
+            last = (rows[-1][-1], rows[-1][5])
+
+    def iter_adapter_copies(self, adapter_id: str, batch_size: int = 500):
+        """
+        Iterate over every copy in an adapter, yielding lists of at most :param batch_size rows.
+        Each row has the same layout as `summarize_copies`, followed by the resource's filename.
+
+        Batches are fetched by copy id (keyset pagination), so rewriting copies' locators
+        while iterating is safe.
+
+        :param adapter_id - the adapter whose copies to list
+        :param batch_size - maximum number of copies per batch
+        """
+        last_id = -1
+        while True:
+            batch = self.cursor.execute(
+                "select copies.*, resources.name from copies left join resources on copies.resource_id = resources.uuid "
+                "where copies.adapter_identifier=? and copies.copy_id > ? order by copies.copy_id limit ?",
+                (adapter_id, last_id, batch_size)).fetchall()
+            if not batch:
+                return
+            yield batch
+            last_id = batch[-1][0]
+
+    def update_copy_locators(self, updates: List[List]) -> None:
+        """
+        Change the locators of copies that have been moved, in a single transaction.
+        A canonical copy's locator is also changed in the `resources` table.
+
+        :param updates - list of (copy_id, new locator)
+        """
+        with self.transaction():
+            for copy_id, locator in updates:
+                self._write("update copies set locator=? where copy_id=?", (locator, copy_id))
+                self._write("update resources set path=? where uuid=(select resource_id from copies "
+                            "where copy_id=? and canonical=1)", (locator, copy_id))
+
+    def start_scrub(self, deep: bool) -> int:
+        """
+        Record the start of a new scrub, and return its scrub id
+
+        :param deep - whether the scrub computes actual checksums
+        """
+        cursor = self._write(
+            "insert into scrub_runs values (?, datetime('now'), ?, ?, ?)", (None, None, int(deep), "running"))
+        self._commit()
+        return cursor.lastrowid
+
+    def get_unfinished_scrub(self, deep: bool) -> int:
+        """
+        Return the id of the most recent scrub of the same kind that was interrupted
+        before it finished, or None if there isn't one.
+
+        :param deep - whether the scrub computes actual checksums
+        """
+        row = self.cursor.execute(
+            "select scrub_id from scrub_runs where status='running' and deep=? order by scrub_id desc limit 1",
+            (int(deep),)).fetchone()
+        return row[0] if row else None
+
+    def finish_scrub(self, scrub_id: int, status: str = "finished") -> None:
+        """
+        Mark a scrub as finished. Its checkpoints are no longer needed, so they're removed.
+
+        :param scrub_id - the scrub to finish
+        :param status - final status to record
+        """
+        self._write("update scrub_runs set finished_at=datetime('now'), status=? where scrub_id=?",
+                    (status, scrub_id))
+        self._write("delete from scrub_checkpoints where scrub_id=?", (scrub_id,))
+        self._commit()
+
+    def add_scrub_checkpoints(self, scrub_id: int, checkpoints: List[List[str]]) -> None:
+        """
+        Record that (resource, adapter) pairs have been checked by a scrub
+
+        :param scrub_id - the scrub doing the checking
+        :param checkpoints - list of (resource id, adapter id, result) entries
+        """
+        with self.transaction():
+            for r_id, adapter_id, result in checkpoints:
+                self._write("insert or replace into scrub_checkpoints values (?, ?, ?, ?, datetime('now'))",
+                            (scrub_id, r_id, adapter_id, result))
+
+    def get_scrub_checkpoints(self, scrub_id: int, r_ids: List[str]) -> dict:
+        """
+        Return the recorded results for a set of resources in a scrub, as a dict
+        mapping (resource id, adapter id) to result
+
+        :param scrub_id - the scrub to look up
+        :param r_ids - resource ids to look up
+        """
+        checkpoints = {}
+        # Stay under SQLite's limit on the number of bound parameters
+        for i in range(0, len(r_ids), 500):
+            chunk = r_ids[i:i + 500]
+            sql = "select resource_id, adapter_identifier, result from scrub_checkpoints where scrub_id=? and resource_id in ({})".format(
+                ",".join("?" * len(chunk)))
+            for r_id, adapter_id, result in self.cursor.execute(sql, [scrub_id] + chunk).fetchall():
+                checkpoints[(r_id, adapter_id)] = result
+        return checkpoints
+
+    def get_copy_verification(self, copy_id: int) -> List:
+        """
+        Return the last recorded verification of a copy, or None if it has never been verified.
+        The row is:
+
+        `copy_id`, `size`, `mtime_ns`, `inode`, `verified_at` (unix time of the last full hash),
+        `result`, `cycles` (checks since the last full hash)
+
+        :param copy_id - the copy id (not resource uuid) to look up
+        """
+        return self.cursor.execute(
+            "select * from copy_verifications where copy_id=?", (copy_id,)).fetchone()
+
+    def record_copy_verifications(self, verifications: List[List]) -> None:
+        """
+        Record the results of checking copies.
+
+        Each entry is (copy_id, size, mtime_ns, inode, result, rehashed). If `rehashed` is True,
+        the copy was fully hashed: its fingerprint, result and verification time are replaced,
+        and its cycle count is reset. Otherwise the copy was trusted on its fingerprint alone,
+        and only its cycle count goes up.
+
+        :param verifications - list of entries to record
+        """
+        with self.transaction():
+            for copy_id, size, mtime_ns, inode, result, rehashed in verifications:
+                if rehashed:
+                    self._write("insert or replace into copy_verifications values (?, ?, ?, ?, ?, ?, 0)",
+                                (copy_id, size, mtime_ns, inode, time.time(), result))
+                else:
+                    self._write("update copy_verifications set cycles=cycles+1 where copy_id=?",
+                                (copy_id,))
+
+    def invalidate_copy_verification(self, copy_id: int) -> None:
+        """
+        Forget the last verification of a copy, so the next deep check hashes it in full,
+        whatever its fingerprint. Used when a copy has been exposed to writes outside LIBRE-ary.
+
+        :param copy_id - the copy id (not resource uuid) to forget
+        """
+        self._write("delete from copy_verifications where copy_id=?", (copy_id,))
+        self._commit()
+
+    def get_scheduler_state(self, name: str) -> str:
+        """
+        Return a value saved by the check scheduler, or None if it was never set
+
+        :param name - name of the value
+        """
+        row = self.cursor.execute(
+            "select value from scheduler_state where name=?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_scheduler_state(self, name: str, value: str) -> None:
+        """
+        Save a value for the check scheduler, so it survives restarts
+
+        :param name - name of the value
+        :param value - value to save
+        """
+        self._write("insert or replace into scheduler_state values (?, ?)", (name, value))
+        self._commit()
+
+    def enqueue_repair(self, r_id: str, adapter_id: str, canonical: bool = False,
+                       reason: str = None) -> bool:
+        """
+        Queue a repair of the copy of a resource in an adapter. Returns False if a repair
+        of that copy was already pending or running, in which case nothing is queued.
+
+        :param r_id - UUID of the resource
+        :param adapter_id - adapter holding the copy
+        :param canonical - whether the canonical copy needs repairing
+        :param reason - why the repair was queued
+        """
+        now = time.time()
+        cursor = self._write(
+            "insert or ignore into repair_queue values (?, ?, ?, ?, ?, 'pending', 0, ?, ?, ?, null, null)",
+            (None, r_id, adapter_id, int(canonical), reason, now, now, now))
+        self._commit()
+        return cursor.rowcount == 1
+
+    def claim_repairs(self, claimed_by: str, limit: int, now: float = None) -> List[List]:
+        """
+        Mark up to :param limit pending repairs that are due as running, and return them.
+        Claiming is a single statement, so concurrent claimers never get the same repair.
+
+        Each row is: `repair_id`, `resource_id`, `adapter_identifier`, `canonical`, `reason`,
+        `status`, `attempts`, `enqueued_at`, `next_attempt_at`, `updated_at`, `claimed_by`, `last_error`
+
+        :param claimed_by - unique token identifying the claimer
+        :param limit - maximum number of repairs to claim
+        :param now - unix time. Defaults to the current time
+        """
+        now = now if now is not None else time.time()
+        self._write(
+            """update repair_queue set status='running', claimed_by=?, updated_at=? where repair_id in
+               (select repair_id from repair_queue where status='pending' and next_attempt_at <= ?
+                order by next_attempt_at limit ?)""",
+            (claimed_by, now, now, limit))
+        self._commit()
+        return self.cursor.execute(
+            "select * from repair_queue where status='running' and claimed_by=?", (claimed_by,)).fetchall()
+
+    def finish_repair(self, repair_id: int, status: str, error: str = None,
+                      next_attempt_at: float = None, count_attempt: bool = True) -> None:
+        """
+        Record the outcome of a repair attempt.
+
+        :param repair_id - the repair attempted
+        :param status - "done", "failed" (given up), or "pending" (to be retried)
+        :param error - error from the attempt, if it failed
+        :param next_attempt_at - unix time of the next attempt, when retrying
+        :param count_attempt - count this against the repair's attempts. False when the
+            repair was put off without being attempted
+        """
+        self._write(
+            """update repair_queue set status=?, attempts=attempts+?, last_error=?, updated_at=?,
+               next_attempt_at=coalesce(?, next_attempt_at), claimed_by=null where repair_id=?""",
+            (status, int(count_attempt), error, time.time(), next_attempt_at, repair_id))
+        self._commit()
+
+    def requeue_running_repairs(self, older_than: float) -> int:
+        """
+        Return repairs left running by a process that died to the pending state.
+        Returns the number of repairs requeued.
+
+        :param older_than - only requeue repairs claimed before this unix time
+        """
+        cursor = self._write(
+            "update repair_queue set status='pending', claimed_by=null where status='running' and updated_at < ?",
+            (older_than,))
+        self._commit()
+        return cursor.rowcount
+
+    def list_repairs(self, status: str = None) -> List[List]:
+        """
+        Return queued repairs, optionally only those with :param status.
+        Rows have the same layout as `claim_repairs`.
+        """
+        if status is None:
+            return self.cursor.execute("select * from repair_queue order by repair_id").fetchall()
+        return self.cursor.execute(
+            "select * from repair_queue where status=? order by repair_id", (status,)).fetchall()
+
+    def get_repair_queue_stats(self) -> List[List]:
+        """
+        Return a summary of the repair queue: one row per (adapter, status) with
+        `adapter_identifier`, `status`, `count`, `oldest enqueued_at`
+        """
+        return self.cursor.execute(
+            "select adapter_identifier, status, count(*), min(enqueued_at) from repair_queue "
+            "group by adapter_identifier, status").fetchall()
 
     def search(self, search_term: str):
         """
@@ -293,10 +958,10 @@ class SQLite3MetadataManager(object):
         :param md_schema - list of field names and types
         """
         md_schema_text = json.dumps(md_schema)
-        self.cursor.execute(
+        self._write(
             "insert into object_metadata_schema values ( ?, ?, ?)",
             [None, r_id, md_schema_text])
-        self.conn.commit()
+        self._commit()
 
     def set_object_metadata_field(
             self, r_id: str, field: str, value: str) -> None:
@@ -317,10 +982,10 @@ class SQLite3MetadataManager(object):
         if field not in list_of_fields:
             raise NoSuchMetadataFieldExeption
 
-        self.cursor.execute(
+        self._write(
             "insert into object_metadata values ( ?, ?, ?, ?)",
             [None, r_id, field, value])
-        self.conn.commit()
+        self._commit()
 
     def set_all_object_metadata(
             self, r_id: str, metadata: List[dict]) -> None:
@@ -362,9 +1027,9 @@ class SQLite3MetadataManager(object):
         :param r_id - orbect uuid for deletion
         :param field - field to delete
         """
-        self.cursor.execute(
+        self._write(
             "delete from object_metadata where object_id=? and key=?", (r_id, field))
-        self.conn.commit()
+        self._commit()
 
     def delete_object_metadata_schema(self, r_id: str):
         """
@@ -372,9 +1037,9 @@ class SQLite3MetadataManager(object):
 
         :param r_id - orbect uuid for deletion
         """
-        self.cursor.execute(
+        self._write(
             "delete from object_metadata_schema where object_id=?", (r_id,))
-        self.conn.commit()
+        self._commit()
 
     def delete_object_metadata_entirely(self, r_id: str) -> None:
         """
@@ -0,0 +1,116 @@
+import threading
+from typing import List, Tuple, Union
+import logging
+
+from libreary.exceptions import LevelNotFoundException
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PLAN_CACHE_SIZE = 1024
+
+
+class PlacementPlanner:
+    """
+    Works out which adapters copies of a resource belong in.
+
+    A resource's levels are resolved to a unique, ordered list of adapter IDs once:
+    an adapter shared by several levels appears a single time, in the position it
+    first appears in. Each level's adapter list, and each combination of levels seen,
+    is cached, so distributing, deleting and checking resources in wide, overlapping
+    levels doesn't re-walk the level config for every resource.
+
+    The caches must be cleared with `invalidate` whenever the levels change. The
+    AdapterManager does this in `reload_levels_adapters`.
+
+    This class currently contains the following methods:
+
+    - level_adapters (the adapters used by a single level)
+    - plan (the adapters used by a set of levels)
+    - invalidate (forget cached placements)
+    """
+
+    def __init__(self, adapter_man: object, cache_size: int = DEFAULT_PLAN_CACHE_SIZE):
+        """
+        Constructor for the PlacementPlanner object. In most cases, it will be
+        constructed by the AdapterManager.
+
+        :param adapter_man - the AdapterManager, whose `levels` describe each level's adapters
+        :param cache_size - most combinations of levels to remember plans for
+        """
+        self.adapter_man = adapter_man
+        self.cache_size = cache_size
+        self._level_adapters = {}
+        self._plans = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self) -> None:
+        """
+        Forget every cached placement. Call this whenever levels are added, changed or removed.
+        """
+        with self._lock:
+            self._level_adapters = {}
+            self._plans = {}
+
+    def level_adapters(self, level: str) -> Tuple[str]:
+        """
+        Return the IDs of the adapters :param level stores copies in, without duplicates.
+        Raises LevelNotFoundException if there's no such level.
+        """
+        with self._lock:
+            adapter_ids = self._level_adapters.get(level)
+        if adapter_ids is not None:
+            return adapter_ids
+
+        if level not in self.adapter_man.levels:
+            raise LevelNotFoundException(level)
+        adapter_ids = []
+        for adapter in self.adapter_man.levels[level]["adapters"]:
+            if adapter["id"] not in adapter_ids:
+                adapter_ids.append(adapter["id"])
+        adapter_ids = tuple(adapter_ids)
+        with self._lock:
+            self._level_adapters[level] = adapter_ids
+        return adapter_ids
+
+    def plan(self, levels: Union[str, List[str]], exclude_canonical: bool = False,
+             skip_unknown: bool = False) -> Tuple[str]:
+        """
+        Return the IDs of the adapters that copies of a resource in :param levels belong in,
+        without duplicates, in the order they first appear in the levels.
+
+        :param levels - list of level names, or a comma-separated string of them,
+            as stored in the `resources` table
+        :param exclude_canonical - leave out the canonical adapter, whose copy is the canonical copy
+        :param skip_unknown - leave out levels that don't exist, rather than raising LevelNotFoundException
+        """
+        if isinstance(levels, str):
+            levels = levels.split(",")
+        key = (tuple(levels), exclude_canonical, skip_unknown)
+        with self._lock:
+            adapter_ids = self._plans.get(key)
+        if adapter_ids is not None:
+            return adapter_ids
+
+        canonical_id = self.adapter_man.canonical_adapter
+        adapter_ids = []
+        for level in levels:
+            if not level:
+                continue
+            try:
+                level_adapters = self.level_adapters(level)
+            except LevelNotFoundException:
+                if not skip_unknown:
+                    raise
+                logger.warning(f"Ignoring unknown level {level}")
+                continue
+            for adapter_id in level_adapters:
+                if adapter_id in adapter_ids or (exclude_canonical and adapter_id == canonical_id):
+                    continue
+                adapter_ids.append(adapter_id)
+        adapter_ids = tuple(adapter_ids)
+
+        with self._lock:
+            if len(self._plans) >= self.cache_size:
+                self._plans = {}
+            self._plans[key] = adapter_ids
+        return adapter_ids
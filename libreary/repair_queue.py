@@ -0,0 +1,268 @@
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from libreary.exceptions import ResourceNotIngestedException, AdapterUnavailableException
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPAIR_WORKERS = 2
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BACKOFF_BASE = 30
+DEFAULT_BACKOFF_MAX = 60 * 60
+DEFAULT_POLL_INTERVAL = 5
+# A repair still marked running after this long was abandoned by a dead process
+DEFAULT_REPAIR_TIMEOUT = 60 * 60
+
+
+class RepairQueue:
+    """
+    A durable queue of copies waiting to be repaired from their canonical copy.
+
+    Code that finds a bad copy while serving a request (a retrieve that hits a
+    checksum mismatch, for example) only queues a repair and moves on, so a slow or
+    flaky adapter never stalls the request. The queue lives in the metadata db, so
+    queued repairs survive restarts, and there's at most one outstanding repair per copy.
+
+    Repairs are made by `process`, or by a pool of background workers once `start` has been
+    called (`background_repairs` starts them with the AdapterManager). A failed repair is retried with
+    exponential backoff, up to a maximum number of attempts which can be set per
+    adapter, after which it's marked failed and left for an operator. Repairs of copies
+    in an adapter that is out of service wait for it to come back, without using up attempts.
+    Stores deferred while an adapter was out of service are queued here too, and
+    made the same way, so they're only made once the queue is drained.
+
+    This class currently contains the following methods:
+
+    - enqueue (queue a repair)
+    - process (attempt every repair that is due, and wait for them to finish)
+    - start (drain the queue in a background thread)
+    - stop (stop the background thread)
+    - metrics (queue depth, age and outcome counters)
+    """
+
+    def __init__(self, adapter_man: object, metadata_man: object, options: dict = None):
+        """
+        Constructor for the RepairQueue object. This object can be created manually, but
+        in most cases, it will be constructed by the AdapterManager.
+
+        :param adapter_man - the AdapterManager used to perform repairs
+        :param metadata_man - the metadata manager holding the queue
+        :param options - the `options` section of the LIBRE-ary config. The following keys are used:
+        ```{json}
+        {
+            "background_repairs": (optional, boolean) drain the queue in the background, from a thread
+                the AdapterManager starts. Defaults to false, so queued repairs and deferred stores wait
+                for `process` or `start`,
+            "repair_workers": (optional, int) repairs attempted concurrently. Defaults to 2,
+            "repair_max_attempts": (optional, int) attempts before a repair is given up on. Defaults to 5,
+            "adapter_repair_max_attempts": (optional) {"adapter_id": attempts for repairs of that adapter's copies},
+            "repair_backoff_base": (optional, int) seconds before the first retry, doubled for each retry. Defaults to 30,
+            "repair_backoff_max": (optional, int) longest wait between retries, in seconds. Defaults to 3600,
+            "repair_poll_interval": (optional, int) seconds between checks for due repairs. Defaults to 5
+        }
+        ```
+        """
+        options = options or {}
+        self.adapter_man = adapter_man
+        self.metadata_man = metadata_man
+        self.background = options.get("background_repairs", False)
+        self.workers = options.get("repair_workers", DEFAULT_REPAIR_WORKERS)
+        self.max_attempts = options.get("repair_max_attempts", DEFAULT_MAX_ATTEMPTS)
+        self.adapter_max_attempts = options.get("adapter_repair_max_attempts", {})
+        self.backoff_base = options.get("repair_backoff_base", DEFAULT_BACKOFF_BASE)
+        self.backoff_max = options.get("repair_backoff_max", DEFAULT_BACKOFF_MAX)
+        self.poll_interval = options.get("repair_poll_interval", DEFAULT_POLL_INTERVAL)
+        self._pool = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._counters = {"enqueued": 0, "repaired": 0, "retried": 0, "gave_up": 0}
+
+    def enqueue(self, r_id: str, adapter_id: str, canonical: bool = False, reason: str = None) -> bool:
+        """
+        Queue a repair of the copy of :param r_id in :param adapter_id. Returns False if
+        that copy already had a repair queued.
+
+        :param r_id - UUID of the resource
+        :param adapter_id - adapter holding the bad copy
+        :param canonical - whether it's the canonical copy that needs repairing
+        :param reason - why the repair is needed, for the record
+        """
+        queued = self.metadata_man.enqueue_repair(r_id, adapter_id, canonical=canonical, reason=reason)
+        if queued:
+            logger.info(f"Queued repair of object {r_id} in adapter {adapter_id}: {reason}")
+            with self._lock:
+                self._counters["enqueued"] += 1
+        # Only drained here if the background thread has been started
+        self._wake.set()
+        return queued
+
+    def get_max_attempts(self, adapter_id: str) -> int:
+        """
+        Return the number of attempts allowed for repairs of :param adapter_id's copies
+        """
+        return self.adapter_max_attempts.get(adapter_id, self.max_attempts)
+
+    def get_backoff(self, attempts: int) -> float:
+        """
+        Return the number of seconds to wait before retrying a repair that has failed :param attempts times.
+        The wait doubles with each attempt, up to `repair_backoff_max`, with jitter so that
+        repairs that failed together don't all retry together.
+        """
+        delay = min(self.backoff_max, self.backoff_base * 2 ** max(attempts - 1, 0))
+        return delay * random.uniform(0.5, 1.0)
+
+    def process(self, limit: int = None, now: float = None) -> dict:
+        """
+        Attempt every repair that is due, and wait for the attempts to finish.
+        Returns counts of the outcomes: `{"repaired": n, "retried": n, "gave_up": n}`
+
+        :param limit - attempt at most this many repairs. Defaults to `repair_workers`
+        :param now - unix time used to decide which repairs are due. Defaults to the current time
+        """
+        claimed = self.metadata_man.claim_repairs(
+            str(uuid.uuid4()), limit or self.workers, now=now)
+        outcomes = {"repaired": 0, "retried": 0, "gave_up": 0}
+        if not claimed:
+            return outcomes
+        pool = self._get_pool()
+        for future in [pool.submit(self._attempt, repair) for repair in claimed]:
+            outcomes[future.result()] += 1
+        return outcomes
+
+    def _attempt(self, repair: list) -> str:
+        """
+        Attempt a single claimed repair, and record the outcome.
+        Returns "repaired", "retried" or "gave_up".
+        """
+        repair_id, r_id, adapter_id, canonical, attempts = repair[0], repair[1], repair[2], repair[3], repair[6]
+        try:
+            logger.debug(f"Repairing object {r_id} in adapter {adapter_id}, attempt {attempts + 1}")
+            if canonical:
+                self.adapter_man.restore_canonical_copy(r_id)
+            else:
+                self.adapter_man.restore_from_canonical_copy(adapter_id, r_id)
+            self.metadata_man.finish_repair(repair_id, "done")
+            outcome = "repaired"
+        except ResourceNotIngestedException:
+            # The resource was deleted after the repair was queued
+            self.metadata_man.finish_repair(repair_id, "failed", error="resource no longer exists")
+            outcome = "gave_up"
+        except AdapterUnavailableException as e:
+            # Wait for the adapter to come back, without using up an attempt
+            retry_at = self.adapter_man.health.retry_at(adapter_id)
+            logger.debug(f"Adapter {adapter_id} is out of service. Putting off repair of object {r_id}")
+            self.metadata_man.finish_repair(
+                repair_id, "pending", error=str(e),
+                next_attempt_at=max(retry_at, time.time() + self.poll_interval), count_attempt=False)
+            outcome = "retried"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if attempts + 1 >= self.get_max_attempts(adapter_id):
+                logger.error(
+                    f"Giving up on repairing object {r_id} in adapter {adapter_id} after {attempts + 1} attempts: {error}")
+                self.metadata_man.finish_repair(repair_id, "failed", error=error)
+                outcome = "gave_up"
+            else:
+                delay = self.get_backoff(attempts + 1)
+                logger.warning(
+                    f"Repair of object {r_id} in adapter {adapter_id} failed, retrying in {delay:.0f}s: {error}")
+                self.metadata_man.finish_repair(
+                    repair_id, "pending", error=error, next_attempt_at=time.time() + delay)
+                outcome = "retried"
+        with self._lock:
+            self._counters[outcome] += 1
+        return outcome
+
+    def metrics(self) -> dict:
+        """
+        Return metrics describing the repair queue:
+        ```
+        {
+            "depth": (int) repairs pending or running,
+            "pending": (int), "running": (int), "failed": (int), "done": (int),
+            "oldest_pending_age": (float) seconds since the oldest pending repair was queued, or 0,
+            "by_adapter": {"adapter_id": {"pending": (int), "running": (int), "failed": (int), "done": (int)}},
+            "enqueued": (int), "repaired": (int), "retried": (int), "gave_up": (int)
+                counts of events in this process since it started
+        }
+        ```
+        """
+        metrics = {"depth": 0, "pending": 0, "running": 0, "failed": 0, "done": 0,
+                   "oldest_pending_age": 0, "by_adapter": {}}
+        oldest = None
+        for adapter_id, status, count, enqueued_at in self.metadata_man.get_repair_queue_stats():
+            metrics[status] = metrics.get(status, 0) + count
+            metrics["by_adapter"].setdefault(adapter_id, {})[status] = count
+            if status == "pending" and (oldest is None or enqueued_at < oldest):
+                oldest = enqueued_at
+        metrics["depth"] = metrics["pending"] + metrics["running"]
+        if oldest is not None:
+            metrics["oldest_pending_age"] = max(0, time.time() - oldest)
+        with self._lock:
+            metrics.update(self._counters)
+        return metrics
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        """
+        Return the worker pool, creating it on first use
+        """
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="libreary-repair")
+            return self._pool
+
+    @property
+    def running(self) -> bool:
+        """
+        True while the background thread is running
+        """
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """
+        Start draining the queue in a background thread
+        """
+        with self._lock:
+            if self.running:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="libreary-repair-queue", daemon=True)
+            self._thread.start()
+        logger.debug("Started repair queue")
+
+    def stop(self, timeout: float = None) -> None:
+        """
+        Stop the background thread, after any repairs in progress finish
+
+        :param timeout - seconds to wait for the thread to stop
+        """
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+        logger.debug("Stopped repair queue")
+
+    def _run(self) -> None:
+        requeued = self.metadata_man.requeue_running_repairs(
+            time.time() - DEFAULT_REPAIR_TIMEOUT)
+        if requeued:
+            logger.info(f"Requeued {requeued} abandoned repairs")
+        while not self._stop.is_set():
+            try:
+                outcomes = self.process()
+            except Exception as e:
+                logger.error(f"Repair queue failed: {e}")
+                outcomes = {}
+            # Go straight round again while there's a backlog
+            if not any(outcomes.values()):
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
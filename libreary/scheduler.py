@@ -1,4 +1,6 @@
+import json
 import logging
+import shlex
 from crontab import CronTab
 from typing import List
 
@@ -21,6 +23,7 @@ class Scheduler:
     """
 
     def __init__(self, config_dir: str):
+        self.config_dir = config_dir
         try:
             self.crontab = CronTab(user=True)
         except Exception as e:
@@ -42,7 +45,7 @@ class Scheduler:
 
         :param schedule - list of dictionaries as described.
         """
-        for entry in schedule.items():
+        for entry in schedule:
             self.add_schedule_job(entry)
 
     def add_schedule_job(self, schedule_entry: dict):
@@ -78,8 +81,10 @@ class Scheduler:
         }
         ```
         """
-        base_python_command = f"python3 -c from libreary import Libreary; l = Libreary('{self.config_dir}');"
+        config_dir = schedule_entry.get("config_dir", self.config_dir)
+        # Double-quoted python strings, so the single-quoted shell argument needs no escaping
+        statements = ["from libreary import Libreary", f"l = Libreary({json.dumps(config_dir)})"]
         for level in schedule_entry["levels_to_check"]:
-            base_python_command += f"l.check_level('{level}');"
-        base_python_command += ";".join(schedule_entry["other_commands"])
-        return base_python_command
+            statements.append(f"l.check_level({json.dumps(level)})")
+        statements += schedule_entry.get("other_commands", [])
+        return "python3 -c " + shlex.quote("; ".join(statements))
@@ -0,0 +1,478 @@
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List
+import logging
+
+from libreary.exceptions import NoCopyExistsException, ResourceNotIngestedException, LevelNotFoundException
+from libreary.throttle import AdapterBudget
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SCRUB_WORKERS = 2
+DEFAULT_SCRUB_BATCH_SIZE = 500
+DEFAULT_CHECKPOINT_INTERVAL = 200
+DEFAULT_VERIFICATION_HORIZON = 7 * 24 * 60 * 60
+DEFAULT_FULL_REHASH_EVERY = 10
+REPAIR_LOCK_STRIPES = 64
+
+# Possible results of checking one copy of a resource
+OK = "ok"
+MISSING = "missing"
+CORRUPT = "corrupt"
+REPAIRED = "repaired"
+REPAIR_FAILED = "repair_failed"
+ERROR = "error"
+
+
+class Scrubber:
+    """
+    The Scrubber audits every copy of every resource in a LIBRE-ary, and repairs
+    copies which are missing or don't match their recorded checksum.
+
+    A scrub is a queue of (resource, adapter) checks. Resources are read from the
+    metadata db in batches, and each check is handed to a thread pool belonging to
+    the adapter that holds the copy, so a slow adapter doesn't hold up the others,
+    and each adapter only sees as many concurrent checks as it's configured for.
+    Within a batch, canonical copies are checked (and restored) first, since every
+    other copy is repaired from the canonical one.
+
+    Completed checks are recorded as checkpoints in the metadata db. If a scrub is
+    interrupted, the next scrub of the same kind picks up the unfinished run and skips
+    every check that already has a checkpoint.
+
+    Deep checks keep a ledger of each copy's fingerprint (size, mtime and inode) as of
+    its last full hash. For adapters which can fingerprint copies cheaply, a copy whose
+    fingerprint is unchanged and which was hashed within the verification horizon is
+    trusted without being read again. Every `full_rehash_every` checks, it's hashed anyway.
+
+    Reads done by deep checks can be limited per adapter, in bytes per second and
+    operations per second, so that checking never starves ingest and retrieval.
+
+    This class currently contains the following methods:
+
+    - run (scrub every resource)
+    - check_resource (check and repair all copies of a single resource)
+    - check_level (check and repair all copies of every resource in a level)
+    """
+
+    def __init__(self, adapter_man: object, metadata_man: object, options: dict = None):
+        """
+        Constructor for the Scrubber object. This object can be created manually, but
+        in most cases, it will be constructed by the LIBRE-ary main object.
+
+        :param adapter_man - the AdapterManager holding the adapters to check
+        :param metadata_man - the metadata manager describing the resources and copies
+        :param options - the `options` section of the LIBRE-ary config. The following keys are used:
+        ```{json}
+        {
+            "scrub_workers": (optional, int) concurrent checks per adapter. Defaults to 2,
+            "adapter_scrub_workers": (optional) {"adapter_id": concurrent checks for that adapter},
+            "scrub_batch_size": (optional, int) resources read from the metadata db at a time. Defaults to 500,
+            "scrub_checkpoint_interval": (optional, int) checks between checkpoint writes. Defaults to 200,
+            "verification_horizon": (optional, int) seconds a full hash of an unchanged copy is trusted for.
+                Defaults to 7 days. 0 rehashes every copy on every deep check,
+            "full_rehash_every": (optional, int) rehash an unchanged copy on every Nth deep check anyway. Defaults to 10,
+            "check_budgets": (optional) {"adapter_id": {"bytes_per_sec": (int), "iops": (int)}} I/O limits for deep checks,
+            "default_check_budget": (optional) {"bytes_per_sec": (int), "iops": (int)} limits for adapters not in check_budgets
+        }
+        ```
+        """
+        options = options or {}
+        self.adapter_man = adapter_man
+        self.metadata_man = metadata_man
+        self.scrub_workers = options.get("scrub_workers", DEFAULT_SCRUB_WORKERS)
+        self.adapter_scrub_workers = options.get("adapter_scrub_workers", {})
+        self.batch_size = options.get("scrub_batch_size", DEFAULT_SCRUB_BATCH_SIZE)
+        self.checkpoint_interval = options.get(
+            "scrub_checkpoint_interval", DEFAULT_CHECKPOINT_INTERVAL)
+        self.verification_horizon = options.get(
+            "verification_horizon", DEFAULT_VERIFICATION_HORIZON)
+        self.full_rehash_every = options.get(
+            "full_rehash_every", DEFAULT_FULL_REHASH_EVERY)
+        self.check_budgets = options.get("check_budgets", {})
+        self.default_check_budget = options.get("default_check_budget")
+        self._budgets = {}
+        self._pools = {}
+        # Runs using the pools. They're shut down when the last one finishes
+        self._pool_users = 0
+        self._pools_lock = threading.Lock()
+        # Repairs of one resource share its file in the dropbox dir, so they're serialized
+        self._repair_locks = [threading.Lock() for i in range(REPAIR_LOCK_STRIPES)]
+
+    def run(self, deep: bool = False, resume: bool = True, repair: bool = True) -> dict:
+        """
+        Scrub every resource. Returns a summary structured as follows:
+        ```
+        {
+            "scrub_id": (int) id of this scrub in the metadata db,
+            "deep": (bool),
+            "resumed": (bool) whether an interrupted scrub was picked up,
+            "checked": (int) number of copies checked,
+            "ok": (int) number of copies which were fine,
+            "skipped": (int) number of copies already checked before an interruption,
+            "trusted": (int) number of copies a deep check trusted on their unchanged fingerprint,
+            "failures": [{"resource", "adapter", "result", "problem", "error"}, ...],
+            "repairs": [{"resource", "adapter", "result", "problem", "error"}, ...]
+        }
+        ```
+
+        :param deep - compute the actual checksum of every copy, rather than trusting the metadata db
+        :param resume - continue the most recent interrupted scrub of the same kind, if there is one
+        :param repair - attempt to repair missing and corrupt copies
+        """
+        scrub_id = None
+        if resume:
+            scrub_id = self.metadata_man.get_unfinished_scrub(deep)
+        resumed = scrub_id is not None
+        if resumed:
+            logger.info(f"Resuming interrupted scrub {scrub_id}")
+        else:
+            scrub_id = self.metadata_man.start_scrub(deep)
+            logger.info(f"Starting scrub {scrub_id}. Deep: {deep}")
+
+        summary = {"scrub_id": scrub_id, "deep": deep, "resumed": resumed,
+                   "checked": 0, "ok": 0, "skipped": 0, "trusted": 0, "failures": [], "repairs": []}
+        # An interrupted scrub is left as running, so it can be resumed
+        with self._using_pools():
+            for batch in self.metadata_man.iter_resources(self.batch_size):
+                self._scrub_batch(scrub_id, batch, deep, repair, summary)
+
+        self.metadata_man.finish_scrub(scrub_id)
+        logger.info(
+            f"Scrub {scrub_id} finished: {summary['checked']} checked, {len(summary['failures'])} failures, "
+            f"{len(summary['repairs'])} repairs")
+        return summary
+
+    def check_resource(self, r_id: str, deep: bool = False, repair: bool = True) -> List[dict]:
+        """
+        Check, and optionally repair, every copy of a single resource, starting with the
+        canonical copy. Returns a list with one result dict per copy.
+
+        :param r_id - UUID of the resource to check
+        :param deep - compute the actual checksum of every copy
+        :param repair - attempt to repair missing and corrupt copies
+        """
+        try:
+            resource = self.metadata_man.get_resource_info(r_id)[0]
+        except IndexError:
+            raise ResourceNotIngestedException
+
+        results = [self._check(resource, self.adapter_man.canonical_adapter,
+                               deep, repair, canonical=True)]
+        for adapter_id in self._targets(resource):
+            results.append(self._check(resource, adapter_id, deep, repair))
+        verifications = [result.pop("verification") for result in results]
+        self.metadata_man.record_copy_verifications(
+            [verification for verification in verifications if verification is not None])
+        return results
+
+    def check_level(self, level: str, deep: bool = False, repair: bool = True) -> dict:
+        """
+        Check, and optionally repair, every copy of every resource in a level: each resource's
+        canonical copy, and its copy in each of the level's adapters.
+
+        Resources and their copies are read with one joined query per batch, and each
+        adapter's copies are checked concurrently on that adapter's pool. Returns a report
+        with the same keys as `run` (without scrub_id, resumed and skipped), plus:
+        ```
+        {
+            "level": (str) the level checked,
+            "missing": [result, ...] copies which were missing, whether or not they were repaired,
+            "corrupt": [result, ...] copies which didn't match, whether or not they were repaired
+        }
+        ```
+
+        :param level - name of the level to check
+        :param deep - compute the actual checksum of every copy
+        :param repair - attempt to repair missing and corrupt copies
+        """
+        canonical_id = self.adapter_man.canonical_adapter
+        # Raises LevelNotFoundException for an unknown level
+        adapter_ids = self.adapter_man.placement.plan([level], exclude_canonical=True)
+
+        report = {"level": level, "deep": deep, "checked": 0, "ok": 0, "trusted": 0,
+                  "failures": [], "repairs": []}
+        with self._using_pools():
+            for batch in self.metadata_man.iter_level_copies(level, self.batch_size):
+                canonical_work = []
+                copy_work = []
+                for resource, copies in batch:
+                    # `canonical` is stored as text, "1" or "0"
+                    canonical_copies = [copy for copy in copies if int(copy[6])]
+                    canonical_work.append((resource, canonical_id, True, canonical_copies))
+                    for adapter_id in adapter_ids:
+                        copy_work.append((resource, adapter_id, False,
+                                          [copy for copy in copies if copy[2] == adapter_id and not int(copy[6])]))
+                self._run_work(None, canonical_work, deep, repair, report)
+                self._run_work(None, copy_work, deep, repair, report)
+
+        found = report["failures"] + report["repairs"]
+        report["missing"] = [result for result in found if result["problem"] == MISSING]
+        report["corrupt"] = [result for result in found if result["problem"] == CORRUPT]
+        logger.info(
+            f"Checked level {level}: {report['checked']} copies, {len(report['missing'])} missing, "
+            f"{len(report['corrupt'])} corrupt, {len(report['repairs'])} repaired")
+        return report
+
+    def _targets(self, resource: List[str]) -> List[str]:
+        """
+        Return the ids of the adapters that should hold a non-canonical copy of :param resource
+        """
+        # The canonical adapter's copy is checked separately
+        return self.adapter_man.placement.plan(resource[2], exclude_canonical=True, skip_unknown=True)
+
+    def _scrub_batch(self, scrub_id: int, batch: List[List[str]], deep: bool,
+                     repair: bool, summary: dict) -> None:
+        """
+        Check every copy of every resource in :param batch, canonical copies first
+        """
+        canonical_id = self.adapter_man.canonical_adapter
+        done = self.metadata_man.get_scrub_checkpoints(
+            scrub_id, [resource[5] for resource in batch])
+
+        canonical_work = []
+        copy_work = []
+        for resource in batch:
+            canonical_work.append((resource, canonical_id, True, None))
+            for adapter_id in self._targets(resource):
+                copy_work.append((resource, adapter_id, False, None))
+
+        for work in (canonical_work, copy_work):
+            pending = []
+            for item in work:
+                if (item[0][5], item[1]) in done:
+                    summary["skipped"] += 1
+                else:
+                    pending.append(item)
+            self._run_work(scrub_id, pending, deep, repair, summary)
+
+    def _run_work(self, scrub_id: int, work: List[tuple], deep: bool,
+                  repair: bool, summary: dict) -> None:
+        """
+        Run each (resource, adapter id, canonical, copies) check in :param work on its
+        adapter's pool, and record the results as they complete. `copies` is the list of
+        the adapter's copies of the resource, if they've already been looked up, or None.
+
+        Checkpoints are only recorded if :param scrub_id is set.
+        """
+        futures = [self._get_pool(adapter_id).submit(
+            self._check, resource, adapter_id, deep, repair, canonical, copies)
+            for resource, adapter_id, canonical, copies in work]
+
+        checkpoints = []
+        verifications = []
+        for future in as_completed(futures):
+            result = future.result()
+            verification = result.pop("verification")
+            if verification is not None:
+                verifications.append(verification)
+                # A verification that didn't rehash trusted the fingerprint
+                summary["trusted"] += not verification[5]
+            summary["checked"] += 1
+            if result["result"] == OK:
+                summary["ok"] += 1
+            elif result["result"] == REPAIRED:
+                summary["repairs"].append(result)
+            else:
+                summary["failures"].append(result)
+            checkpoints.append(
+                (result["resource"], result["adapter"], result["result"]))
+            if len(checkpoints) >= self.checkpoint_interval:
+                self._flush(scrub_id, checkpoints, verifications)
+                checkpoints = []
+                verifications = []
+        if checkpoints:
+            self._flush(scrub_id, checkpoints, verifications)
+
+    def _flush(self, scrub_id: int, checkpoints: List[tuple], verifications: List[tuple]) -> None:
+        """
+        Record a group of completed checks and their verifications in one transaction
+        """
+        with self.metadata_man.transaction():
+            self.metadata_man.record_copy_verifications(verifications)
+            if scrub_id is not None:
+                self.metadata_man.add_scrub_checkpoints(scrub_id, checkpoints)
+
+    def _get_pool(self, adapter_id: str) -> ThreadPoolExecutor:
+        """
+        Return the thread pool that checks copies held by :param adapter_id, creating it on first use
+        """
+        with self._pools_lock:
+            if adapter_id not in self._pools:
+                workers = self.adapter_scrub_workers.get(adapter_id, self.scrub_workers)
+                self._pools[adapter_id] = ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix=f"libreary-scrub-{adapter_id}")
+            return self._pools[adapter_id]
+
+    @contextmanager
+    def _using_pools(self):
+        """
+        Use the adapters' thread pools for the duration of a run. Runs on the same Scrubber
+        can overlap, and share the pools, which are shut down when the last of them finishes.
+        """
+        with self._pools_lock:
+            self._pool_users += 1
+        try:
+            yield
+        finally:
+            with self._pools_lock:
+                self._pool_users -= 1
+                pools = []
+                if self._pool_users == 0:
+                    pools = list(self._pools.values())
+                    self._pools = {}
+            # Outside the lock, as checks still running take it to find their budgets
+            for pool in pools:
+                pool.shutdown(wait=True)
+
+    def _verify(self, resource: List[str], adapter_id: str, deep: bool,
+                canonical: bool, result: dict, copies: List[List[str]] = None) -> bool:
+        """
+        Returns True iff the copy of :param resource in :param adapter_id matches the
+        resource's checksum. Raises NoCopyExistsException if there's no copy.
+
+        Deep checks store the verification to record in the ledger in `result["verification"]`.
+
+        :param copies - the adapter's copies of the resource, if they've already been looked up
+        """
+        r_id = resource[5]
+        expected = resource[4]
+        if canonical:
+            copy_info = copies if copies is not None else self.metadata_man.get_canonical_copy_metadata(r_id)
+            if len(copy_info) == 0:
+                raise NoCopyExistsException
+            if not deep:
+                return copy_info[0][4] == expected
+            adapter = self.adapter_man.get_canonical_adapter()
+        else:
+            if copies is not None:
+                if len(copies) == 0:
+                    raise NoCopyExistsException
+                if not deep:
+                    return copies[0][4] == expected
+            elif not deep:
+                return self.adapter_man.verify_copy(r_id, adapter_id)
+            elif len(self.metadata_man.get_copy_info(r_id, adapter_id)) == 0:
+                raise NoCopyExistsException
+            adapter = self.adapter_man.adapters[adapter_id]
+
+        get_fingerprint = getattr(adapter, "get_fingerprint", None)
+        fingerprint = get_fingerprint(r_id, canonical=canonical) if get_fingerprint else None
+        if fingerprint is not None and self._trust_fingerprint(fingerprint):
+            result["verification"] = fingerprint + (OK, False)
+            return True
+
+        self._throttle(adapter_id, fingerprint[1] if fingerprint is not None else self._size_hint(r_id))
+        # The canonical copy was checked against `expected` already, so compare
+        # against that rather than re-reading the canonical copy for every adapter
+        matches = adapter.get_actual_checksum(r_id) == expected
+        if fingerprint is not None:
+            result["verification"] = fingerprint + (OK if matches else CORRUPT, True)
+        return matches
+
+    def _get_budget(self, adapter_id: str) -> AdapterBudget:
+        """
+        Return the I/O budget for deep checks of :param adapter_id, or None if it's unlimited
+        """
+        with self._pools_lock:
+            if adapter_id not in self._budgets:
+                config = self.check_budgets.get(adapter_id, self.default_check_budget)
+                self._budgets[adapter_id] = AdapterBudget.from_config(config) if config else None
+            return self._budgets[adapter_id]
+
+    def _throttle(self, adapter_id: str, size: int) -> None:
+        """
+        Wait until :param adapter_id's budget allows reading :param size more bytes
+        """
+        budget = self._get_budget(adapter_id)
+        if budget is not None:
+            waited = budget.acquire(size)
+            if waited:
+                logger.debug(f"Throttled deep check of adapter {adapter_id} for {waited:.2f}s")
+
+    def _size_hint(self, r_id: str) -> int:
+        """
+        Best-effort size of a resource, for adapters that can't fingerprint their copies.
+        Uses the canonical copy's fingerprint, and returns 0 if that's not available either.
+        """
+        canonical = self.adapter_man.get_canonical_adapter()
+        get_fingerprint = getattr(canonical, "get_fingerprint", None)
+        try:
+            return get_fingerprint(r_id, canonical=True)[1] if get_fingerprint else 0
+        except (NoCopyExistsException, OSError):
+            return 0
+
+    def _trust_fingerprint(self, fingerprint: tuple) -> bool:
+        """
+        Returns True if a copy with :param fingerprint (copy_id, size, mtime_ns, inode)
+        can skip being rehashed: it was fine when last hashed, that was within the
+        verification horizon, it hasn't changed since, and it isn't due for a full rehash.
+        """
+        if self.verification_horizon <= 0:
+            return False
+        ledger = self.metadata_man.get_copy_verification(fingerprint[0])
+        if ledger is None or ledger[5] != OK:
+            return False
+        if tuple(ledger[1:4]) != tuple(fingerprint[1:]):
+            return False
+        if time.time() - ledger[4] > self.verification_horizon:
+            return False
+        return ledger[6] + 1 < self.full_rehash_every
+
+    def _repair(self, r_id: str, adapter_id: str, canonical: bool) -> None:
+        """
+        Restore the copy of :param r_id in :param adapter_id
+        """
+        with self._repair_locks[zlib.crc32(r_id.encode()) % REPAIR_LOCK_STRIPES]:
+            if canonical:
+                self.adapter_man.restore_canonical_copy(r_id)
+            else:
+                self.adapter_man.restore_from_canonical_copy(adapter_id, r_id)
+
+    def _check(self, resource: List[str], adapter_id: str, deep: bool,
+               repair: bool, canonical: bool = False, copies: List[List[str]] = None) -> dict:
+        """
+        Check a single copy of a resource, repairing it if needed. Never raises;
+        errors are reported in the returned result dict.
+        """
+        r_id = resource[5]
+        result = {"resource": r_id, "adapter": adapter_id, "canonical": canonical,
+                  "result": OK, "problem": None, "error": None, "verification": None}
+        if not self.adapter_man.health.available(adapter_id):
+            # Don't wait on an adapter that's out of service. It's checked again next time
+            result["result"] = ERROR
+            result["problem"] = ERROR
+            result["error"] = "adapter out of service"
+            return result
+        try:
+            if self._verify(resource, adapter_id, deep, canonical, result, copies):
+                return result
+            result["problem"] = CORRUPT
+        except (NoCopyExistsException, FileNotFoundError):
+            result["problem"] = MISSING
+        except Exception as e:
+            logger.error(f"Checking object {r_id} in adapter {adapter_id} failed: {e}")
+            result["result"] = ERROR
+            result["problem"] = ERROR
+            result["error"] = str(e)
+            return result
+
+        logger.warning(
+            f"Copy of object {r_id} in adapter {adapter_id} is {result['problem']}")
+        result["result"] = result["problem"]
+        if not repair:
+            return result
+
+        try:
+            self._repair(r_id, adapter_id, canonical)
+            if self._verify(resource, adapter_id, deep, canonical, result):
+                result["result"] = REPAIRED
+                return result
+        except Exception as e:
+            result["error"] = str(e)
+        logger.error(f"Repairing object {r_id} in adapter {adapter_id} failed")
+        result["result"] = REPAIR_FAILED
+        return result
@@ -0,0 +1,251 @@
+import argparse
+import json
+import os
+import sys
+from typing import List
+import logging
+
+from libreary.exceptions import ConfigurationError, ChecksumMismatchException
+from libreary.hashing import copy_and_checksum
+
+logger = logging.getLogger(__name__)
+
+FLAT = "flat"
+UUID = "uuid"
+CHECKSUM = "checksum"
+LAYOUTS = (FLAT, UUID, CHECKSUM)
+
+DEFAULT_FANOUT_DEPTH = 2
+DEFAULT_FANOUT_WIDTH = 2
+DEFAULT_MIGRATION_BATCH_SIZE = 500
+
+
+class StorageLayout:
+    """
+    Decides where in a LocalAdapter's `storage_dir` each copy goes.
+
+    - "flat" (the default): every copy directly in `storage_dir`, named after the resource's
+        filename (`canonical_<filename>` for canonical copies). Names that are already taken
+        get the resource's UUID as a suffix.
+    - "uuid": copies fanned out into subdirectories named after the leading hex digits of the
+        resource's UUID, e.g. `ab/cd/<uuid>`.
+    - "checksum": the same, but fanned out by the leading digits of the resource's checksum,
+        so identical resources end up next to each other.
+
+    UUIDs and checksums are evenly distributed, so the hashed layouts keep every directory
+    small however big the archive grows, and each copy's path is unique without checking
+    what's on disk. Canonical copies are named `<uuid>.canonical`.
+
+    This class currently contains the following methods:
+
+    - relative_path (where a copy goes, relative to `storage_dir`)
+    - path (where a copy goes)
+    """
+
+    def __init__(self, layout: str = FLAT, depth: int = DEFAULT_FANOUT_DEPTH, width: int = DEFAULT_FANOUT_WIDTH):
+        """
+        Constructor for StorageLayout.
+
+        :param layout - "flat", "uuid" or "checksum"
+        :param depth - levels of subdirectories, for the hashed layouts
+        :param width - hex digits per subdirectory name, for the hashed layouts
+        """
+        if layout not in LAYOUTS:
+            raise ConfigurationError(f"layout must be one of {', '.join(LAYOUTS)}, not {layout}")
+        if depth < 0 or width < 1 or depth * width > 32:
+            raise ConfigurationError(f"Invalid fan-out of {depth} levels of {width} digits")
+        self.layout = layout
+        self.depth = depth
+        self.width = width
+
+    @classmethod
+    def from_config(cls, adapter_config: dict) -> 'StorageLayout':
+        """
+        Create the layout described by the `adapter` section of a LocalAdapter's config
+        """
+        return cls(adapter_config.get("layout", FLAT),
+                   adapter_config.get("layout_depth", DEFAULT_FANOUT_DEPTH),
+                   adapter_config.get("layout_width", DEFAULT_FANOUT_WIDTH))
+
+    @property
+    def hashed(self) -> bool:
+        """
+        True if copies are fanned out into subdirectories, and their paths are unique
+        """
+        return self.layout != FLAT
+
+    def relative_path(self, r_id: str, filename: str, checksum: str = None, canonical: bool = False) -> str:
+        """
+        Return where a copy goes, relative to `storage_dir`. For the flat layout, the
+        caller must still check whether the name is taken.
+
+        :param r_id - UUID of the resource
+        :param filename - the resource's filename
+        :param checksum - the resource's checksum. Required for the checksum layout
+        :param canonical - whether it's the canonical copy
+        """
+        if self.layout == FLAT:
+            return "{}{}".format("canonical_" if canonical else "", filename)
+        if self.layout == UUID:
+            key = r_id.replace("-", "")
+        else:
+            if not checksum:
+                raise ValueError(f"The checksum layout needs the checksum of {r_id}")
+            key = checksum
+        fanout = [key[i * self.width:(i + 1) * self.width] for i in range(self.depth)]
+        return "/".join(fanout + ["{}{}".format(r_id, ".canonical" if canonical else "")])
+
+    def path(self, storage_dir: str, r_id: str, filename: str, checksum: str = None,
+             canonical: bool = False) -> str:
+        """
+        Return where a copy goes. See `relative_path`.
+
+        :param storage_dir - the adapter's storage directory
+        """
+        return os.path.expanduser(
+            "{}/{}".format(storage_dir, self.relative_path(r_id, filename, checksum, canonical)))
+
+    def __repr__(self) -> str:
+        if not self.hashed:
+            return f"StorageLayout({self.layout})"
+        return f"StorageLayout({self.layout}, depth={self.depth}, width={self.width})"
+
+
+def migrate_layout(adapter: object, layout: StorageLayout = None,
+                   batch_size: int = DEFAULT_MIGRATION_BATCH_SIZE, dry_run: bool = False) -> dict:
+    """
+    Move every copy in a LocalAdapter into :param layout, and rewrite their locators in
+    the `copies` table (and, for canonical copies, the `resources` table).
+
+    This is meant to be run offline, while nothing else is using the adapter. Copies are
+    handled :param batch_size at a time: each copy is hard linked into its new place, the
+    batch's locators are rewritten in a single transaction, and only then are the old names
+    removed. If it's interrupted, every copy is still reachable, and running it again carries
+    on where it left off. Where a hard link can't be made, the copy is copied and checked
+    against its checksum instead.
+
+    Returns counts of copies: `{"moved": (int), "skipped": (int) already in place, "failed": (int)}`
+
+    :param adapter - the LocalAdapter whose copies to move
+    :param layout - the layout to move to. Defaults to the adapter's configured layout
+    :param batch_size - copies per transaction
+    :param dry_run - count what would be moved, without moving anything
+    """
+    layout = layout or adapter.layout
+    metadata_man = adapter.metadata_man
+    counts = {"moved": 0, "skipped": 0, "failed": 0}
+    logger.info(f"Moving copies in {adapter.adapter_id} to {layout}")
+
+    for batch in metadata_man.iter_adapter_copies(adapter.adapter_id, batch_size):
+        updates = []
+        old_locations = []
+        for copy in batch:
+            copy_id, r_id, locator, checksum, canonical, filename = \
+                copy[0], copy[1], copy[3], copy[4], bool(int(copy[6])), copy[7]
+            new_location = layout.path(adapter.storage_dir, r_id, filename, checksum, canonical)
+            if os.path.abspath(locator) == os.path.abspath(new_location):
+                counts["skipped"] += 1
+                continue
+            if not layout.hashed and os.path.lexists(new_location) and \
+                    not _same_file(locator, new_location):
+                new_location = "{}_{}".format(new_location, r_id)
+            if dry_run:
+                counts["moved"] += 1
+                continue
+            try:
+                _place(locator, new_location, checksum)
+            except Exception as e:
+                logger.error(f"Could not move copy {copy_id} of {r_id} from {locator} to {new_location}: {e}")
+                counts["failed"] += 1
+                continue
+            updates.append((copy_id, new_location))
+            old_locations.append(locator)
+
+        if not updates:
+            continue
+        metadata_man.update_copy_locators(updates)
+        for locator in old_locations:
+            if os.path.lexists(locator):
+                os.remove(locator)
+        counts["moved"] += len(updates)
+        logger.info(f"Moved {counts['moved']} copies in {adapter.adapter_id}")
+
+    if not dry_run:
+        _prune_empty_dirs(os.path.expanduser(adapter.storage_dir))
+    return counts
+
+
+def _same_file(a: str, b: str) -> bool:
+    try:
+        return os.path.samefile(a, b)
+    except OSError:
+        return False
+
+
+def _place(locator: str, new_location: str, checksum: str) -> None:
+    """
+    Put a copy at :param new_location as well as its current :param locator
+    """
+    if _same_file(locator, new_location):
+        # Linked by an earlier, interrupted, run
+        return
+    os.makedirs(os.path.dirname(new_location), exist_ok=True)
+    if os.path.lexists(new_location):
+        os.remove(new_location)
+    try:
+        os.link(locator, new_location)
+    except OSError:
+        if copy_and_checksum(locator, new_location) != checksum:
+            os.remove(new_location)
+            raise ChecksumMismatchException(f"{locator} doesn't match its checksum")
+
+
+def _prune_empty_dirs(storage_dir: str) -> None:
+    """
+    Remove subdirectories of :param storage_dir left empty by a migration
+    """
+    for dirpath, _, _ in os.walk(storage_dir, topdown=False):
+        if dirpath != storage_dir and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+
+
+def main(argv: List[str] = None) -> int:
+    """
+    Command line entry point for `migrate_layout`:
+
+    `python -m libreary.storage_layout <config_dir> <adapter_id> [--layout uuid] [--dry-run]`
+
+    Without `--layout`, copies are moved into the layout in the adapter's config, so
+    the usual way to change layout is to stop LIBRE-ary, change the adapter's config,
+    run this, and start LIBRE-ary again.
+    """
+    # Imported here, as the adapters import this module
+    from libreary.adapter_manager import AdapterManager
+    from libreary.metadata import SQLite3MetadataManager
+
+    parser = argparse.ArgumentParser(
+        prog="python -m libreary.storage_layout",
+        description="Move a LocalAdapter's copies into a new storage layout. Run it while LIBRE-ary is stopped.")
+    parser.add_argument("config_dir", help="LIBRE-ary config directory, containing config.json")
+    parser.add_argument("adapter_id", help="ID of the LocalAdapter to migrate")
+    parser.add_argument("--layout", choices=LAYOUTS, help="layout to move to. Defaults to the adapter's configured one")
+    parser.add_argument("--depth", type=int, default=DEFAULT_FANOUT_DEPTH, help="levels of subdirectories")
+    parser.add_argument("--width", type=int, default=DEFAULT_FANOUT_WIDTH, help="hex digits per subdirectory name")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_MIGRATION_BATCH_SIZE, help="copies per transaction")
+    parser.add_argument("--dry-run", action="store_true", help="count the copies that would move, and stop")
+    args = parser.parse_args(argv)
+
+    with open(os.path.join(args.config_dir, "config.json")) as fh:
+        config = json.load(fh)
+    metadata_man = SQLite3MetadataManager(config["metadata"])
+    adapter = AdapterManager.create_adapter(
+        "LocalAdapter", args.adapter_id, args.config_dir, config["metadata"], metadata_man=metadata_man)
+    layout = StorageLayout(args.layout, args.depth, args.width) if args.layout else None
+
+    counts = migrate_layout(adapter, layout, batch_size=args.batch_size, dry_run=args.dry_run)
+    print(json.dumps(counts))
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
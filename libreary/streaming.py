@@ -0,0 +1,278 @@
+import queue
+import threading
+from typing import BinaryIO, Callable, Iterable, Union
+import logging
+
+from libreary.exceptions import IngestionFailedException
+from libreary.hashing import get_default_chunk_size
+
+logger = logging.getLogger(__name__)
+
+# Chunks buffered for each consumer before the source waits for the slowest one
+DEFAULT_TEE_DEPTH = 8
+# How often a blocked producer or consumer checks whether the other side has gone away
+_POLL_INTERVAL = 0.1
+
+_EOF = object()
+
+
+class PipeReader:
+    """
+    The reading end of one branch of a StreamTee. It's a minimal binary file object:
+    `read` returns bytes as the tee produces them, and b"" at the end of the stream.
+
+    If the tee is aborted, `read` raises IngestionFailedException, so whatever is
+    consuming the stream stops and cleans up.
+    """
+
+    def __init__(self, depth: int = DEFAULT_TEE_DEPTH):
+        self._chunks = queue.Queue(depth)
+        self._buffer = b""
+        self._eof = False
+        self.aborted = threading.Event()
+        # Set once the consumer has stopped reading, whether it finished or failed
+        self.closed = threading.Event()
+
+    def readable(self) -> bool:
+        return True
+
+    def _next_chunk(self) -> bytes:
+        while True:
+            if self.aborted.is_set():
+                raise IngestionFailedException("stream aborted")
+            try:
+                chunk = self._chunks.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if chunk is _EOF:
+                self._eof = True
+                return b""
+            return chunk
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            parts = [self._buffer]
+            self._buffer = b""
+            while not self._eof:
+                parts.append(self._next_chunk())
+            return b"".join(parts)
+        while not self._buffer and not self._eof:
+            self._buffer = self._next_chunk()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def _put(self, chunk) -> bool:
+        """
+        Hand :param chunk to the consumer. Returns False if the consumer has stopped reading.
+        """
+        while not self.closed.is_set():
+            try:
+                self._chunks.put(chunk, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+class RangeReader:
+    """
+    A binary file object that reads at most `length` bytes from another, then reports
+    the end of the stream. Closing it closes the underlying file object.
+    """
+
+    def __init__(self, fh: BinaryIO, length: int = None):
+        """
+        Constructor for RangeReader.
+
+        :param fh - a file object opened in binary mode, positioned at the start of the range
+        :param length - bytes to read, or None to read to the end of :param fh
+        """
+        self.fh = fh
+        self.remaining = length
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        if self.remaining is None:
+            return self.fh.read() if size is None or size < 0 else self.fh.read(size)
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return b""
+        data = self.fh.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self) -> None:
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class IterableReader:
+    """
+    A binary file object that reads from an iterable of bytes, such as a generator
+    downloading a resource in chunks. Chunks are only fetched as they're read.
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        """
+        Constructor for IterableReader.
+
+        :param chunks - an iterable of bytes
+        """
+        self.chunks = chunks
+        self._iterator = iter(chunks)
+        self._buffer = b""
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def _fill(self) -> None:
+        while not self._buffer and not self._eof:
+            try:
+                self._buffer = bytes(next(self._iterator))
+            except StopIteration:
+                self._eof = True
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            parts = [self._buffer]
+            self._buffer = b""
+            parts.extend(bytes(chunk) for chunk in self._iterator)
+            self._eof = True
+            return b"".join(parts)
+        self._fill()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self) -> None:
+        self._eof = True
+        self._buffer = b""
+        close = getattr(self.chunks, "close", None)
+        if close is not None:
+            close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class StreamTee:
+    """
+    Reads a stream once, and feeds every chunk to several consumers at the same time.
+
+    Each consumer is a callable that takes a binary file object (a `PipeReader`) and
+    runs on its own thread. Each consumer has a small bounded buffer, so the source is
+    read no faster than the slowest consumer, and memory use doesn't grow with the
+    size of the stream.
+
+    A consumer that fails drops out, and the others carry on, unless it was marked
+    `required`, in which case every consumer is aborted.
+    """
+
+    def __init__(self, source: Union[BinaryIO, Iterable[bytes]], chunk_size: int = None,
+                 depth: int = DEFAULT_TEE_DEPTH):
+        """
+        Constructor for StreamTee.
+
+        :param source - a binary file object, or an iterable of bytes
+        :param chunk_size - bytes read from a file object at a time
+        :param depth - chunks buffered for each consumer
+        """
+        self.source = source
+        self.chunk_size = chunk_size or get_default_chunk_size()
+        self.depth = depth
+        self._consumers = {}
+
+    def add(self, name: str, consume: Callable[[BinaryIO], object], required: bool = False) -> None:
+        """
+        Add a consumer.
+
+        :param name - name the consumer's result or error is reported under
+        :param consume - callable taking a binary file object, which reads it to the end
+        :param required - abort every consumer if this one fails
+        """
+        self._consumers[name] = (consume, required, PipeReader(self.depth))
+
+    def _chunks(self):
+        if hasattr(self.source, "read"):
+            while True:
+                chunk = self.source.read(self.chunk_size)
+                if not chunk:
+                    return
+                yield bytes(chunk)
+        else:
+            for chunk in self.source:
+                if chunk:
+                    yield bytes(chunk)
+
+    def run(self) -> tuple:
+        """
+        Feed the whole source to every consumer, and wait for them to finish.
+
+        Returns `(results, errors, size)`: a dict of each successful consumer's return value,
+        a dict of each failed consumer's exception, and the number of bytes read. If a required
+        consumer failed, the rest were aborted, but any that had already finished are in `results`.
+
+        Raises IngestionFailedException if the source can't be read.
+        """
+        results = {}
+        errors = {}
+        lock = threading.Lock()
+
+        def run_consumer(name, consume, required, reader):
+            try:
+                result = consume(reader)
+                # Drain anything the consumer didn't read, so the end is seen
+                while not reader._eof:
+                    reader._next_chunk()
+                with lock:
+                    results[name] = result
+            except BaseException as e:
+                with lock:
+                    errors[name] = e
+                if not reader.aborted.is_set():
+                    logger.error(f"Stream consumer {name} failed: {e}")
+                if required:
+                    self._abort()
+            finally:
+                reader.closed.set()
+
+        threads = [threading.Thread(target=run_consumer, args=(name,) + consumer,
+                                    name=f"libreary-tee-{name}", daemon=True)
+                   for name, consumer in self._consumers.items()]
+        for thread in threads:
+            thread.start()
+
+        size = 0
+        try:
+            for chunk in self._chunks():
+                size += len(chunk)
+                delivered = [reader._put(chunk) for _, _, reader in self._consumers.values()]
+                if not any(delivered):
+                    break
+            for _, _, reader in self._consumers.values():
+                reader._put(_EOF)
+        except Exception as e:
+            logger.error(f"Reading stream failed: {e}")
+            self._abort()
+            for thread in threads:
+                thread.join()
+            raise IngestionFailedException(f"reading stream failed: {e}") from e
+
+        for thread in threads:
+            thread.join()
+        return results, errors, size
+
+    def _abort(self) -> None:
+        for _, _, reader in self._consumers.values():
+            reader.aborted.set()
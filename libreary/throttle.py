@@ -0,0 +1,88 @@
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket. Tokens refill continuously at `rate` per second,
+    up to `capacity`. `acquire` blocks until enough tokens are available.
+
+    A request larger than the bucket's capacity waits for the bucket to fill, then for
+    the rest of the tokens to accrue on top, so a big file is charged in full before it's
+    read and the average rate is kept, without ever blocking forever.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        Constructor for TokenBucket.
+
+        :param rate - tokens added per second
+        :param capacity - most tokens the bucket can hold. Defaults to one second's worth
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount: float = 1) -> float:
+        """
+        Take :param amount tokens, waiting for them if needed.
+        Returns the number of seconds spent waiting.
+        """
+        waited = 0.0
+        with self._lock:
+            self._refill()
+            if self._tokens < amount:
+                waited = (amount - self._tokens) / self.rate
+                time.sleep(waited)
+                # Everything that accrued while waiting, even beyond the capacity, was this request's
+                self._tokens = 0.0
+                self._updated = time.monotonic()
+            else:
+                self._tokens -= amount
+        return waited
+
+
+class AdapterBudget:
+    """
+    Limits the background I/O one adapter does, in bytes per second and operations
+    per second. Either limit can be left unset.
+    """
+
+    def __init__(self, bytes_per_sec: float = None, iops: float = None):
+        """
+        Constructor for AdapterBudget.
+
+        :param bytes_per_sec - bytes per second this adapter may read. None for no limit
+        :param iops - operations per second this adapter may perform. None for no limit
+        """
+        self.bytes = TokenBucket(bytes_per_sec) if bytes_per_sec else None
+        self.ops = TokenBucket(iops) if iops else None
+
+    def acquire(self, size: int = 0) -> float:
+        """
+        Wait until the budget allows one more operation of :param size bytes.
+        Returns the number of seconds spent waiting.
+        """
+        waited = 0.0
+        if self.ops is not None:
+            waited += self.ops.acquire(1)
+        if self.bytes is not None and size:
+            waited += self.bytes.acquire(size)
+        return waited
+
+    @classmethod
+    def from_config(cls, config: dict) -> "AdapterBudget":
+        """
+        Build a budget from a dict like `{"bytes_per_sec": 50000000, "iops": 100}`
+        """
+        return cls(config.get("bytes_per_sec"), config.get("iops"))
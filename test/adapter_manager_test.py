@@ -1,3 +1,5 @@
+import threading
+import time
 import libreary
 from libreary import Libreary
 from libreary.adapters.AbstractAdapter import AbstractAdapter
@@ -35,4 +37,474 @@ def test_verify_adapters():
 def test_create_adapter():
     adapter = AdapterManager.create_adapter(
                     "LocalAdapter", "test_local5", "test_run_dir/config", am.config["metadata"])
-    assert type(adapter) == LocalAdapter
\ No newline at end of file
+    assert type(adapter) == LocalAdapter
+
+def test_send_resource_parallel():
+    adapters = [{"id": "local1", "type": "LocalAdapter"},
+                {"id": "local2", "type": "LocalAdapter"}]
+    am.metadata_man.add_level("test_parallel", 1, adapters, copies=1)
+    am.reload_levels_adapters()
+    r_id = l.ingester.ingest("test_run_dir/dropbox/grace.jpg", ["test_parallel"], "parallel distribution")
+    report = am.send_resource_to_adapters(r_id, parallel=True)
+    assert sorted(report["stored"]) == ["local1", "local2"]
+    assert report["failed"] == {}
+    assert len(am.summarize_copies(r_id)) == 2
+    l.delete(r_id)
+    am.metadata_man.delete_level("test_parallel")
+
+
+def test_adapter_registry_reuses_adapters():
+    first = am.get_adapter("LocalAdapter", "test_local5")
+    assert am.get_adapter("LocalAdapter", "test_local5") is first
+    assert first.metadata_man is am.metadata_man
+    am.reload_levels_adapters(invalidate=True)
+    assert am.get_adapter("LocalAdapter", "test_local5") is not first
+
+
+def test_adapter_registry_builds_outside_its_lock():
+    from libreary.adapter_registry import AdapterRegistry
+
+    class Fast:
+        def __init__(self, config, metadata_man):
+            self.metadata_man = metadata_man
+
+    class Slow(Fast):
+        def __init__(self, config, metadata_man):
+            super().__init__(config, metadata_man)
+            built.append(self)
+            started.set()
+            release.wait(5)
+
+    registry = AdapterRegistry()
+    built = []
+    started = threading.Event()
+    release = threading.Event()
+    fast = registry.get_adapter("fast", {"n": 1}, am.metadata_man, Fast)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        registry.get_adapter("slow", {"n": 2}, am.metadata_man, Slow))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    assert started.wait(5)
+    # Built adapters can still be looked up while another one is connecting
+    start = time.monotonic()
+    assert registry.get_adapter("fast", {"n": 1}, am.metadata_man, Slow) is fast
+    assert time.monotonic() - start < 1
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(built) == 1
+    assert all(result is built[0] for result in results)
+
+
+def test_adapters_are_lazy():
+    from libreary.adapters.lazy import LazyAdapter
+    am.metadata_man.add_level("test_lazy", 1, [{"id": "local2", "type": "LocalAdapter"}], copies=1)
+    am.reload_levels_adapters(invalidate=True)
+    adapter = am.adapters["local2"]
+    assert isinstance(adapter, LazyAdapter)
+    assert not adapter.loaded
+    assert adapter.adapter_id == "local2"
+    assert not adapter.loaded
+    am.warm_up()
+    assert adapter.loaded
+    assert isinstance(adapter.load(), LocalAdapter)
+    am.metadata_man.delete_level("test_lazy")
+
+
+def test_repair_queue_dedups():
+    from libreary.repair_queue import RepairQueue
+    queue = RepairQueue(am, am.metadata_man, {"background_repairs": False})
+    # The resource doesn't exist, so the repair is given up on straight away
+    assert queue.enqueue("no-such-resource", "local2", reason="test")
+    assert not queue.enqueue("no-such-resource", "local2", reason="test")
+    assert queue.metrics()["by_adapter"]["local2"]["pending"] == 1
+    assert queue.metrics()["depth"] >= 1
+
+    assert queue.process() == {"repaired": 0, "retried": 0, "gave_up": 1}
+    failed = [r for r in am.metadata_man.list_repairs("failed") if r[1] == "no-such-resource"]
+    assert len(failed) == 1
+    # Once it's been given up on, the copy can be queued again
+    assert queue.enqueue("no-such-resource", "local2", reason="test")
+    queue.process()
+
+
+def test_repair_queue_retries_with_backoff():
+    from libreary.repair_queue import RepairQueue
+
+    class FlakyAdapterManager:
+        def restore_from_canonical_copy(self, adapter_id, r_id):
+            raise ConnectionError("adapter unavailable")
+
+    queue = RepairQueue(FlakyAdapterManager(), am.metadata_man,
+                        {"background_repairs": False, "adapter_repair_max_attempts": {"flaky": 2},
+                         "repair_backoff_base": 60})
+    queue.enqueue("flaky-resource", "flaky", reason="test")
+    assert queue.process() == {"repaired": 0, "retried": 1, "gave_up": 0}
+    # Backing off, so nothing is due yet
+    assert queue.process() == {"repaired": 0, "retried": 0, "gave_up": 0}
+    assert queue.process(now=time.time() + 120) == {"repaired": 0, "retried": 0, "gave_up": 1}
+    assert queue.metrics()["gave_up"] == 1
+
+
+def test_repair_queue_backoff():
+    from libreary.repair_queue import RepairQueue
+    queue = RepairQueue(am, am.metadata_man,
+                        {"repair_backoff_base": 10, "repair_backoff_max": 60})
+    assert 5 <= queue.get_backoff(1) <= 10
+    assert 10 <= queue.get_backoff(2) <= 20
+    assert 30 <= queue.get_backoff(10) <= 60
+
+
+def test_latency_tracker():
+    from libreary.latency import LatencyTracker
+    tracker = LatencyTracker(decay=0.5)
+    assert tracker.rank(["a", "b", "c"]) == ["a", "b", "c"]
+    for _ in range(10):
+        tracker.record("b", 0.1, 1000)
+        tracker.record("c", 1.0, 1000)
+    # Adapters with no history go last, in the order given
+    assert tracker.rank(["a", "c", "b"]) == ["b", "c", "a"]
+    assert abs(tracker.predict("b", 2000) - 0.2) < 1e-9
+    assert abs(tracker.deadline("c") - 1.0) < 1e-9
+    # Not enough samples for a percentile yet
+    assert tracker.deadline("a", default=3) == 3
+    tracker.record_failure("b")
+    assert tracker.predict("b") > 0.1
+    assert tracker.summary()["c"]["samples"] == 10
+
+
+def test_hedged_retrieve():
+    from libreary.hashing import checksum_file
+
+    class SlowAdapter:
+        def __init__(self, adapter, delay):
+            self.adapter = adapter
+            self.adapter_id = adapter.adapter_id
+            self.delay = delay
+            self.released = threading.Event()
+
+        def retrieve(self, r_id, output_dir=None):
+            self.released.wait(self.delay)
+            return self.adapter.retrieve(r_id, output_dir=output_dir)
+
+    adapters = [{"id": "local1", "type": "LocalAdapter"},
+                {"id": "local2", "type": "LocalAdapter"}]
+    am.metadata_man.add_level("test_hedged", 1, adapters, copies=1)
+    am.reload_levels_adapters()
+    r_id = l.ingester.ingest("test_run_dir/dropbox/grace.jpg", ["test_hedged"], "hedged retrieval")
+    am.send_resource_to_adapters(r_id)
+    local1 = am.adapters["local1"]
+    slow = SlowAdapter(local1, 2)
+    am.adapters["local1"] = slow
+    am.retrieval_mode = "hedged"
+    am.hedge_default_delay = 0.1
+    try:
+        start = time.monotonic()
+        path = am.retrieve_by_preference(r_id)
+        assert time.monotonic() - start < 1.5
+        assert checksum_file(path) == am.metadata_man.get_resource_info(r_id)[0][4]
+        assert am.latency.predict("local2") is not None
+    finally:
+        # Let the losing retrieve finish before the resource goes away
+        slow.released.set()
+        am._get_retrieval_pool().shutdown(wait=True)
+        am._retrieval_pool = None
+        am.adapters["local1"] = local1
+        am.retrieval_mode = "preference"
+        am.hedge_default_delay = 1.0
+    l.delete(r_id)
+    am.metadata_man.delete_level("test_hedged")
+
+
+def test_hedged_retrieve_hedges_a_stalled_primary():
+    import os
+
+    class StallingAdapter:
+        def __init__(self, adapter):
+            self.adapter = adapter
+            self.adapter_id = adapter.adapter_id
+            self.released = threading.Event()
+
+        def retrieve(self, r_id, output_dir=None):
+            # Makes some progress, then stalls
+            with open(os.path.join(output_dir, "partial"), "wb") as fh:
+                fh.write(b"start")
+            self.released.wait(5)
+            return self.adapter.retrieve(r_id, output_dir=output_dir)
+
+    adapters = [{"id": "local1", "type": "LocalAdapter"},
+                {"id": "local2", "type": "LocalAdapter"}]
+    am.metadata_man.add_level("test_stalled", 1, adapters, copies=1)
+    am.reload_levels_adapters()
+    r_id = l.ingester.ingest("test_run_dir/dropbox/grace.jpg", ["test_stalled"], "stalled retrieval")
+    am.send_resource_to_adapters(r_id)
+    local1 = am.adapters["local1"]
+    stalling = StallingAdapter(local1)
+    am.adapters["local1"] = stalling
+    am._get_retrieval_candidates = lambda r_id: [stalling, am.adapters["local2"]]
+    am.hedge_default_delay = 0.1
+    try:
+        start = time.monotonic()
+        assert am.retrieve_hedged(r_id) is not None
+        assert time.monotonic() - start < 2
+    finally:
+        stalling.released.set()
+        am._get_retrieval_pool().shutdown(wait=True)
+        am._retrieval_pool = None
+        am.adapters["local1"] = local1
+        del am._get_retrieval_candidates
+        am.hedge_default_delay = 1.0
+    l.delete(r_id)
+    am.metadata_man.delete_level("test_stalled")
+
+
+def test_circuit_breaker():
+    from libreary.health import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05, max_reset_timeout=1)
+    assert breaker.allow()
+    breaker.record_failure(0.1, ConnectionError("down"))
+    assert breaker.state == CLOSED
+    breaker.record_failure(0.1, ConnectionError("down"))
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.state == HALF_OPEN
+    # Only one probe at a time
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure(0.1, ConnectionError("still down"))
+    assert breaker.state == OPEN
+    # A failed probe doubles the wait
+    time.sleep(0.06)
+    assert breaker.state == OPEN
+    time.sleep(0.05)
+    assert breaker.allow()
+    breaker.record_success(0.1)
+    assert breaker.state == CLOSED
+    assert breaker.snapshot()["failures"] == 3
+
+
+def test_stores_deferred_while_adapter_out_of_service():
+    from libreary.health import AdapterHealth, OPEN
+    adapters = [{"id": "local1", "type": "LocalAdapter"},
+                {"id": "local2", "type": "LocalAdapter"}]
+    am.metadata_man.add_level("test_health", 1, adapters, copies=1)
+    am.reload_levels_adapters()
+    health = am.health
+    am.health = AdapterHealth({"circuit_failure_threshold": 2, "circuit_reset_timeout": 60})
+    try:
+        am.health.record_failure("local2", error=ConnectionError("down"))
+        am.health.record_failure("local2", error=ConnectionError("down"))
+        assert l.get_adapter_health()["local2"]["state"] == OPEN
+
+        r_id = l.ingester.ingest("test_run_dir/dropbox/grace.jpg", ["test_health"], "deferred store")
+        report = am.send_resource_to_adapters(r_id)
+        assert report["deferred"] == ["local2"]
+        assert "local2" not in [copy[2] for copy in am.summarize_copies(r_id)]
+        assert am.retrieve_by_preference(r_id) is not None
+
+        # Nothing is attempted until the adapter is back
+        assert am.repair_queue.process(now=time.time() + 3600) == {"repaired": 0, "retried": 1, "gave_up": 0}
+        am.reset_adapter_health("local2")
+        assert am.repair_queue.process(now=time.time() + 3600) == {"repaired": 1, "retried": 0, "gave_up": 0}
+        assert "local2" in [copy[2] for copy in am.summarize_copies(r_id)]
+    finally:
+        am.health = health
+    l.delete(r_id)
+    am.metadata_man.delete_level("test_health")
+
+
+def test_change_resource_level_moves_only_changed_copies():
+    am.set_additional_adapter("test_local5", "LocalAdapter")
+    am.metadata_man.add_level("test_move_a", 1, [{"id": "local1", "type": "LocalAdapter"},
+                                                 {"id": "local2", "type": "LocalAdapter"}], copies=1)
+    am.metadata_man.add_level("test_move_b", 1, [{"id": "local2", "type": "LocalAdapter"},
+                                                 {"id": "test_local5", "type": "LocalAdapter"}], copies=1)
+    am.reload_levels_adapters()
+    r_id = l.ingester.ingest("test_run_dir/dropbox/grace.jpg", ["test_move_a"], "level change")
+    am.send_resource_to_adapters(r_id)
+    local2_copy = am.metadata_man.get_copy_info(r_id, "local2")[0][0]
+
+    report = am.change_resource_level(r_id, ["test_move_b"])
+    assert report["stored"] == ["test_local5"]
+    assert report["deleted"] == []
+    assert am.get_resource_metadata(r_id)[0][2] == "test_move_b"
+    # The shared adapter's copy wasn't touched
+    assert am.metadata_man.get_copy_info(r_id, "local2")[0][0] == local2_copy
+
+    report = am.change_resource_level(r_id, ["test_move_a"])
+    assert report["stored"] == []
+    assert report["deleted"] == ["test_local5"]
+    assert sorted(copy[2] for copy in am.summarize_copies(r_id)) == ["local1", "local2"]
+
+    try:
+        am.change_resource_level(r_id, ["no_such_level"])
+        assert False
+    except libreary.exceptions.LevelNotFoundException:
+        pass
+
+    l.delete(r_id)
+    am.metadata_man.delete_level("test_move_a")
+    am.metadata_man.delete_level("test_move_b")
+
+
+def test_placement_planner_dedups_overlapping_levels():
+    am.set_additional_adapter("test_local5", "LocalAdapter")
+    am.metadata_man.add_level("test_overlap_a", 1, [{"id": "local1", "type": "LocalAdapter"},
+                                                    {"id": "local2", "type": "LocalAdapter"}], copies=1)
+    am.metadata_man.add_level("test_overlap_b", 1, [{"id": "local2", "type": "LocalAdapter"},
+                                                    {"id": "test_local5", "type": "LocalAdapter"}], copies=1)
+    am.reload_levels_adapters()
+    plan = am.placement.plan("test_overlap_a,test_overlap_b")
+    assert plan == ("local1", "local2", "test_local5")
+    assert am.placement.plan(["test_overlap_a", "test_overlap_b"], exclude_canonical=True) == ("local2", "test_local5")
+    # Plans are cached until the levels are reloaded
+    assert am.placement.plan("test_overlap_a,test_overlap_b") is plan
+    assert am.placement.plan("test_overlap_a,no_such_level", skip_unknown=True) == ("local1", "local2")
+    try:
+        am.placement.plan("no_such_level")
+        assert False
+    except libreary.exceptions.LevelNotFoundException:
+        pass
+
+    r_id = l.ingester.ingest("test_run_dir/dropbox/grace.jpg", ["test_overlap_a", "test_overlap_b"], "overlap")
+    report = am.send_resource_to_adapters(r_id)
+    assert report["stored"] == ["local1", "local2", "test_local5"]
+    assert sorted(copy[2] for copy in am.summarize_copies(r_id)) == ["local1", "local2", "test_local5"]
+    l.delete(r_id)
+    am.metadata_man.delete_level("test_overlap_a")
+    am.metadata_man.delete_level("test_overlap_b")
+    am.reload_levels_adapters()
+    assert "test_overlap_a" not in am.levels
+    assert am.placement.plan("test_overlap_a", skip_unknown=True) == ()
+
+
+def test_repairs_leave_the_output_dir_alone():
+    import os
+    adapters = [{"id": "local1", "type": "LocalAdapter"},
+                {"id": "local2", "type": "LocalAdapter"}]
+    am.metadata_man.add_level("test_repair_staging", 1, adapters, copies=1)
+    am.reload_levels_adapters()
+    r_id = l.ingester.ingest("test_run_dir/dropbox/grace.jpg", ["test_repair_staging"], "repair staging")
+    am.send_resource_to_adapters(r_id)
+
+    # Repairs are only queued, until the background thread is started explicitly
+    am.repair_queue.enqueue(r_id, "local2", reason="test")
+    assert not am.repair_queue.running
+
+    retrieved = am.retrieve_by_preference(r_id)
+    before = set(os.listdir(am.ret_dir))
+    # So the repairs have to fetch the resource from a stored copy
+    os.replace("test_run_dir/dropbox/grace.jpg", "test_run_dir/dropbox/grace.jpg.bak")
+    try:
+        assert am.repair_queue.process() == {"repaired": 1, "retried": 0, "gave_up": 0}
+        am.restore_canonical_copy(r_id)
+    finally:
+        os.replace("test_run_dir/dropbox/grace.jpg.bak", "test_run_dir/dropbox/grace.jpg")
+    # The user's retrieved file is where they left it, and nothing else was put there
+    assert os.path.isfile(retrieved)
+    assert set(os.listdir(am.ret_dir)) == before
+    assert not [name for name in os.listdir(am.dropbox_dir) if name.startswith(".restore-")]
+    assert len(am.metadata_man.get_canonical_copy_metadata(r_id)) == 1
+    l.delete(r_id)
+    am.metadata_man.delete_level("test_repair_staging")
+
+
+def test_stream_to_adapters_survives_an_adapter_that_cannot_connect():
+    import uuid
+    from libreary.adapters.lazy import LazyAdapter
+
+    def fail_to_connect():
+        raise ConnectionError("down")
+
+    adapters = [{"id": "local1", "type": "LocalAdapter"},
+                {"id": "local2", "type": "LocalAdapter"}]
+    am.metadata_man.add_level("test_unreachable", 1, adapters, copies=1)
+    am.reload_levels_adapters()
+    am.adapters["local2"] = LazyAdapter("local2", "LocalAdapter", fail_to_connect)
+    r_id = str(uuid.uuid4())
+    try:
+        with open("test_run_dir/dropbox/grace.jpg", "rb") as fh:
+            report = am.stream_to_adapters(r_id, "grace.jpg", fh, ["test_unreachable"])
+        assert report["locator"] is not None
+        assert isinstance(report["failed"]["local2"], ConnectionError)
+        am.discard_stream(r_id, report)
+    finally:
+        am.reset_adapter_health("local2")
+        am.metadata_man.delete_level("test_unreachable")
+        am.reload_levels_adapters()
+
+
+def test_open_resource_skips_an_adapter_that_cannot_connect():
+    from libreary.adapters.lazy import LazyAdapter
+
+    def fail_to_connect():
+        raise ConnectionError("down")
+
+    r_id = l.ingest("test_run_dir/dropbox/grace.jpg", [], "opened")
+    broken = LazyAdapter("test_broken", "LocalAdapter", fail_to_connect)
+    am._get_retrieval_candidates = lambda r_id: [broken, am.get_canonical_adapter()]
+    try:
+        with am.open_resource(r_id) as stream:
+            with open("test_run_dir/dropbox/grace.jpg", "rb") as fh:
+                assert stream.read() == fh.read()
+        assert am.get_adapter_health()["test_broken"]["failures"] >= 1
+    finally:
+        del am._get_retrieval_candidates
+        am.reset_adapter_health("test_broken")
+    l.delete(r_id)
+
+
+def test_retrieve_in_place_skips_adapters_that_cannot_connect():
+    import json
+    import os
+    from libreary.adapters.lazy import LazyAdapter
+
+    def fail_to_connect():
+        raise ConnectionError("down")
+
+    config_path = "test_run_dir/config/test_linked_config.json"
+    with open(config_path, "w") as fh:
+        json.dump({"adapter": {"storage_dir": "test_run_dir/librelocal_linked", "adapter_identifier": "test_linked",
+                               "retrieve_mode": "hardlink"}}, fh)
+    r_id = l.ingest("test_run_dir/dropbox/grace.jpg", [], "linked")
+    canonical = am.get_canonical_adapter()
+    # local2 copies on retrieve, so it isn't asked, and isn't connected
+    idle = LazyAdapter("local2", "LocalAdapter", fail_to_connect)
+    broken = LazyAdapter("test_linked", "LocalAdapter", fail_to_connect)
+    am._get_retrieval_candidates = lambda r_id: [idle, broken, canonical]
+    try:
+        canonical.retrieve_mode = "path"
+        assert l.retrieve(r_id, in_place=True) == os.path.abspath(
+            am.metadata_man.get_copy_info(r_id, am.canonical_adapter)[0][3])
+        assert not idle.loaded
+        assert am.get_adapter_health()["test_linked"]["failures"] >= 1
+    finally:
+        canonical.retrieve_mode = "copy"
+        del am._get_retrieval_candidates
+        am.reset_adapter_health("test_linked")
+        os.remove(config_path)
+    l.delete(r_id)
+
+
+def test_abstract_adapter_subclasses_have_no_optional_methods():
+    class Minimal(AbstractAdapter):
+        adapter_id = "test_minimal"
+
+    for method in ("store_stream", "open", "get_fingerprint", "link"):
+        assert not AdapterManager._supports(Minimal(), method)
+    assert AdapterManager._supports(am.get_canonical_adapter(), "store_stream")
+
+
+def test_deferred_store_warns_when_repairs_are_not_running(caplog):
+    import logging
+    assert not am.repair_queue.running
+    report = {"deferred": []}
+    with caplog.at_level(logging.WARNING, logger="libreary.adapter_manager"):
+        am._defer_store("test-deferred-warning", "local2", report)
+    assert report["deferred"] == ["local2"]
+    assert "repairs aren't running" in caplog.text
+    for repair in am.metadata_man.list_repairs("pending"):
+        if repair[1] == "test-deferred-warning":
+            am.metadata_man.finish_repair(repair[0], "done")
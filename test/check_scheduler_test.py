@@ -0,0 +1,109 @@
+import time
+import uuid
+
+from libreary.libreary import Libreary
+from libreary.check_scheduler import CheckScheduler
+from libreary.throttle import TokenBucket, AdapterBudget
+
+libreary = Libreary("test_run_dir/config")
+
+
+def test_slots_are_spread_across_the_period():
+    period = 100.0
+    r_ids = [str(uuid.uuid4()) for i in range(2000)]
+    windows = [sum(CheckScheduler.is_due(r_id, period, start, start + 10) for r_id in r_ids)
+               for start in range(1000, 1100, 10)]
+    # Each resource is due in exactly one window per period
+    assert sum(windows) == len(r_ids)
+    # and no window gets much more than its share
+    assert max(windows) < 2 * len(r_ids) / len(windows)
+
+
+def test_long_window_is_always_due():
+    assert CheckScheduler.is_due("any", 10, 0, 10)
+
+
+def test_token_bucket_throttles():
+    bucket = TokenBucket(rate=100)
+    assert bucket.acquire(100) == 0
+    start = time.monotonic()
+    bucket.acquire(10)
+    assert time.monotonic() - start >= 0.05
+
+
+def test_adapter_budget_charges_oversized_reads_in_full():
+    budget = AdapterBudget(bytes_per_sec=1000)
+    # Bigger than the bucket: waits for the part the full bucket doesn't cover, rather than forever
+    assert 0.45 <= budget.acquire(1500) < 1
+    # and nothing is left over for the next read
+    start = time.monotonic()
+    budget.acquire(100)
+    assert time.monotonic() - start >= 0.08
+    assert AdapterBudget.from_config({}).acquire(10 ** 9) == 0
+
+
+def test_tick_checks_due_resources():
+    levels_dict = [
+        {
+            "id": "local2",
+            "type": "LocalAdapter"
+        }
+    ]
+    libreary.add_level("scheduled", "1", levels_dict, copies=1)
+    obj_id = libreary.ingest("test_run_dir/dropbox/grace.jpg", ["scheduled"],
+                             "cat", delete_after_store=False)
+    scheduler = CheckScheduler(libreary.adapter_man, libreary.metadata_man,
+                               libreary.scrubber, {"check_frequency_unit": 1})
+    resource = libreary.metadata_man.get_resource_info(obj_id)[0]
+    assert scheduler.get_period(resource) == 1
+
+    now = time.time()
+    libreary.metadata_man.set_scheduler_state("check_scheduler.last_tick", repr(now - 5))
+    summary = scheduler.tick(now)
+    assert summary["checked"] >= 1
+    assert obj_id not in summary["failed"]
+    # The next tick starts where this one ended
+    assert scheduler.tick(now)["checked"] == 0
+
+    libreary.delete(obj_id)
+    libreary.metadata_man.delete_level("scheduled")
+
+
+def test_due_resources_only_reads_the_due_slots():
+    from libreary.metadata.base import check_slot
+    levels_dict = [{"id": "local2", "type": "LocalAdapter"}]
+    libreary.add_level("slotted", "1", levels_dict, copies=1)
+    obj_id = libreary.ingest("test_run_dir/dropbox/grace.jpg", ["slotted"], "cat")
+    metadata_man = libreary.metadata_man
+    slot = check_slot(obj_id)
+
+    def found(low, high, levels=None):
+        return [r[5] for batch in metadata_man.iter_resources_by_slot(low, high, levels, batch_size=1) for r in batch]
+
+    assert obj_id in found(slot, min(slot + 1e-6, 1.0))
+    assert obj_id in found(slot, 1.0, ["slotted"])
+    assert obj_id not in found(0.0, slot)
+    assert obj_id not in found(slot, 1.0, ["slot_ed"])
+
+    scheduler = CheckScheduler(libreary.adapter_man, metadata_man, libreary.scrubber, {"check_frequency_unit": 100})
+    iter_resources = metadata_man.iter_resources
+    metadata_man.iter_resources = None
+    try:
+        # Due once in every period, at its slot
+        start = 1000 * 100
+        windows = [[r[5] for r in scheduler.due_resources(start + i * 10, start + (i + 1) * 10)] for i in range(10)]
+        assert sum(window.count(obj_id) for window in windows) == 1
+        assert obj_id in windows[int(slot * 10)]
+    finally:
+        metadata_man.iter_resources = iter_resources
+    libreary.delete(obj_id)
+    assert obj_id not in found(0.0, 1.0)
+    libreary.metadata_man.delete_level("slotted")
+
+
+def test_cron_command_calls_check_level():
+    from libreary.scheduler import Scheduler
+    command = Scheduler("test_run_dir/config").build_single_python_command(
+        {"levels_to_check": ["low", "high"], "other_commands": []})
+    assert command.startswith("python3 -c '")
+    assert 'Libreary("test_run_dir/config"); l.check_level("low"); l.check_level("high")' in command
@@ -0,0 +1,123 @@
+import hashlib
+import io
+
+from libreary import hashing
+
+test_file = "test_run_dir/dropbox/grace.jpg"
+grace_checksum = "6b4f683d08d5431b5f8d1c8f4071610d5cab758d"
+
+
+def test_checksum_file_matches_hashlib():
+    assert hashing.checksum_file(test_file) == grace_checksum
+
+
+def test_checksum_file_small_chunks():
+    # Chunk sizes below the minimum are clamped, but the digest must not change
+    assert hashing.checksum_file(test_file, chunk_size=1) == grace_checksum
+    assert hashing.checksum_file(
+        test_file, chunk_size=hashing.MIN_CHUNK_SIZE + 7) == grace_checksum
+
+
+def test_checksum_fileobj_without_readinto():
+    class ReadOnly:
+        def __init__(self, data):
+            self.fh = io.BytesIO(data)
+
+        def read(self, n):
+            return self.fh.read(n)
+
+    data = b"libreary" * 100000
+    expected = hashlib.sha1(data).hexdigest()
+    assert hashing.checksum_fileobj(ReadOnly(data)) == expected
+    assert hashing.checksum_fileobj(io.BytesIO(data)) == expected
+
+
+def test_set_default_chunk_size():
+    original = hashing.get_default_chunk_size()
+    hashing.set_default_chunk_size(128 * 1024)
+    assert hashing.get_default_chunk_size() == 128 * 1024
+    assert hashing.checksum_file(test_file) == grace_checksum
+    hashing.set_default_chunk_size(original)
+
+
+def test_copy_and_checksum(tmp_path):
+    destination = str(tmp_path / "grace_copy.jpg")
+    checksum = hashing.copy_and_checksum(
+        test_file, destination, verify_destination=True)
+    assert checksum == grace_checksum
+    assert hashing.checksum_file(destination) == grace_checksum
+
+
+def test_checksum_cache_hit_and_invalidation(tmp_path):
+    path = str(tmp_path / "cached.bin")
+    with open(path, "wb") as fh:
+        fh.write(b"first version")
+
+    first = hashing.checksum_file(path)
+    hits = hashing.checksum_cache.hits
+    assert hashing.checksum_file(path) == first
+    assert hashing.checksum_cache.hits == hits + 1
+
+    with open(path, "wb") as fh:
+        fh.write(b"second version, longer")
+    assert hashing.checksum_file(path) == hashlib.sha1(
+        b"second version, longer").hexdigest()
+
+
+def test_checksum_cache_is_bounded():
+    cache = hashing.ChecksumCache(max_entries=2)
+    for i in range(3):
+        st = type("Stat", (), {"st_dev": 1, "st_ino": i, "st_size": 0,
+                               "st_mtime_ns": 0, "st_ctime_ns": 0})
+        cache.put(st, str(i))
+    assert len(cache) == 2
+    cache.resize(1)
+    assert len(cache) == 1
+
+
+def test_copy_strategies(tmp_path):
+    from libreary import copying
+    copying.file_copier.forget()
+    for i in range(2):
+        destination = str(tmp_path / f"grace_fast_{i}.jpg")
+        assert hashing.copy_and_checksum(test_file, destination, verify_destination=True) == grace_checksum
+        assert hashing.checksum_file(destination, use_cache=False) == grace_checksum
+    # The best strategy is found once, and remembered for the filesystem, not each directory
+    subdir = tmp_path / "other"
+    subdir.mkdir()
+    with open(test_file, "rb") as fh:
+        assert copying.file_copier.get_strategy(fh.fileno(), str(tmp_path)) in copying.STRATEGIES
+        assert copying.file_copier.get_strategy(fh.fileno(), str(subdir)) == \
+            copying.file_copier.get_strategy(fh.fileno(), str(tmp_path))
+    assert len(copying.file_copier._detected) == 1
+
+    # Each strategy falls back to the next where the filesystem doesn't support it
+    for strategy in copying.STRATEGIES:
+        copier = copying.FileCopier(strategies=(strategy,))
+        destination = str(tmp_path / f"grace_{strategy}.jpg")
+        with open(test_file, "rb") as fsrc, open(destination, "wb") as fdst:
+            used = copier.copy(fsrc.fileno(), fdst.fileno(), str(tmp_path))
+        assert used in (strategy, copying.BUFFERED)
+        if used != copying.BUFFERED:
+            assert hashing.checksum_file(destination, use_cache=False) == grace_checksum
+
+    destination = str(tmp_path / "grace_buffered.jpg")
+    assert hashing.copy_and_checksum(test_file, destination, fast_copy=False) == grace_checksum
+
+
+def test_kernel_copies_are_read_back_despite_a_cached_source_digest(tmp_path, monkeypatch):
+    import os
+    from libreary import copying
+
+    def bad_copy(fsrc, fdst, dst_dir):
+        # Reports a kernel copy, but writes the wrong bytes
+        os.write(fdst, b"not the source")
+        return copying.COPY_FILE_RANGE
+
+    assert hashing.checksum_file(test_file) == grace_checksum
+    monkeypatch.setattr(hashing.file_copier, "copy", bad_copy)
+    destination = str(tmp_path / "grace_bad.jpg")
+    assert hashing.copy_and_checksum(test_file, destination, use_cache=True) != grace_checksum
+    # and what was read back isn't taken for the source's digest
+    monkeypatch.undo()
+    assert hashing.checksum_file(test_file) == grace_checksum
@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+
+import libreary
+
+# Cron-driven jobs import libreary on every run, so keep `import libreary` cheap.
+# The budget is generous to absorb slow CI machines; a regression that pulls
+# boto3 or googleapiclient back in costs several times this.
+IMPORT_BUDGET_SECONDS = float(os.getenv("LIBREARY_IMPORT_BUDGET", "0.25"))
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(libreary.__file__)))
+
+import_script = """
+import sys
+import time
+start = time.perf_counter()
+import libreary
+elapsed = time.perf_counter() - start
+heavy = [m for m in ("boto3", "botocore", "googleapiclient", "google_auth_oauthlib", "crontab") if m in sys.modules]
+print(elapsed)
+print(",".join(heavy))
+"""
+
+
+def run_import():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = repo_root + os.pathsep + env.get("PYTHONPATH", "")
+    out = subprocess.run([sys.executable, "-c", import_script], env=env,
+                         stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    elapsed, heavy = out.split("\n")[:2]
+    return float(elapsed), heavy
+
+
+def test_import_does_not_load_optional_backends():
+    _, heavy = run_import()
+    assert heavy == ""
+
+
+def test_import_time_budget():
+    # Best of three, to keep a cold disk cache from failing the test
+    elapsed = min(run_import()[0] for i in range(3))
+    assert elapsed < IMPORT_BUDGET_SECONDS
+
+
+def test_lazy_names_still_resolve():
+    from libreary.adapters import S3Adapter, GoogleDriveAdapter
+    from libreary.adapter_manager import adapters_translate_table
+    assert adapters_translate_table["S3Adapter"] is S3Adapter
+    assert adapters_translate_table["GoogleDriveAdapter"] is GoogleDriveAdapter
+    assert libreary.Scheduler.__name__ == "Scheduler"
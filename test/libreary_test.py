@@ -91,7 +91,420 @@ def test_libreary_ingest_metadata():
     libreary.delete(obj_id)
     libreary.metadata_man.delete_level("low")
 
+
+def test_run_check_repairs_copies():
+    levels_dict = [
+        {
+            "id": "local1",
+            "type": "LocalAdapter"
+        },
+        {
+            "id": "local2",
+            "type": "LocalAdapter"
+        }
+    ]
+    libreary.add_level("scrub", "1", levels_dict, copies=1)
+    obj_id = libreary.ingest("test_run_dir/dropbox/grace.jpg", ["scrub"],
+                             "cat", delete_after_store=False)
+    copy_path = libreary.metadata_man.get_copy_info(obj_id, "local2")[0][3]
+    with open(copy_path, "wb") as fh:
+        fh.write(b"bit rot")
+
+    # A shallow check trusts the metadata db, so it can't see the damage
+    assert libreary.check_single_resource(obj_id)
+
+    summary = libreary.run_check(deep=True, resume=False)
+    assert summary["checked"] >= 2
+    repairs = [r for r in summary["repairs"] if r["resource"] == obj_id]
+    assert [(r["adapter"], r["problem"]) for r in repairs] == [("local2", "corrupt")]
+    assert libreary.scrubber.check_resource(obj_id, deep=True, repair=False)[1]["result"] == "ok"
+    assert libreary.metadata_man.get_unfinished_scrub(True) is None
+
+    libreary.delete(obj_id)
+    libreary.metadata_man.delete_level("scrub")
+
+
+def test_run_check_resumes():
+    levels_dict = [
+        {
+            "id": "local2",
+            "type": "LocalAdapter"
+        }
+    ]
+    libreary.add_level("scrub", "1", levels_dict, copies=1)
+    obj_id = libreary.ingest("test_run_dir/dropbox/grace.jpg", ["scrub"],
+                             "cat", delete_after_store=False)
+    # Pretend an earlier scrub was interrupted after checking this object
+    scrub_id = libreary.metadata_man.start_scrub(False)
+    libreary.metadata_man.add_scrub_checkpoints(
+        scrub_id, [(obj_id, "local1", "ok"), (obj_id, "local2", "ok")])
+
+    summary = libreary.run_check()
+    assert summary["scrub_id"] == scrub_id
+    assert summary["resumed"]
+    assert summary["skipped"] == 2
+
+    libreary.delete(obj_id)
+    libreary.metadata_man.delete_level("scrub")
+
+
+def test_deep_check_trusts_unchanged_copies():
+    levels_dict = [
+        {
+            "id": "local2",
+            "type": "LocalAdapter"
+        }
+    ]
+    libreary.add_level("scrub", "1", levels_dict, copies=1)
+    obj_id = libreary.ingest("test_run_dir/dropbox/grace.jpg", ["scrub"],
+                             "cat", delete_after_store=False)
+
+    first = libreary.scrubber.check_resource(obj_id, deep=True)
+    assert [r["result"] for r in first] == ["ok", "ok"]
+    copy_id = libreary.metadata_man.get_copy_info(obj_id, "local2")[0][0]
+    assert libreary.metadata_man.get_copy_verification(copy_id)[6] == 0
+
+    # Nothing changed, so the second deep check doesn't rehash
+    libreary.scrubber.check_resource(obj_id, deep=True)
+    assert libreary.metadata_man.get_copy_verification(copy_id)[6] == 1
+
+    # A rewritten copy no longer matches its fingerprint, so it's rehashed and repaired
+    copy_path = libreary.metadata_man.get_copy_info(obj_id, "local2")[0][3]
+    with open(copy_path, "wb") as fh:
+        fh.write(b"bit rot")
+    third = libreary.scrubber.check_resource(obj_id, deep=True)
+    assert third[1]["result"] == "repaired"
+
+    libreary.delete(obj_id)
+    libreary.metadata_man.delete_level("scrub")
+
+
+def test_check_level_reports_missing_and_corrupt_copies():
+    levels_dict = [
+        {
+            "id": "local1",
+            "type": "LocalAdapter"
+        },
+        {
+            "id": "local2",
+            "type": "LocalAdapter"
+        }
+    ]
+    libreary.add_level("checked", "1", levels_dict, copies=1)
+    corrupt_id = libreary.ingest("test_run_dir/dropbox/grace.jpg", ["checked"],
+                                 "cat", delete_after_store=False)
+    missing_id = libreary.ingest("test_run_dir/dropbox/grace.jpg", ["checked"],
+                                 "another cat", delete_after_store=False)
+    with open(libreary.metadata_man.get_copy_info(corrupt_id, "local2")[0][3], "wb") as fh:
+        fh.write(b"bit rot")
+    libreary.adapter_man.adapters["local2"].delete(missing_id)
+
+    report = libreary.check_level("checked", deep=True)
+    assert report["level"] == "checked"
+    assert [(r["resource"], r["adapter"]) for r in report["missing"]] == [(missing_id, "local2")]
+    assert [(r["resource"], r["adapter"]) for r in report["corrupt"]] == [(corrupt_id, "local2")]
+    assert len(report["repairs"]) == 2
+    assert report["failures"] == []
+    assert libreary.check_level("checked", deep=True)["ok"] == 4
+
+    libreary.delete(corrupt_id)
+    libreary.delete(missing_id)
+    libreary.metadata_man.delete_level("checked")
+
 if __name__ == '__main__':
 
     test_libreary_ingest_metadata()
 
+
+
+def test_ingest_many():
+    import os
+    import shutil
+    import tempfile
+    from libreary.hashing import checksum_file
+    levels_dict = [{"id": "local1", "type": "LocalAdapter"},
+                   {"id": "local2", "type": "LocalAdapter"}]
+    libreary.add_level("bulk", "1", levels_dict, copies=1)
+    source_dir = tempfile.mkdtemp()
+    paths = []
+    for i in range(12):
+        # Files with the same name in different directories must not clobber each other
+        subdir = os.path.join(source_dir, str(i % 3))
+        os.makedirs(subdir, exist_ok=True)
+        path = os.path.join(subdir, f"file{i // 3}.txt")
+        with open(path, "w") as fh:
+            fh.write(f"bulk ingest {i}")
+        paths.append(path)
+    missing = os.path.join(source_dir, "missing.txt")
+
+    libreary.ingest_pipeline.batch_size = 5
+    results = list(libreary.ingest_many(iter(paths + [missing]), ["bulk"], "bulk", delete_after_store=True))
+    libreary.ingest_pipeline.batch_size = 100
+
+    assert len(results) == 13
+    failed = [r for r in results if r["error"] is not None]
+    assert [(r["path"], r["stage"], r["resource"]) for r in failed] == [(missing, "hash", None)]
+    for result in results:
+        if result["error"] is not None:
+            continue
+        obj_id = result["resource"]
+        assert sorted(result["report"]["stored"]) == ["local1", "local2"]
+        assert libreary.metadata_man.get_resource_info(obj_id)[0][4] == checksum_file(result["path"])
+        assert libreary.metadata_man.get_copy_info(obj_id, "local2")[0][4] == checksum_file(result["path"])
+        assert len(libreary.metadata_man.get_canonical_copy_metadata(obj_id)) == 1
+        libreary.delete(obj_id)
+    libreary.metadata_man.delete_level("bulk")
+    shutil.rmtree(source_dir)
+
+
+def test_stream_tee():
+    from libreary.streaming import StreamTee
+
+    def fail(reader):
+        reader.read(3)
+        raise ValueError("consumer failed")
+
+    data = [bytes([i]) * 1000 for i in range(50)]
+    tee = StreamTee(iter(data), depth=2)
+    tee.add("whole", lambda reader: reader.read())
+    tee.add("chunked", lambda reader: b"".join(iter(lambda: reader.read(7), b"")))
+    tee.add("failing", fail)
+    results, errors, size = tee.run()
+    assert size == 50000
+    assert results["whole"] == results["chunked"] == b"".join(data)
+    assert isinstance(errors["failing"], ValueError)
+
+    tee = StreamTee(iter(data), depth=2)
+    tee.add("required", fail, required=True)
+    tee.add("other", lambda reader: reader.read())
+    results, errors, size = tee.run()
+    assert results == {}
+    assert set(errors) == {"required", "other"}
+
+
+def test_ingest_stream():
+    import os
+    from libreary.hashing import checksum_file
+    levels_dict = [{"id": "local1", "type": "LocalAdapter"},
+                   {"id": "local2", "type": "LocalAdapter"}]
+    libreary.add_level("streamed", "1", levels_dict, copies=1)
+    path = "test_run_dir/dropbox/grace.jpg"
+    checksum = checksum_file(path)
+
+    with open(path, "rb") as fh:
+        file_id = libreary.ingest_stream(fh, "grace.jpg", ["streamed"], "from a file",
+                                         metadata_schema=["owner"], metadata=[{"field": "owner", "value": "me"}])
+    with open(path, "rb") as fh:
+        chunks = iter(lambda: fh.read(4096), b"")
+        # Staged copies are made from a private file, leaving the one in the dropbox alone
+        iter_id = libreary.ingest_stream(chunks, "grace.jpg", ["streamed"], "from chunks", stage=True)
+
+    assert os.path.isfile(path)
+    assert [f for f in os.listdir("test_run_dir/dropbox") if f.startswith(".stream-")] == []
+    for obj_id in (file_id, iter_id):
+        assert libreary.metadata_man.get_resource_info(obj_id)[0][4] == checksum
+        for adapter_id in ("local1", "local2"):
+            copies = libreary.metadata_man.get_copy_info(obj_id, adapter_id)
+            assert len(copies) >= 1
+            assert all(checksum_file(copy[3]) == checksum for copy in copies)
+        assert checksum_file(libreary.retrieve(obj_id)) == checksum
+        libreary.delete(obj_id)
+    libreary.metadata_man.delete_level("streamed")
+
+
+def test_open():
+    import pytest
+    from libreary.exceptions import ChecksumMismatchException
+    levels_dict = [{"id": "local1", "type": "LocalAdapter"},
+                   {"id": "local2", "type": "LocalAdapter"}]
+    libreary.add_level("opened", "1", levels_dict, copies=1)
+    path = "test_run_dir/dropbox/grace.jpg"
+    with open(path, "rb") as fh:
+        data = fh.read()
+    obj_id = libreary.ingest(path, ["opened"], "opened")
+
+    with libreary.open(obj_id) as stream:
+        chunks = iter(lambda: stream.read(1000), b"")
+        assert b"".join(chunks) == data
+        assert stream.verified
+    with libreary.open(obj_id, offset=10, length=100) as stream:
+        assert stream.read() == data[10:110]
+    with libreary.open(obj_id, offset=len(data) - 5, length=100) as stream:
+        assert stream.read() == data[-5:]
+
+    # Corrupt every copy, so whichever is opened is caught
+    copies = [libreary.metadata_man.get_copy_info(obj_id, adapter_id)[0][3]
+              for adapter_id in ("local1", "local2")]
+    for copy in copies:
+        with open(copy, "r+b") as fh:
+            fh.write(b"corrupt")
+    with libreary.open(obj_id) as stream:
+        with pytest.raises(ChecksumMismatchException):
+            stream.read()
+    for copy in copies:
+        with open(copy, "wb") as fh:
+            fh.write(data)
+
+    libreary.delete(obj_id)
+    libreary.metadata_man.delete_level("opened")
+
+
+def test_retrieve_in_place():
+    import os
+    import stat
+    from libreary.hashing import checksum_file
+    libreary.add_level("linked", "1", [{"id": "local1", "type": "LocalAdapter"}], copies=1)
+    obj_id = libreary.ingest("test_run_dir/dropbox/grace.jpg", ["linked"], "linked")
+    checksum = libreary.metadata_man.get_resource_info(obj_id)[0][4]
+    adapter = libreary.adapter_man.get_canonical_adapter().load()
+    copy_id, _, _, copy_path = libreary.metadata_man.get_copy_info(obj_id, "local1")[0][:4]
+    copy_path = os.path.abspath(copy_path)
+
+    try:
+        adapter.retrieve_mode = "hardlink"
+        libreary.metadata_man.record_copy_verifications([(copy_id, 1, 1, 1, "ok", True)])
+        path = libreary.retrieve(obj_id, in_place=True)
+        assert os.stat(path).st_ino == os.stat(copy_path).st_ino
+        assert not stat.S_IMODE(os.stat(copy_path).st_mode) & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+        # The next deep check has to hash the exposed copy in full
+        assert libreary.metadata_man.get_copy_verification(copy_id) is None
+
+        # A copying retrieve replaces the link, rather than writing through it
+        copied = libreary.retrieve(obj_id, in_place=False)
+        assert copied == path
+        assert os.stat(copied).st_ino != os.stat(copy_path).st_ino
+        assert checksum_file(copy_path, use_cache=False) == checksum
+
+        adapter.retrieve_mode = "symlink"
+        path = libreary.retrieve(obj_id, in_place=True)
+        assert os.path.islink(path) and os.path.realpath(path) == os.path.realpath(copy_path)
+
+        adapter.retrieve_mode = "path"
+        assert libreary.retrieve(obj_id, in_place=True) == copy_path
+        # Copying is the default
+        assert libreary.retrieve(obj_id) != copy_path
+    finally:
+        adapter.retrieve_mode = "copy"
+    assert not os.path.islink(libreary.retrieve(obj_id, in_place=True))
+    libreary.delete(obj_id)
+    libreary.metadata_man.delete_level("linked")
+
+
+def test_storage_layout_migration():
+    import os
+    from libreary.hashing import checksum_file
+    from libreary.storage_layout import StorageLayout, migrate_layout, main
+    libreary.add_level("sharded", "1", [{"id": "local1", "type": "LocalAdapter"}], copies=1)
+    adapter = libreary.adapter_man.get_canonical_adapter().load()
+    path = "test_run_dir/dropbox/grace.jpg"
+    checksum = checksum_file(path)
+    obj_ids = [libreary.ingest(path, ["sharded"], "sharded") for _ in range(3)]
+
+    assert main(["test_run_dir/config", "local1", "--layout", "checksum", "--dry-run"]) == 0
+    assert all(os.path.isfile(libreary.metadata_man.get_copy_info(obj_id, "local1")[0][3]) for obj_id in obj_ids)
+
+    try:
+        adapter.layout = StorageLayout("checksum")
+        counts = migrate_layout(adapter, batch_size=2)
+        assert counts["failed"] == 0 and counts["moved"] >= 3
+        for obj_id in obj_ids:
+            locator = libreary.metadata_man.get_copy_info(obj_id, "local1")[0][3]
+            assert locator.endswith(f"/{checksum[:2]}/{checksum[2:4]}/{obj_id}.canonical")
+            assert libreary.metadata_man.get_resource_info(obj_id)[0][1] == locator
+            assert checksum_file(libreary.retrieve(obj_id)) == checksum
+        assert migrate_layout(adapter)["moved"] == 0
+
+        # New copies go straight into the layout, even when streamed
+        with open(path, "rb") as fh:
+            obj_ids.append(libreary.ingest_stream(fh, "grace.jpg", ["sharded"], "sharded"))
+        locator = libreary.metadata_man.get_copy_info(obj_ids[-1], "local1")[0][3]
+        assert locator.endswith(f"/{checksum[:2]}/{checksum[2:4]}/{obj_ids[-1]}.canonical")
+    finally:
+        adapter.layout = StorageLayout()
+        assert migrate_layout(adapter)["failed"] == 0
+
+    for obj_id in obj_ids:
+        locator = libreary.metadata_man.get_copy_info(obj_id, "local1")[0][3]
+        assert os.path.dirname(locator) == adapter.storage_dir
+        assert checksum_file(locator) == checksum
+        libreary.delete(obj_id)
+    # Emptied fan-out directories are removed
+    assert not any(os.path.isdir(os.path.join(adapter.storage_dir, name)) for name in os.listdir(adapter.storage_dir))
+    libreary.metadata_man.delete_level("sharded")
+
+
+def test_ingest_and_delete_hold_no_transaction_during_adapter_io():
+    import os
+    adapter_man = libreary.adapter_man
+    levels_dict = [{"id": "local1", "type": "LocalAdapter"},
+                   {"id": "local2", "type": "LocalAdapter"}]
+    libreary.add_level("unlocked", "1", levels_dict, copies=1)
+    real = adapter_man.adapters["local2"]
+    seen = []
+
+    class Watched:
+        adapter_id = "local2"
+        fail_delete = True
+
+        def store(self, r_id):
+            seen.append(libreary.metadata_man.in_transaction())
+            return real.store(r_id)
+
+        def delete(self, r_id):
+            seen.append(libreary.metadata_man.in_transaction())
+            if self.fail_delete:
+                self.fail_delete = False
+                raise ConnectionError("local2 went away")
+            return real.delete(r_id)
+
+    adapter_man.adapters["local2"] = Watched()
+    try:
+        obj_id = libreary.ingest("test_run_dir/dropbox/grace.jpg", ["unlocked"], "unlocked")
+        try:
+            libreary.delete(obj_id)
+            assert False, "delete should have failed"
+        except ConnectionError:
+            pass
+        # Nothing was rolled back, and what's left is still recorded
+        copy = libreary.metadata_man.get_copy_info(obj_id, "local2")[0]
+        assert os.path.isfile(copy[3])
+        assert len(libreary.metadata_man.get_canonical_copy_metadata(obj_id)) == 1
+        assert len(libreary.metadata_man.get_resource_info(obj_id)) == 1
+        libreary.delete(obj_id)
+        assert libreary.metadata_man.get_resource_info(obj_id) == []
+        assert seen == [False, False, False]
+    finally:
+        adapter_man.adapters["local2"] = real
+        adapter_man.reset_adapter_health("local2")
+        libreary.metadata_man.delete_level("unlocked")
+
+
+def test_failed_link_leaves_the_stored_copy_alone():
+    import os
+    obj_id = libreary.ingest("test_run_dir/dropbox/grace.jpg", [], "unlinked")
+    adapter = libreary.adapter_man.get_canonical_adapter().load()
+    copy_id, _, _, copy_path = libreary.metadata_man.get_copy_info(obj_id, "local1")[0][:4]
+    mode = os.stat(copy_path).st_mode
+    libreary.metadata_man.record_copy_verifications([(copy_id, 1, 1, 1, "ok", True)])
+    try:
+        adapter.retrieve_mode = "symlink"
+        assert adapter.link(obj_id, output_dir="test_run_dir/no-such-dir") is None
+    finally:
+        adapter.retrieve_mode = "copy"
+    assert os.stat(copy_path).st_mode == mode
+    assert libreary.metadata_man.get_copy_verification(copy_id) is not None
+    libreary.delete(obj_id)
+
+
+def test_overlapping_checks_share_the_scrub_pools():
+    libreary.add_level("overlap", "1", [{"id": "local2", "type": "LocalAdapter"}], copies=1)
+    obj_id = libreary.ingest("test_run_dir/dropbox/grace.jpg", ["overlap"], "overlap")
+    scrubber = libreary.scrubber
+    # Stands in for a scrub that's still running on another thread
+    with scrubber._using_pools():
+        pool = scrubber._get_pool("local2")
+        assert scrubber.check_level("overlap")["checked"] == 2
+        assert pool.submit(lambda: "still running").result() == "still running"
+    assert scrubber._pools == {}
+    libreary.delete(obj_id)
+    libreary.metadata_man.delete_level("overlap")
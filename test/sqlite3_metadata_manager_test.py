@@ -36,4 +36,113 @@ def test_metadata_add_delete_resource():
     mm.ingest_to_db("No Locator", ",".join([str(l) for l in a]), "test filename", "sha1 hash", "test-hell", "test-object")
     assert len(mm.list_resources()) == init_resources + 1
     mm.delete_resource("test-hell")
-    assert len(mm.list_resources()) == init_resources
\ No newline at end of file
+    assert len(mm.list_resources()) == init_resources
+
+def test_metadata_migrations_applied():
+    from libreary.metadata.sqlite3 import MIGRATIONS
+    latest = MIGRATIONS[-1][0]
+    assert mm.get_schema_version() == latest
+    # Running migrations again is a no-op
+    assert mm.migrate() == latest
+    indexes = [row[0] for row in cursor.execute(
+        "select name from sqlite_master where type='index'").fetchall()]
+    assert "idx_copies_resource_adapter" in indexes
+    assert "idx_resources_uuid" in indexes
+
+
+def test_metadata_transaction_commits_once():
+    init_resources = len(mm.list_resources())
+    with mm.transaction():
+        mm.ingest_to_db("No Locator", "test", "test filename", "sha1 hash", "test-tx-1", "test-object")
+        with mm.transaction():
+            mm.ingest_to_db("No Locator", "test", "test filename", "sha1 hash", "test-tx-2", "test-object")
+        assert mm.in_transaction()
+        # Not visible to other connections until the outer block commits
+        assert len(cursor.execute("select * from resources").fetchall()) == init_resources
+    assert not mm.in_transaction()
+    assert len(cursor.execute("select * from resources").fetchall()) == init_resources + 2
+    mm.delete_resource("test-tx-1")
+    mm.delete_resource("test-tx-2")
+
+
+def test_metadata_transaction_rolls_back():
+    init_resources = len(mm.list_resources())
+    try:
+        with mm.transaction():
+            mm.ingest_to_db("No Locator", "test", "test filename", "sha1 hash", "test-tx-3", "test-object")
+            raise ValueError
+    except ValueError:
+        pass
+    assert len(mm.list_resources()) == init_resources
+
+
+def test_metadata_wal_and_thread_local_connections():
+    import threading
+    assert mm.conn.execute("pragma journal_mode").fetchone()[0] == "wal"
+
+    connections = []
+    errors = []
+
+    def worker(i):
+        try:
+            connections.append(mm.conn)
+            mm.ingest_to_db("No Locator", "test", "test filename", "sha1 hash", f"test-thread-{i}", "test-object")
+            mm.delete_resource(f"test-thread-{i}")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert len(set(id(c) for c in connections)) == 4
+    assert mm.conn not in connections
+
+
+def test_metadata_busy_transaction_retried_whole():
+    init_resources = len(mm.list_resources())
+    attempts = []
+
+    def record():
+        attempts.append(mm.in_transaction())
+        if len(attempts) == 1:
+            # Read, so the transaction has a snapshot, then let another connection write.
+            # The snapshot is now stale, and retrying the statement can't help.
+            mm.cursor.execute("begin")
+            mm.list_resources()
+            db_conn.execute("insert or replace into scheduler_state values ('test-busy', '1')")
+            db_conn.commit()
+        mm.ingest_to_db("No Locator", "test", "test filename", "sha1 hash", f"test-busy-{len(attempts)}", "test-object")
+
+    mm.run_in_transaction(record)
+    assert attempts == [True, True]
+    assert mm.get_resource_info("test-busy-1") == []
+    assert len(mm.list_resources()) == init_resources + 1
+    mm.delete_resource("test-busy-2")
+    db_conn.execute("delete from scheduler_state where name='test-busy'")
+    db_conn.commit()
+
+
+def test_metadata_iter_level_copies_matches_level_names_exactly():
+    for r_id, levels in (("test-level-1", "a_b"), ("test-level-2", "aXb,other"), ("test-level-3", "A_B")):
+        mm.ingest_to_db("No Locator", levels, "test filename", "sha1 hash", r_id, "test-object")
+    found = [resource[5] for batch in mm.iter_level_copies("a_b") for resource, copies in batch]
+    assert found == ["test-level-1"]
+    for r_id in ("test-level-1", "test-level-2", "test-level-3"):
+        mm.delete_resource(r_id)
+
+
+def test_metadata_deferred_copies_written_with_resource():
+    with mm.deferred_copies() as copies:
+        mm.add_copy("test-deferred", "local1", "somewhere", "sha1 hash", "LocalAdapter", canonical=True)
+    assert mm.get_copy_info("test-deferred", "local1") == []
+    with mm.transaction():
+        mm.ingest_to_db("No Locator", "a", "test filename", "sha1 hash", "test-deferred", "test-object")
+        mm.add_copies(copies)
+    canonical = mm.get_canonical_copy_metadata("test-deferred")
+    assert len(canonical) == 1
+    mm.delete_copy_metadata(canonical[0][0])
+    mm.delete_resource("test-deferred")